@@ -0,0 +1,116 @@
+'''
+Asynchronous versions of the functions of "crud.py" used by the API to
+read the database, relying on the asyncio-native Motor client so that
+requests never block the event loop of the server.
+'''
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from . import crud
+
+# Maximum number of threads running the blocking functions of "crud.py".
+BLOCKING_WORKERS = 4
+# Maximum number of connections to MongoDB kept open by each process of
+# the API (they are reused from one request to another).
+POOL_SIZE = 100
+
+motorClient = AsyncIOMotorClient(crud.MONGO_URL, maxPoolSize=POOL_SIZE)
+database = motorClient["air_quality"]
+
+# Threads running the functions of "crud.py" which would otherwise block
+# the event loop of the server.
+executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+
+async def run_blocking(function, *args):
+    '''
+    Run "function" with the given arguments in one of the threads of
+    "executor" and return its result.
+    '''
+    # Keep the context of the request (see "metrics.round_trips").
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(contextvars.copy_context().run, function, *args))
+
+async def get_last_update():
+    '''
+    Same as function "get_last_update" of "crud.py", sharing the date
+    already read by the synchronous functions (and raising
+    "databaseNotReady" the same way).
+    '''
+    if not(crud.update_is_known()):
+        crud.remember_update(await database["last_update"].find_one())
+    return crud.known_update["date"]
+
+async def is_monitored_by(pollutant, station_code):
+    '''
+    Same as function "is_monitored_by" of "crud.py".
+    '''
+    # Load the catalogue again once the database has been updated.
+    version = await get_last_update()
+    if crud.catalogue["version"] != version:
+        crud.set_catalogue(
+            version,
+            await database["distribution_pollutants"].find().to_list(None))
+    return pollutant in crud.catalogue["pollutants"].get(station_code, ())
+
+async def profiles_of(pairs, n_days):
+    '''
+    Same as function "profiles_of" of "crud.py".
+    '''
+    # Consider only the data published by the last update.
+    end = await get_last_update()+timedelta(days=1)
+    profiles = await run_blocking(crud.cube_profiles, pairs, n_days, end)
+    if profiles is not None:
+        return profiles
+    if not(n_days):
+        return crud.complete_profiles(pairs, {})
+    name, pipeline = crud.profiles_query(
+        {station for station, _ in pairs},
+        {pollutant for _, pollutant in pairs},
+        n_days,
+        end)
+    return crud.complete_profiles(
+        pairs,
+        crud.profiles_from(
+            await database[name].aggregate(pipeline).to_list(None),
+            n_days,
+            end))
+
+async def get_values(station, pollutant, n_days):
+    '''
+    Same as function "get_values" of "crud.py".
+    '''
+    profiles = await profiles_of([(station, pollutant)], n_days)
+    return profiles[(station, pollutant)]
+
+async def get_profiles(stations, pollutants, n_days):
+    '''
+    Same as function "get_profiles" of "crud.py".
+    '''
+    pairs = [
+        (station, pollutant)
+        for station in stations for pollutant in pollutants
+        if await is_monitored_by(pollutant, station)]
+    if not(pairs):
+        return {}
+    return await profiles_of(pairs, n_days)
+
+async def get_statistics(station, pollutant, n_days, statistics):
+    '''
+    Same as function "get_statistics" of "crud.py".
+    '''
+    # Consider only the data published by the last update.
+    end = await get_last_update()+timedelta(days=1)
+    matrix = await run_blocking(crud.cube_matrix, station, pollutant, n_days, end)
+    if matrix is None:
+        name, query, projection = crud.statistics_query(
+            station, pollutant, n_days, end)
+        matrix = crud.statistics_matrix(
+            await database[name].find(query, projection).to_list(None),
+            n_days,
+            end)
+    return crud.hourly_statistics(matrix, statistics)
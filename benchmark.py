@@ -0,0 +1,955 @@
+'''
+Benchmarks of the pipeline filling the "air_quality" database.
+
+The LCSQA server is replaced by a local HTTP server serving synthetic
+daily files, so that results do not depend on the network.
+
+Usage:
+    python -m webApplication.benchmark download [--days N]
+    python -m webApplication.benchmark query [--mongo URL]
+    python -m webApplication.benchmark startup
+    python -m webApplication.benchmark load [--url URL] [--station CODE]
+    python -m webApplication.benchmark update [--mongo URL]
+    python -m webApplication.benchmark writers [--mongo URL] [--days N]
+        [--stations N]
+    python -m webApplication.benchmark storage [--mongo URL]
+    python -m webApplication.benchmark encoding
+    python -m webApplication.benchmark explain [--mongo URL]
+    python -m webApplication.benchmark suite [--mongo URL] [--stations N]
+        [--pollutants N] [--days N] [--queries N] [--output FILE]
+        [--baseline FILE]
+
+The "suite" command runs the whole pipeline (ingestion, creation, update
+and queries) on synthetic files and prints its measures as JSON. With
+"--mongo mongomock://", it runs against the in-process stand-in of the
+"mongomock" package (to be installed separately), the stages using
+operators it does not implement being skipped. With "--baseline", it exits
+with status 1 when a throughput or latency is worse than in the given
+results of a previous run.
+
+The "explain" command does not measure anything: it checks that each
+query issued by the API and the client uses an index, and exits with
+status 1 when one of them scans a whole collection.
+'''
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from statistics import mean, quantiles
+from urllib.parse import urlencode, urlsplit
+
+from bson import decode, encode
+from bson.code import Code
+from pymongo import MongoClient, monitoring
+
+from . import crud
+
+# Header of the daily "csv" files published by the LCSQA.
+FR_E2_COLUMNS = [
+    "Date de début",
+    "Date de fin",
+    "Organisme",
+    "code zas",
+    "Zas",
+    "code site",
+    "nom site",
+    "type d'implantation",
+    "Polluant",
+    "type d'influence",
+    "discriminant",
+    "Réglementaire",
+    "type d'évaluation",
+    "procédure de mesure",
+    "type de valeur",
+    "valeur",
+    "valeur brute",
+    "unité de mesure",
+    "taux de saisie",
+    "couverture temporelle",
+    "couverture de données",
+    "code qualité",
+    "validité"]
+
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+POLLUTANTS = ["O3","NO2","SO2","PM2.5","PM10","CO","NO","NOX as NO2"]
+
+def synthetic_day(DATE, n_stations=20, pollutants=POLLUTANTS, seed=0):
+    '''
+    Return the content of a "csv" file in the format of the LCSQA daily
+    files, with one reading per station, pollutant and hour of "DATE".
+    '''
+    generator = random.Random(seed+DATE.toordinal())
+    lines = [";".join(FR_E2_COLUMNS)]
+    for i in range(n_stations):
+        code = "FR"+str(10000+i)
+        for pollutant in pollutants:
+            for hour in range(24):
+                start = datetime(DATE.year, DATE.month, DATE.day, hour)
+                end = start+timedelta(hours=1)
+                value = round(generator.uniform(-1,60), 1)
+                validity = 1 if generator.random() < 0.9 else -1
+                lines.append(";".join([
+                    start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT),
+                    "ORGANISME", "FR01ZAG01", "ZAG",
+                    code, "Station "+str(i), "Urbaine", pollutant,
+                    "Fond", "", "Oui", "mesures fixes", "", "moyenne horaire",
+                    str(value), str(value), "µg-m3", "", "", "", "A",
+                    str(validity)]))
+    return ("\n".join(lines)+"\n").encode()
+
+def write_fixtures(directory, dates, **parameters):
+    '''
+    Write synthetic daily files for the given days in "directory", using
+    the same tree of folders as the LCSQA server.
+    '''
+    for DATE in dates:
+        folder = os.path.join(directory, str(DATE.year))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "FR_E2_"+DATE.isoformat()+".csv"), "wb") as f:
+            f.write(synthetic_day(DATE, **parameters))
+
+class slowHandler(SimpleHTTPRequestHandler):
+    '''
+    Serve files of a directory, waiting "delay" seconds before each
+    response to simulate the round trip to the LCSQA server.
+    '''
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+def serve(directory, delay=0):
+    '''
+    Start a local HTTP server serving "directory" in a background thread
+    and return it along with its url.
+    '''
+    handler = type("handler", (slowHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:"+str(server.server_port)+"/"
+
+def benchmark_download(n_days=180, workers=crud.DOWNLOAD_WORKERS, delay=0.05):
+    '''
+    Compare the time needed to get the files of the last "n_days" days
+    one after the other with the time needed by "fetch_days", without
+    and then with the local cache.
+    '''
+    dates = [date.today()-timedelta(days=n) for n in range(n_days,0,-1)]
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixtures(os.path.join(directory, "files"), dates)
+        server, url = serve(os.path.join(directory, "files"), delay)
+        url_backup, cache_backup = crud.LCSQA_URL, crud.CACHE_DIRECTORY
+        crud.LCSQA_URL = url
+        crud.CACHE_DIRECTORY = os.path.join(directory, "cache")
+        try:
+            # Download the files one after the other, as was done before.
+            start = time.perf_counter()
+            for DATE in dates:
+                crud.urlopen(crud.day_url(DATE)).read()
+            serial = time.perf_counter()-start
+            # Download the files concurrently, filling the cache.
+            start = time.perf_counter()
+            for _ in crud.fetch_days(dates, workers):
+                pass
+            concurrent = time.perf_counter()-start
+            # Read the files again, the cache being filled.
+            start = time.perf_counter()
+            for _ in crud.fetch_days(dates, workers):
+                pass
+            cached = time.perf_counter()-start
+        finally:
+            crud.LCSQA_URL, crud.CACHE_DIRECTORY = url_backup, cache_backup
+            server.shutdown()
+    print("Files of "+str(n_days)+" days ("+str(delay*1000)+" ms per request):")
+    print("    serial loop       : "+format(serial, ".2f")+" s")
+    print("    "+str(workers)+" workers         : "+format(concurrent, ".2f")+" s"+
+          " (x"+format(serial/concurrent, ".1f")+")")
+    print("    cached past days  : "+format(cached, ".2f")+" s")
+    return {"serial": serial, "concurrent": concurrent, "cached": cached}
+
+def benchmark_writers(
+    mongo_url,
+    n_days=30,
+    n_stations=200,
+    settings=((1,10000), (2,10000), (4,10000), (4,2000), (8,2000))):
+    '''
+    Measure the number of rows stored per second by "store_pollution_data"
+    for each (number of writer threads, batch size) setting of its
+    "bulkWriter", and by the previous loop inserting each day before
+    parsing the next one, against the MongoDB server at "mongo_url".
+    '''
+    client = connect(mongo_url)
+    database_backup = crud.database
+    url_backup, cache_backup = crud.LCSQA_URL, crud.CACHE_DIRECTORY
+    settings_backup = crud.WRITER_WORKERS, crud.INSERT_BATCH_SIZE
+    crud.database = client["air_quality_benchmark"]
+    dates = [date.today()-timedelta(days=n) for n in range(n_days,0,-1)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixtures(os.path.join(directory, "files"), dates, n_stations=n_stations)
+        server, crud.LCSQA_URL = serve(os.path.join(directory, "files"))
+        crud.CACHE_DIRECTORY = os.path.join(directory, "cache")
+        try:
+            client.drop_database("air_quality_benchmark")
+            # Fill the cache first, so that all the runs read the same files.
+            for _ in crud.fetch_days(dates):
+                pass
+            for setting in [None]+list(settings):
+                crud.database.drop_collection("new_data")
+                crud.database["new_data"].create_index(crud.STAGING_INDEX)
+                crud.clear_manifest("new_data")
+                start = time.perf_counter()
+                if setting is None:
+                    for DATE, content in crud.fetch_days(dates):
+                        crud.store_day(DATE, content, "new_data")
+                else:
+                    crud.WRITER_WORKERS, crud.INSERT_BATCH_SIZE = setting
+                    crud.store_pollution_data(n_days, "new_data")
+                elapsed = time.perf_counter()-start
+                rows = crud.database["new_data"].count_documents({})
+                results[setting or "serial"] = rows/elapsed
+        finally:
+            client.drop_database("air_quality_benchmark")
+            crud.database = database_backup
+            crud.LCSQA_URL, crud.CACHE_DIRECTORY = url_backup, cache_backup
+            crud.WRITER_WORKERS, crud.INSERT_BATCH_SIZE = settings_backup
+            server.shutdown()
+    print("Ingestion of "+str(n_days)+" days of "+str(n_stations)+" stations:")
+    for setting, rows_per_second in results.items():
+        name = "serial loop" if setting == "serial" else \
+        str(setting[0])+" writers, batches of "+str(setting[1])
+        print("    "+name.ljust(29)+": "+format(rows_per_second, ".0f")+" rows/s")
+    return results
+
+class bytesCounter(monitoring.CommandListener):
+    '''
+    Count the commands sent to MongoDB and the bytes of their replies.
+    '''
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+
+    def started(self, event):
+        self.commands += 1
+
+    def succeeded(self, event):
+        self.bytes += len(encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+def store_synthetic_history(
+    n_stations, pollutants=POLLUTANTS[:6], n_days=180, seed=0, days_ago=0,
+    encoded=True):
+    '''
+    Fill the "LCSQA_data" collection with random histories covering
+    "n_days" days and ending "days_ago" days before yesterday, in the
+    layout built by "create_database" (or as lists of values and dates
+    when "encoded" is False).
+    '''
+    generator = random.Random(seed)
+    DATE = date.today()-timedelta(days=days_ago)
+    end = datetime(DATE.year, DATE.month, DATE.day)
+    documents = []
+    for i in range(n_stations):
+        for pollutant in pollutants:
+            for hour in range(24):
+                dates = [
+                    end-timedelta(days=n)+timedelta(hours=hour)
+                    for n in range(n_days,0,-1) if generator.random() < 0.9]
+                documents.append(
+                    {"_id": {"station": "FR"+str(10000+i),
+                             "pollutant": pollutant,
+                             "hour": hour},
+                     "history": {"values": [generator.uniform(0,60) for _ in dates],
+                                 "dates": dates}})
+    crud.database["LCSQA_data"].insert_many(documents)
+    if encoded:
+        crud.encode_histories(end)
+
+def publish_synthetic_history(days_ago=0):
+    '''
+    Store the date of the last update of a history built by
+    "store_synthetic_history", so that it is read by "get_values".
+    '''
+    DATE = date.today()-timedelta(days=days_ago+1)
+    crud.database["last_update"].insert_one(
+        {"date": datetime(DATE.year, DATE.month, DATE.day)})
+    crud.known_update["date"] = None
+
+def store_synthetic_readings():
+    '''
+    Fill the time-series collection "readings" with the values of the
+    histories of "LCSQA_data" (see function "store_synthetic_history").
+    '''
+    crud.create_readings()
+    batch = []
+    for document in crud.database["LCSQA_data"].find({}, {"history": 1}):
+        meta = {"station": document["_id"]["station"],
+                "pollutant": document["_id"]["pollutant"]}
+        values, days = crud.decode_history(document["history"])
+        for value, day in zip(values.tolist(), days.tolist()):
+            DATE = datetime.fromordinal(day)+timedelta(hours=document["_id"]["hour"])
+            batch.append({"meta": meta, "dateTime": DATE, "value": value})
+            if len(batch) == crud.INSERT_BATCH_SIZE:
+                crud.database[crud.READINGS].insert_many(batch)
+                batch = []
+    if batch:
+        crud.database[crud.READINGS].insert_many(batch)
+
+def client_side_values(station, pollutant, n_days):
+    '''
+    Compute the same averages as "get_values" by retrieving the whole
+    histories and averaging them on the client side, as was done before.
+    '''
+    first_day = date.today().toordinal()-n_days
+    averages = [float(0)]*24
+    for document in crud.database["LCSQA_data"].find(
+        {"_id.station": station, "_id.pollutant": pollutant}):
+        values, days = crud.decode_history(document["history"])
+        values = values[days >= first_day]
+        if len(values):
+            averages[document["_id"]["hour"]] = float(values.mean())
+    return averages
+
+def server_side_values(station, pollutant, n_days):
+    '''
+    Compute the same averages as "get_values" with the aggregation of the
+    "timeseries" layout, MongoDB sending only the 24 averages (see function
+    "profiles_pipeline" of "crud.py").
+    '''
+    end = crud.get_last_update()+timedelta(days=1)
+    return crud.complete_profiles(
+        [(station, pollutant)],
+        crud.as_profiles(crud.database[crud.READINGS].aggregate(
+            crud.profiles_pipeline([station], [pollutant], n_days, end)))
+    )[(station, pollutant)]
+
+def benchmark_query(mongo_url, n_stations=50, repeat=200):
+    '''
+    Compare latency and bytes received per query of the client-side loop,
+    of "get_values" (ring buffers) and of the server-side averages of the
+    readings (function "server_side_values"), against the MongoDB server
+    at "mongo_url" (version 7.0 or later).
+    '''
+    listener = bytesCounter()
+    client = MongoClient(mongo_url, event_listeners=[listener])
+    database_backup = crud.database
+    crud.database = client["air_quality_benchmark"]
+    results = {}
+    try:
+        client.drop_database("air_quality_benchmark")
+        store_synthetic_history(n_stations)
+        store_synthetic_readings()
+        publish_synthetic_history()
+        for name, function in [
+            ("client-side loop", client_side_values),
+            ("ring buffers", crud.get_values),
+            ("server-side $avg", server_side_values)]:
+            for n_days in [7, 180]:
+                listener.bytes = listener.commands = 0
+                start = time.perf_counter()
+                for i in range(repeat):
+                    function("FR"+str(10000+i%n_stations), "O3", n_days)
+                elapsed = time.perf_counter()-start
+                results[(name, n_days)] = {
+                    "latency_ms": 1000*elapsed/repeat,
+                    "bytes": listener.bytes/repeat}
+    finally:
+        client.drop_database("air_quality_benchmark")
+        crud.database = database_backup
+    print("Query of 24 averages ("+str(repeat)+" queries each):")
+    for (name, n_days), result in results.items():
+        print("    "+name.ljust(17)+" n="+str(n_days).ljust(4)+": "+
+              format(result["latency_ms"], ".2f")+" ms, "+
+              format(result["bytes"]/1000, ".1f")+" kB received")
+    return results
+
+def benchmark_startup(repeat=5):
+    '''
+    Measure the time needed by a new Python process to import the API
+    ("main.py") until the application is ready to be served.
+    '''
+    # Build the snapshot of the stations first, as done once when the
+    # Docker image is built.
+    crud.load_stations()
+    package = os.path.dirname(os.path.abspath(__file__))
+    command = [
+        sys.executable,
+        "-c",
+        "import "+os.path.basename(package)+".main"]
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=os.path.dirname(package), check=True)
+        durations.append(time.perf_counter()-start)
+    print("Start of a process importing the API ("+str(repeat)+" runs):")
+    print("    first : "+format(durations[0], ".2f")+" s")
+    print("    best  : "+format(min(durations), ".2f")+" s")
+    print("    mean  : "+format(mean(durations), ".2f")+" s")
+    return durations
+
+def benchmark_load(url, station, pollutant, duration=10, clients=(1,16,64)):
+    '''
+    Send requests to the API running at "url" from several concurrent
+    clients (each one keeping its connection open) during "duration"
+    seconds and report the number of requests served per second.
+
+    The server should be started with RESPONSE_CACHE_SIZE=0, otherwise
+    most of the responses come from its cache.
+    '''
+    address = urlsplit(url)
+    def send_requests(i, stop, counts):
+        connection = http.client.HTTPConnection(address.hostname, address.port)
+        n = 0
+        while time.perf_counter() < stop:
+            # Vary the number of days so that queries are not all the same.
+            query = urlencode({"s": station, "p": pollutant, "n": 1+(i+n)%180})
+            connection.request("GET", "/?"+query)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError("Unexpected response: "+str(response.status))
+            n += 1
+        connection.close()
+        counts[i] = n
+    results = {}
+    print("Requests to "+url+" ("+str(duration)+" s per run):")
+    for n_clients in clients:
+        counts = [0]*n_clients
+        stop = time.perf_counter()+duration
+        threads = [
+            threading.Thread(target=send_requests, args=(i, stop, counts))
+            for i in range(n_clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[n_clients] = sum(counts)/duration
+        print("    "+str(n_clients).rjust(2)+" clients : "+
+              format(results[n_clients], ".0f")+" requests/s")
+    return results
+
+# Function used by the previous version of "update_database" to append the
+# new values to each history (called by MongoDB for every document).
+appendValues = Code('''
+function (history, new_data){
+  if (new_data.length){
+    history.values = history.values.concat(new_data[0].values);
+    history.dates = history.dates.concat(new_data[0].dates);
+  }
+  history.values = history.values.slice(-180);
+  history.dates = history.dates.slice(-180);
+  return history;
+}
+''')
+
+def previous_rollover():
+    '''
+    Add the data of the "new_data" collection to the histories the way
+    the previous version of "update_database" did, rewriting the whole
+    "LCSQA_data" collection with "$out".
+    '''
+    crud.database["new_data"].aggregate([
+        {"$sort": {"dateTime": 1}},
+        {"$group":
+            {"_id": {"station": "$code site",
+                     "pollutant": "$Polluant",
+                     "hour": "$hour"},
+             "values": {"$push": "$valeur brute"},
+             "dates": {"$push": "$dateTime"}}},
+        {"$out": "new_groups"}])
+    crud.database["LCSQA_data"].aggregate([
+        {"$lookup":
+            {"from": "new_groups",
+             "localField": "_id",
+             "foreignField": "_id",
+             "as": "new_data"}},
+        {"$set":
+            {"history":
+                {"$function":
+                    {"body": appendValues,
+                     "args": ["$history", "$new_data"],
+                     "lang": "js"}}}},
+        {"$unset": "new_data"},
+        {"$out": "LCSQA_data"}])
+    crud.database.drop_collection("new_groups")
+
+def benchmark_update(mongo_url, n_stations=200):
+    '''
+    Compare the daily update of "update_database" (bulk writes touching
+    only the documents with new data) with the previous pipeline rewriting
+    the whole collection, on a synthetic 180-day history, against the
+    MongoDB server at "mongo_url".
+    '''
+    client = MongoClient(mongo_url)
+    database_backup = crud.database
+    url_backup, cache_backup = crud.LCSQA_URL, crud.CACHE_DIRECTORY
+    crud.database = client["air_quality_benchmark"]
+    DATE = date.today()-timedelta(days=1)
+    with tempfile.TemporaryDirectory() as directory:
+        # Serve the file of yesterday, for half of the stations.
+        write_fixtures(
+            os.path.join(directory, "files"), [DATE], n_stations=n_stations//2)
+        server, crud.LCSQA_URL = serve(os.path.join(directory, "files"))
+        crud.CACHE_DIRECTORY = os.path.join(directory, "cache")
+        try:
+            client.drop_database("air_quality_benchmark")
+            store_synthetic_history(n_stations, days_ago=1)
+            crud.database["last_update"].insert_one(
+                {"date": datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=1)})
+            size = crud.database.command("collStats", "LCSQA_data")["size"]
+            documents = crud.database["LCSQA_data"].estimated_document_count()
+            report = crud.update_database()
+            # Same update with the previous pipeline.
+            client.drop_database("air_quality_benchmark")
+            store_synthetic_history(n_stations, days_ago=1, encoded=False)
+            crud.store_pollution_data(1, "new_data")
+            start = time.perf_counter()
+            previous_rollover()
+            previous_duration = time.perf_counter()-start
+            previous_size = crud.database.command("collStats", "LCSQA_data")["size"]
+        finally:
+            client.drop_database("air_quality_benchmark")
+            crud.database = database_backup
+            crud.LCSQA_URL, crud.CACHE_DIRECTORY = url_backup, cache_backup
+            server.shutdown()
+    print("Daily update of "+str(documents)+" documents ("+
+          format(size/1e6, ".1f")+" MB):")
+    print("    bulk writes     : "+str(report["documents"])+" documents, "+
+          format(report["bytes"]/1e6, ".2f")+" MB sent, "+
+          format(report["seconds"], ".2f")+" s (download included)")
+    print("    previous $out   : "+str(documents)+" documents, "+
+          format(previous_size/1e6, ".2f")+" MB rewritten, "+
+          format(previous_duration, ".2f")+" s")
+    return {"bulk_writes": report, "previous": {
+        "documents": documents,
+        "bytes": previous_size,
+        "seconds": previous_duration}}
+
+def hot_queries(station, pollutant):
+    '''
+    Return the (collection, filter) pairs of the queries issued by the API
+    (see "crud.py" and "async_crud.py") and by the client (see function
+    "get_items" of "daily_pollution.py"), for the given station and
+    pollutant and the current layout of the hourly data (see
+    "STORAGE_MODE" in "crud.py").
+    '''
+    document = crud.database["cities"].find_one({"stations.code": station}) or {}
+    city = document.get("_id")
+    document = crud.database["departments"].find_one({"cities": city}) or {}
+    department = document.get("_id")
+    document = crud.database["regions"].find_one({"departments": department}) or {}
+    region = document.get("_id")
+    if crud.TIMESERIES:
+        # Filters of the readings of a period (the first stage of the
+        # pipeline of "profiles_pipeline" and the query of
+        # "statistics_query").
+        DATE = date.today()
+        end = datetime(DATE.year, DATE.month, DATE.day)
+        pipeline = crud.profiles_pipeline([station], [pollutant], 180, end)
+        _, query, _ = crud.statistics_query(station, pollutant, 180, end)
+        hourly_queries = [
+            (crud.READINGS, pipeline[0]["$match"]),
+            (crud.READINGS, query)]
+    else:
+        hourly_queries = [
+            ("LCSQA_data", {"_id.station": station, "_id.pollutant": pollutant}),
+            ("LCSQA_data", {"_id.station": {"$in": [station]},
+                            "_id.pollutant": {"$in": [pollutant]}}),
+            ("LCSQA_data", {"_id": {"$in": [
+                {"station": station, "pollutant": pollutant, "hour": 0}]}})]
+    return hourly_queries+[
+        ("distribution_pollutants", {"_id": station}),
+        ("regions", {"_id": region}),
+        ("departments", {"_id": department}),
+        ("departments", {"_id": {"$in": [department]}}),
+        ("cities", {"_id": city}),
+        ("cities", {"_id": {"$in": [city]}})]
+
+def plan_stages(plan):
+    '''
+    Return the names of the stages of the query plan "plan" (given by the
+    "explain" command) and of all its input stages.
+    '''
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+def explain_queries(mongo_url, station=None, pollutant=None):
+    '''
+    Print the stages of the winning plan of each query of "hot_queries"
+    on the "air_quality" database of the MongoDB server at "mongo_url", and
+    return the list of the queries scanning a whole collection. The station
+    and pollutant default to the first ones of "distribution_pollutants".
+    '''
+    database = MongoClient(mongo_url)["air_quality"]
+    database_backup, crud.database = crud.database, database
+    try:
+        if station is None or pollutant is None:
+            document = database["distribution_pollutants"].find_one() or \
+            {"_id": "", "monitored_pollutants": [""]}
+            station = document["_id"]
+            pollutant = document["monitored_pollutants"][0]
+        scans = []
+        for name, query in hot_queries(station, pollutant):
+            plan = database[name].find(query).explain()
+            # Queries of time-series collections are run as aggregations,
+            # whose first stage gives the plan.
+            if "queryPlanner" not in plan:
+                plan = plan["stages"][0]["$cursor"]
+            stages = plan_stages(plan["queryPlanner"]["winningPlan"])
+            print(name+" "+repr(query)+": "+" <- ".join(stages))
+            if "COLLSCAN" in stages:
+                scans.append((name, query))
+    finally:
+        crud.database = database_backup
+    print(str(len(scans))+" queries scanning a whole collection")
+    return scans
+
+def benchmark_storage(mongo_url, n_stations=50, repeat=200):
+    '''
+    Compare the size on disk and the latency of "get_values" of the
+    "arrays" layout ("LCSQA_data") and of the "timeseries" layout
+    ("readings", see function "create_readings") holding the same
+    synthetic 180-day history, against the MongoDB server at "mongo_url".
+    '''
+    client = MongoClient(mongo_url)
+    database_backup = crud.database
+    layout_backup = crud.TIMESERIES, crud.INDEXES
+    crud.database = client["air_quality_benchmark"]
+    results = {}
+    try:
+        client.drop_database("air_quality_benchmark")
+        store_synthetic_history(n_stations)
+        publish_synthetic_history()
+        store_synthetic_readings()
+        for name, timeseries, collection, indexes in [
+            ("arrays", False, "LCSQA_data",
+             {"LCSQA_data": [[("_id.station", 1), ("_id.pollutant", 1)]]}),
+            ("timeseries", True, crud.READINGS,
+             {crud.READINGS: [[("meta.station", 1),
+                               ("meta.pollutant", 1),
+                               ("dateTime", 1)]]})]:
+            crud.TIMESERIES, crud.INDEXES = timeseries, indexes
+            crud.create_indexes()
+            stats = crud.database.command("collStats", collection)
+            results[name] = {
+                "storage_bytes": stats["storageSize"],
+                "index_bytes": stats["totalIndexSize"]}
+            for n_days in [7, 180]:
+                start = time.perf_counter()
+                for i in range(repeat):
+                    values = crud.get_values(
+                        "FR"+str(10000+i%n_stations), "O3", n_days)
+                results[name]["latency_ms_"+str(n_days)] = \
+                1000*(time.perf_counter()-start)/repeat
+                results[name]["values_"+str(n_days)] = values
+    finally:
+        client.drop_database("air_quality_benchmark")
+        crud.database = database_backup
+        crud.TIMESERIES, crud.INDEXES = layout_backup
+    print("Storage of a 180-day history of "+str(n_stations)+" stations:")
+    for name, result in results.items():
+        print("    "+name.ljust(11)+": "+
+              format(result["storage_bytes"]/1e6, ".1f")+" MB + "+
+              format(result["index_bytes"]/1e6, ".1f")+" MB of indexes, "+
+              format(result["latency_ms_7"], ".2f")+" ms (n=7), "+
+              format(result["latency_ms_180"], ".2f")+" ms (n=180)")
+    # Both layouts must give the same averages.
+    difference = max(
+        abs(x-y) for n_days in [7, 180] for x, y in zip(
+            results["arrays"]["values_"+str(n_days)],
+            results["timeseries"]["values_"+str(n_days)]))
+    print("    largest difference between the averages: "+format(difference, ".2g"))
+    return results
+
+def benchmark_encoding(n_documents=1000, seed=0, repeat=5, n_days=7):
+    '''
+    Compare the size of the documents of "LCSQA_data" and the time needed
+    to decode them and select the values of the "n_days" last days, when
+    their histories are stored as lists of values and dates (previous
+    layout, the window being found by scanning the dates) and as ring
+    buffers (see function "encode_history" of "crud.py"), whose sum is also
+    read from the cumulative sums ("sums", see function "history_sum").
+    '''
+    import numpy
+    generator = random.Random(seed)
+    DATE = date.today()
+    end = datetime(DATE.year, DATE.month, DATE.day)
+    documents = {"lists": [], "ring": []}
+    for i in range(n_documents):
+        dates = [
+            end-timedelta(days=n)+timedelta(hours=i%24)
+            for n in range(180,0,-1) if generator.random() < 0.9]
+        values = [generator.uniform(0,60) for _ in dates]
+        days = numpy.array([x.toordinal() for x in dates])
+        documents["lists"].append(encode(
+            {"_id": {"station": "FR"+str(10000+i//24), "pollutant": "O3", "hour": i%24},
+             "history": {"values": values, "dates": dates}}))
+        documents["ring"].append(encode(
+            {"_id": {"station": "FR"+str(10000+i//24), "pollutant": "O3", "hour": i%24},
+             "history": crud.encode_history(values, days, end)}))
+    first_day = end-timedelta(days=n_days)
+    def decode_lists(data):
+        history = decode(data)["history"]
+        return numpy.array([
+            value for value, DATE in zip(history["values"], history["dates"])
+            if DATE >= first_day])
+    def decode_ring(data):
+        return crud.history_window(decode(data)["history"], n_days, end)
+    def decode_sums(data):
+        return crud.history_sum(decode(data)["history"], n_days, end)
+    documents["sums"] = documents["ring"]
+    results = {}
+    for name, function in [
+        ("lists", decode_lists), ("ring", decode_ring), ("sums", decode_sums)]:
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for data in documents[name]:
+                function(data)
+            durations.append(time.perf_counter()-start)
+        results[name] = {
+            "bytes": mean(len(x) for x in documents[name]),
+            "decode_us": 1e6*min(durations)/n_documents}
+    print("Documents of a 180-day history ("+str(n_documents)+" documents):")
+    for name, result in results.items():
+        print("    "+name.ljust(6)+": "+
+              format(result["bytes"], ".0f")+" bytes, "+
+              format(result["decode_us"], ".1f")+" us to decode and select "+
+              str(n_days)+" days")
+    return results
+
+def connect(mongo_url):
+    '''
+    Return a client of the MongoDB server at "mongo_url", or of the
+    in-process stand-in of the "mongomock" package if "mongo_url" is
+    "mongomock://".
+    '''
+    if mongo_url.startswith("mongomock://"):
+        import mongomock
+        return mongomock.MongoClient()
+    return MongoClient(mongo_url)
+
+def percentiles(durations):
+    '''
+    Return the median, 90th and 99th percentiles of the given durations
+    (in seconds), in milliseconds.
+    '''
+    # "quantiles" needs at least two values.
+    q = quantiles(durations*2 if len(durations) < 2 else durations, n=100)
+    return {"p50": 1000*q[49], "p90": 1000*q[89], "p99": 1000*q[98]}
+
+def measure(function, *args):
+    '''
+    Call "function" with the given arguments and return its duration in
+    seconds along with its result, or None and the reason why it has been
+    skipped if it uses an operator not implemented by the stand-in of
+    MongoDB (see function "connect").
+    '''
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    except NotImplementedError as error:
+        return None, str(error)
+    return time.perf_counter()-start, result
+
+def run_suite(
+    mongo_url, n_stations=20, n_pollutants=6, n_days=180, n_queries=500, seed=0):
+    '''
+    Build the database from synthetic daily files of "n_stations" stations
+    monitoring "n_pollutants" pollutants over "n_days" days, update it with
+    one more day and query it, and return the throughput and latencies of
+    each stage.
+    '''
+    pollutants = POLLUTANTS[:n_pollutants]
+    # The days of the creation, followed by the day added by the update.
+    dates = [date.today()-timedelta(days=n) for n in range(n_days+1,0,-1)]
+    client = connect(mongo_url)
+    database_backup = crud.database
+    url_backup, cache_backup = crud.LCSQA_URL, crud.CACHE_DIRECTORY
+    crud.database = client["air_quality_benchmark"]
+    results = {
+        "parameters": {
+            "mongo": mongo_url.split("@")[-1],
+            "storage": crud.STORAGE_MODE,
+            "stations": n_stations,
+            "pollutants": n_pollutants,
+            "days": n_days,
+            "queries": n_queries,
+            "seed": seed,
+            "writers": crud.WRITER_WORKERS,
+            "batch_size": crud.INSERT_BATCH_SIZE,
+            "python": platform.python_version()}}
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixtures(
+            os.path.join(directory, "files"),
+            dates,
+            n_stations=n_stations,
+            pollutants=pollutants,
+            seed=seed)
+        server, crud.LCSQA_URL = serve(os.path.join(directory, "files"))
+        crud.CACHE_DIRECTORY = os.path.join(directory, "cache")
+        try:
+            client.drop_database("air_quality_benchmark")
+            # Ingestion of the days (see function "store_pollution_data").
+            name = crud.staging_collection(True)
+            if crud.TIMESERIES:
+                crud.create_readings()
+            else:
+                crud.database[name].create_index(crud.STAGING_INDEX)
+            durations, rows = [], 0
+            start = time.perf_counter()
+            writer = crud.bulkWriter()
+            try:
+                for DATE, content in crud.fetch_days(dates[:-1]):
+                    day_start = time.perf_counter()
+                    rows += crud.store_day(DATE, content, name, writer)
+                    durations.append(time.perf_counter()-day_start)
+                writer.join()
+            finally:
+                writer.close()
+            elapsed = time.perf_counter()-start
+            results["ingestion"] = {
+                "rows": rows,
+                "seconds": elapsed,
+                "rows_per_second": rows/elapsed,
+                "day_latency_ms": percentiles(durations)}
+            # Aggregations of "create_database".
+            elapsed, result = measure(crud.finish_creation, dates[:-1])
+            results["creation"] = {"skipped": result} if elapsed is None else {
+                "seconds": elapsed,
+                "rows_per_second": rows/elapsed}
+            # Addition of the last day.
+            elapsed, result = measure(crud.update_database)
+            results["update"] = {"skipped": result} if elapsed is None else {
+                "seconds": elapsed,
+                "documents": result["documents"],
+                "bytes": result["bytes"]}
+            # Queries of random stations and pollutants.
+            generator = random.Random(seed)
+            monitored = [x for x in pollutants if x not in crud.IGNORED_POLLUTANTS]
+            results["query"] = {}
+            for n in sorted({7, n_days}):
+                durations = []
+                for _ in range(n_queries):
+                    station = "FR"+str(10000+generator.randrange(n_stations))
+                    pollutant = generator.choice(monitored)
+                    elapsed, result = measure(crud.get_values, station, pollutant, n)
+                    if elapsed is None:
+                        break
+                    durations.append(elapsed)
+                results["query"]["n"+str(n)] = {"skipped": result} \
+                if elapsed is None else {
+                    "queries_per_second": len(durations)/sum(durations),
+                    "latency_ms": percentiles(durations)}
+        finally:
+            client.drop_database("air_quality_benchmark")
+            crud.database = database_backup
+            crud.LCSQA_URL, crud.CACHE_DIRECTORY = url_backup, cache_backup
+            server.shutdown()
+    return results
+
+def compare_results(results, baseline, tolerance=0.2):
+    '''
+    Return the list of the measures of "results" worse than those of
+    "baseline" by more than "tolerance" (a fraction): lower throughputs and
+    higher 90th percentiles of latency.
+    '''
+    regressions = []
+    def walk(new, old, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict):
+                walk(value, old[key], path+[key])
+            elif key.endswith("per_second") and value < old[key]*(1-tolerance):
+                regressions.append(".".join(path+[key]))
+            elif key == "p90" and value > old[key]*(1+tolerance):
+                regressions.append(".".join(path+[key]))
+    walk(results, baseline, [])
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark",
+        choices=[
+            "download","query","startup","load","update","writers","storage",
+            "encoding","explain","suite"])
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--workers", type=int, default=crud.DOWNLOAD_WORKERS)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--mongo", default="mongodb://localhost:27017")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--station", default="FR01011")
+    parser.add_argument("--pollutant", default="O3")
+    parser.add_argument("--stations", type=int, default=20)
+    parser.add_argument("--pollutants", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    arguments = parser.parse_args()
+    if arguments.benchmark == "download":
+        benchmark_download(arguments.days, arguments.workers, arguments.delay)
+    elif arguments.benchmark == "query":
+        benchmark_query(arguments.mongo)
+    elif arguments.benchmark == "startup":
+        benchmark_startup()
+    elif arguments.benchmark == "load":
+        benchmark_load(arguments.url, arguments.station, arguments.pollutant)
+    elif arguments.benchmark == "update":
+        benchmark_update(arguments.mongo)
+    elif arguments.benchmark == "writers":
+        benchmark_writers(arguments.mongo, arguments.days, arguments.stations)
+    elif arguments.benchmark == "storage":
+        benchmark_storage(arguments.mongo)
+    elif arguments.benchmark == "encoding":
+        benchmark_encoding()
+    elif arguments.benchmark == "explain":
+        if explain_queries(arguments.mongo):
+            sys.exit(1)
+    elif arguments.benchmark == "suite":
+        results = run_suite(
+            arguments.mongo,
+            arguments.stations,
+            arguments.pollutants,
+            arguments.days,
+            arguments.queries,
+            arguments.seed)
+        output = json.dumps(results, indent=2)
+        if arguments.output:
+            with open(arguments.output, "w") as f:
+                f.write(output)
+        print(output)
+        if arguments.baseline:
+            with open(arguments.baseline) as f:
+                regressions = compare_results(
+                    results, json.load(f), arguments.tolerance)
+            for path in regressions:
+                print("Regression: "+path, file=sys.stderr)
+            if regressions:
+                sys.exit(1)
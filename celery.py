@@ -1,7 +1,150 @@
-from celery import Celery
+'''
+Celery application keeping the database up to date. The pollution days to
+collect are downloaded, parsed and stored by separate tasks (one per day,
+each retried on its own when the LCSQA server fails) run in parallel by
+the workers, and a last task merges them into "LCSQA_data" once they are
+all stored, so that creating the database scales with the number of
+workers. The days already stored by a previous attempt (as recorded in the
+"manifest" collection) are not stored again.
+
+Run the workers (and the nightly schedule) with:
+    celery -A webApplication.celery worker --beat
+
+The metrics of the tasks (see "metrics.py") are pushed to the Prometheus
+Pushgateway given by "PUSHGATEWAY_URL" after each task.
+
+Setting the environment variable "CELERY_ALWAYS_EAGER" to 1 runs the tasks
+in the calling process instead (with "CELERY_BROKER_URL" set to "memory://"
+and "CELERY_RESULT_BACKEND" to "cache+memory://", no server is needed).
+'''
+import os
+import uuid
+from datetime import date
+
+from celery import Celery, chord
 from celery.schedules import crontab
-import crud
+from celery.signals import task_postrun
+
+from . import crud, metrics
+
+BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://redis:6379/0")
+# The results of the tasks of the days must be stored to trigger the merge.
+RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://redis:6379/1")
+# Maximum number of attempts to store a day after the first one.
+MAX_RETRIES = 5
+# Maximum number of seconds between two attempts to store a day.
+MAX_BACKOFF = 600
+
+app = Celery("webApplication", broker=BROKER_URL, backend=RESULT_BACKEND)
+app.conf.update(
+    timezone="Europe/Paris",
+    enable_utc=True,
+    task_always_eager=os.environ.get("CELERY_ALWAYS_EAGER") == "1",
+    task_eager_propagates=True,
+    # Give the days one by one to the workers, since each takes seconds.
+    worker_prefetch_multiplier=1,
+    task_acks_late=True)
+app.conf.beat_schedule = {
+    "updates": {
+        "task": "webApplication.celery.refresh_database",
+        "schedule": crontab(hour=1, minute=0)}}
+
+@task_postrun.connect
+def push_metrics(**kwargs):
+    '''
+    Send the metrics of the worker once a task is done.
+    '''
+    try:
+        metrics.push()
+    except OSError:
+        # Missing metrics must not make the task fail.
+        pass
+
+@app.task(
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    retry_backoff_max=MAX_BACKOFF,
+    retry_jitter=True,
+    max_retries=MAX_RETRIES)
+def store_day(day, name):
+    '''
+    Download the "csv" file of the pollution day "day" (in ISO format) and
+    store its data into the collection "name" (see function "store_day" of
+    "crud.py"). Return the number of documents inserted.
+    '''
+    DATE = date.fromisoformat(day)
+    # The days are written into the memory-mapped copy by the final task,
+    # since the tasks run in parallel and in any order.
+    return crud.store_day(DATE, crud.fetch_day(DATE), name, write_cube=False)
+
+@app.task
+def finish_creation(counts, days, owner):
+    '''
+    Build the histories of "LCSQA_data" once all the days are stored (see
+    function "finish_creation" of "crud.py"), write the days into the
+    memory-mapped copy if there is one (see function "fill_cube" of
+    "crud.py") and release the lock taken by "refresh_database". Return the
+    number of documents inserted.
+    '''
+    try:
+        days = [date.fromisoformat(x) for x in days]
+        crud.finish_creation(days)
+        crud.fill_cube(days)
+    finally:
+        crud.release_lock("refresh", owner)
+    return sum(counts)
+
+@app.task
+def finish_update(counts, days, owner):
+    '''
+    Add the stored days to the histories of "LCSQA_data" (see function
+    "finish_update" of "crud.py"), write them into the memory-mapped copy
+    if there is one (see function "fill_cube" of "crud.py") and release the
+    lock taken by "refresh_database". Return the report of the update.
+    '''
+    try:
+        days = [date.fromisoformat(x) for x in days]
+        report = crud.finish_update(days)
+        crud.fill_cube(days)
+    finally:
+        crud.release_lock("refresh", owner)
+    report["inserted"] = sum(counts)
+    return report
 
-app = Celery()
-app.conf.update(timezone="Europe/Paris",enable_utc=True)
-app.conf.beat_schedule = {"updates":{"task":"crud.update_database","schedule":crontab(hour=1,minute=0)}}
+@app.task
+def refresh_database():
+    '''
+    Create or update the database if needed, unless it is already being
+    filled by another process, by running one "store_day" task per missing
+    day followed by "finish_creation" or "finish_update". Return the id of
+    the final task, or None if there is nothing to do.
+    '''
+    owner = uuid.uuid4().hex
+    if not(crud.acquire_lock("refresh", owner)):
+        return None
+    try:
+        if "last_update" not in crud.database.list_collection_names():
+            days = crud.prepare_creation()
+            name, callback = crud.staging_collection(True), finish_creation
+        elif crud.history_is_updated():
+            crud.release_lock("refresh", owner)
+            return None
+        else:
+            days = crud.prepare_update()
+            name, callback = crud.staging_collection(False), finish_update
+        # Skip the days already stored by a previous attempt (see function
+        # "pending_days" of "crud.py").
+        pending = [x.isoformat() for x in crud.pending_days(days, name)]
+        days = [x.isoformat() for x in days]
+        # The lock is released by the final task (or expires if one of
+        # the days can not be stored).
+        if pending:
+            result = chord(
+                store_day.si(day, name) for day in pending
+            )(callback.s(days, owner))
+        else:
+            result = callback.delay([], days, owner)
+    except Exception:
+        crud.release_lock("refresh", owner)
+        raise
+    return result.id
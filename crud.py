@@ -1,68 +1,152 @@
+import hashlib
+import os
+import pickle
+import queue
+import tempfile
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-from statistics import mean
+from io import BytesIO
+from urllib.request import urlopen
 
-from bson.code import Code
-from pandas import read_csv, read_excel
-from pymongo import MongoClient
+from bson import Binary, encode
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError
 
+from . import dictionaries
+from . import metrics
 from .dictionaries import french_departments
 
-mongoClient = MongoClient("mongodb://db:27017")
-database = mongoClinet["air_quality"]
-
-stringToDatetime = lambda x: datetime.strptime(x,"%Y/%m/%d %H:%M:%S")
-
-updateList = Code('''
-function (history, data_180_days_ago, data_yesterday){
-  if (!data_180_days_ago && !data_yesterday){
-    return history;
-  } else if (data_180_days_ago && !data_yesterday){
-    return history.slice(1);
-  } else {
-    const new_date = data_yesterday.date
-    const new_value = data_yesterday.value
-    history.dates.push(new_date);
-    history.values.push(new_value);
-    if (data_180_days_ago){
-      history = history.slice(1)
+MONGO_URL = "mongodb://db:27017"
+mongoClient = MongoClient(MONGO_URL, connect=False)
+database = mongoClient["air_quality"]
+
+# Workbook giving location of LCSQA stations, shipped with the application,
+# and binary snapshot of its content (see function "load_stations").
+STATIONS_WORKBOOK = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "Liste points de mesures 2020 pour site LCSQA_221292021.xlsx")
+STATIONS_SNAPSHOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stations.pickle")
+# Location of the daily "csv" files published by the LCSQA (may be replaced
+# by the address of a local server, see "benchmark.py").
+LCSQA_URL = "https://files.data.gouv.fr/lcsqa/concentrations-de"+\
+"-polluants-atmospheriques-reglementes/temps-reel/"
+# Directory keeping the files of past pollution days already downloaded.
+CACHE_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "cache")
+# Maximum number of files downloaded at the same time.
+DOWNLOAD_WORKERS = 8
+# Columns of the daily files used to build the database.
+USED_COLUMNS = ["code site","Polluant","Date de début","valeur brute","validité"]
+# Pollutants whose data are not kept.
+IGNORED_POLLUTANTS = ["NO","NOX as NO2","C6H6"]
+# Maximum number of documents sent to MongoDB in one "insert_many" call.
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", 10000))
+# Number of threads inserting the parsed documents (see class "bulkWriter").
+WRITER_WORKERS = int(os.environ.get("WRITER_WORKERS", 4))
+# Maximum number of batches of documents waiting to be inserted, beyond
+# which parsing the next days is paused.
+WRITER_QUEUE_SIZE = int(os.environ.get("WRITER_QUEUE_SIZE", 8))
+# Layout of the hourly data: "arrays" (one document of "LCSQA_data" per
+# station, pollutant and hour, see function "finish_creation") or
+# "timeseries" (raw readings in the time-series collection "readings",
+# requiring MongoDB 7.0, see function "create_readings"). The averages are
+# computed by MongoDB in the "timeseries" layout (see function
+# "profiles_pipeline"), and by the API from the ring buffers of the
+# "arrays" layout, which MongoDB can not read (MongoDB then sends the
+# binary window of 24 documents instead of 24 averages).
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "arrays")
+TIMESERIES = STORAGE_MODE == "timeseries"
+READINGS = "readings"
+# Number of days after which readings are removed by MongoDB (one more than
+# the 180 days read, the oldest being read during the whole current day).
+READINGS_RETENTION = 181
+# Number of slots of the ring buffers storing the histories of "LCSQA_data"
+# (see function "encode_history"): one more than the 180 days read, so that
+# the oldest day read by the previous version of the database is still
+# there while the documents are being updated.
+HISTORY_DAYS = 181
+# Indexes (lists of (field, direction) pairs) of the collections of the
+# database besides the default one on "_id", created by "create_indexes".
+if TIMESERIES:
+    INDEXES = {
+        # Readings of a station and a pollutant over a period (see
+        # function "profiles_pipeline").
+        READINGS: [[("meta.station", 1), ("meta.pollutant", 1), ("dateTime", 1)]],
+    }
+else:
+    INDEXES = {
+        # Documents of a station and a pollutant (see functions "get_values"
+        # and "get_profiles").
+        "LCSQA_data": [[("_id.station", 1), ("_id.pollutant", 1)]],
     }
-    return history;
-  }
-}
-''')
+# Index of the collections receiving the rows of the downloaded days, used
+# to remove those of a day (see function "store_day").
+STAGING_INDEX = [("dateTime", 1)]
+# Collection recording, for each day stored into a staging collection, the
+# SHA-256 digest of its file, its number of rows and whether it has been
+# completely stored (see function "store_day").
+MANIFEST = "manifest"
+# Directory of the optional memory-mapped copy of the hourly data (see
+# "cube.py"), used instead of "LCSQA_data" to compute the averages.
+CUBE_DIRECTORY = os.environ.get("CUBE_DIRECTORY")
+if CUBE_DIRECTORY:
+    from .cube import hourlyCube
+    cube = hourlyCube(CUBE_DIRECTORY)
+else:
+    cube = None
+# Maximum number of seconds during which the date of the last update read
+# from the database is reused (see function "get_last_update").
+LAST_UPDATE_TTL = 60
+known_update = {"date": None, "time": float(0)}
 
-def store_locations():
+class databaseNotReady(Exception):
     '''
-    Create mongoDB collection "LCSQA_stations storing informations
-    regarding location in France of all the stations owned by the
-    Central Laboratory of Air Quality Monitoring (LCSQA).
+    Raised when the database is read while it is still being created (no
+    update has been published yet).
+    '''
+# Number of seconds after which the lock taken to fill the database (see
+# function "refresh_database") is released if its owner has not done it.
+REFRESH_LEASE = 3600
+# Pollutants monitored by each station (see function "load_catalogue").
+catalogue = {"version": None, "pollutants": {}}
+
+def get_department(city_code):
+    '''
+    Return the name of the French department of the city whose code (five
+    characters, such as "57463" or "2A004") is "city_code". Raise KeyError
+    for an unknown department.
     '''
-    database = mongoClient["air_quality"]
-    url = "https://www.lcsqa.org/system/files/media/documents/"+\
-    "Liste points de mesures 2021 pour site LCSQA_27072022.xlsx"
-    # Import file from previous url giving location of LCSQA stations.
-    data = read_excel(url.replace(" ", "%20"), sheet_name=1)
-    # Rearrange and clean the data.
-    c = data.columns.tolist()
-    columns_to_remove = c[3:7]+c[10:]
-    labels = data.iloc[1].tolist()
-    labels_to_keep = labels[:3]+labels[7:10]
-    data = data.drop(
-        columns=columns_to_remove
-    ).drop(
-        [0,1]
-    ).set_axis(
-        labels_to_keep,
+    # Overseas departments are given by the first three characters.
+    if city_code.startswith("97"):
+        return french_departments[city_code[:3]]
+    return french_departments[city_code[:2]]
+
+def read_stations_workbook():
+    '''
+    Read the workbook giving location in France of all the stations owned
+    by the Central Laboratory of Air Quality Monitoring (LCSQA) and return
+    one dictionary per station.
+    '''
+    from pandas import read_excel
+    # Import file giving location of LCSQA stations.
+    data = read_excel(STATIONS_WORKBOOK, sheet_name=1)
+    # Rearrange and clean the data (the fourth column of the sheet has no
+    # label, so the columns to keep are given by their position).
+    data = data.iloc[2:, [0,1,2,8,9,10]].set_axis(
+        ["Code station",
+         "Nom station",
+         "Secteur de la station",
+         "Région",
+         "Code commune",
+         "Commune"],
         axis="columns")
-    # Define a function "get_department" to retrieve names of French departments
-    # using postal codes of french cities.
-    get_department = lambda x: (
-        french_departments[x[:2]] if not(x[1].isdigit()) or int(x[:2]) < 97
-        else french_departments[x[:3]]
-    )
     # Add a new column "Département" using "get_department".
-    data["Département"] = data["Code commune"].apply(
+    data["Département"] = data["Code commune"].astype(str).str.zfill(5).apply(
         get_department)
     # Keep only columns with useful informations.
     data = data[
@@ -72,9 +156,229 @@ def store_locations():
         "Nom station",
         "Code station",
         "Secteur de la station"]]
-    # Turn the "data" dataframe into the "LCSQA_stations" collection.
-    database["LCSQA_stations"].insert_many(data.to_dict("records"))
+    return data.to_dict("records")
 
+def load_stations():
+    '''
+    Return the list of the LCSQA stations (see function
+    "read_stations_workbook"), read from a binary snapshot of the
+    workbook which is built the first time.
+    '''
+    # Reading the workbook takes a few seconds, so it is only done when
+    # the snapshot is missing or older than the workbook or than the code
+    # reading it.
+    sources = [STATIONS_WORKBOOK, __file__, dictionaries.__file__]
+    if os.path.exists(STATIONS_SNAPSHOT) and \
+    os.path.getmtime(STATIONS_SNAPSHOT) >= max(map(os.path.getmtime, sources)):
+        with open(STATIONS_SNAPSHOT, "rb") as f:
+            return pickle.load(f)
+    stations = read_stations_workbook()
+    temporary_path = STATIONS_SNAPSHOT+".tmp"+str(os.getpid())
+    with open(temporary_path, "wb") as f:
+        pickle.dump(stations, f)
+    os.replace(temporary_path, STATIONS_SNAPSHOT)
+    return stations
+
+def store_locations():
+    '''
+    Create mongoDB collection "LCSQA_stations storing informations
+    regarding location in France of all the stations owned by the
+    Central Laboratory of Air Quality Monitoring (LCSQA).
+    '''
+    database["LCSQA_stations"].insert_many(load_stations())
+
+
+def day_url(DATE):
+    '''
+    Return the url of the "csv" file giving pollution data recorded
+    by LCSQA stations during the day "DATE".
+    '''
+    return LCSQA_URL+str(DATE.year)+"/FR_E2_"+DATE.isoformat()+".csv"
+
+def read_cache(DATE):
+    '''
+    Return the content of the file of the day "DATE" if it has already
+    been downloaded, None otherwise.
+    '''
+    # The cache stores each file under the SHA-256 digest of its content,
+    # and a small file named after the day gives the digest to look for.
+    try:
+        with open(os.path.join(CACHE_DIRECTORY, DATE.isoformat())) as f:
+            digest = f.read()
+        with open(os.path.join(CACHE_DIRECTORY, "objects", digest), "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    # Ignore a file which has been damaged since it was written.
+    if hashlib.sha256(content).hexdigest() != digest:
+        return None
+    return content
+
+def write_cache(DATE, content):
+    '''
+    Save the content of the file of the day "DATE" in the cache.
+    '''
+    digest = hashlib.sha256(content).hexdigest()
+    object_path = os.path.join(CACHE_DIRECTORY, "objects", digest)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    files = [(os.path.join(CACHE_DIRECTORY, DATE.isoformat()), digest.encode())]
+    # Several days may have the same content (for example files without
+    # any data): their object is only written once.
+    if not(os.path.exists(object_path)):
+        files.insert(0, (object_path, content))
+    # Write the files under a unique temporary name (the days being fetched
+    # by several threads) and then rename them, so that a process stopped
+    # in the middle never leaves an incomplete entry.
+    for path, data in files:
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".tmp")
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+def fetch_day(DATE):
+    '''
+    Return the content of the "csv" file of the day "DATE", reading it
+    from the cache when possible.
+    '''
+    with metrics.timed(metrics.INGESTION_SECONDS, "cache"):
+        content = read_cache(DATE)
+    if content is None:
+        with metrics.timed(metrics.INGESTION_SECONDS, "download"), \
+        urlopen(day_url(DATE)) as response:
+            content = response.read()
+        # The file of a day may still be completed by the LCSQA, so only
+        # the final files are kept.
+        if is_final(DATE):
+            write_cache(DATE, content)
+    return content
+
+def is_final(DATE):
+    '''
+    Return whether the file of the day "DATE" is final: the LCSQA may
+    complete the file of a day until the end of the following day.
+    '''
+    return DATE < date.today()-timedelta(days=1)
+
+def cached_digest(DATE):
+    '''
+    Return the SHA-256 digest of the file of the day "DATE" kept in the
+    cache (without reading the file), or None if it is not there.
+    '''
+    try:
+        with open(os.path.join(CACHE_DIRECTORY, DATE.isoformat())) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def fetch_days(dates, workers=DOWNLOAD_WORKERS):
+    '''
+    Download the "csv" files of the given days using a pool of threads and
+    yield (day, content) pairs in the order of "dates".
+
+    Arguments:
+    dates -- list of the pollution days whose files are wanted.
+    workers -- maximum number of files downloaded at the same time.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep at most "workers" files waiting to be processed, so that
+        # memory usage does not grow with the number of days.
+        pending = deque()
+        for DATE in dates:
+            pending.append((DATE, executor.submit(fetch_day, DATE)))
+            if len(pending) > workers:
+                DATE, future = pending.popleft()
+                yield DATE, future.result()
+        while pending:
+            DATE, future = pending.popleft()
+            yield DATE, future.result()
+
+def parse_day(content):
+    '''
+    Turn the content of a daily "csv" file into a dataframe with columns
+    "code site", "Polluant", "valeur brute", "validité", "dateTime" and
+    "hour", keeping only the validated data of the pollutants of interest.
+    Return None when the file does not provide any pollution data.
+    '''
+    # Read only the needed columns, station codes and pollutants being
+    # stored as categories (only a few hundred distinct values).
+    from pandas import read_csv, to_datetime
+    data = read_csv(
+        BytesIO(content),
+        sep=";",
+        usecols=lambda x: x in USED_COLUMNS,
+        dtype={"code site": "category", "Polluant": "category"})
+    # Test whether "csv" file provide some pollution data
+    # (Server errors may occur, making data unavailable).
+    if len(data.columns) < len(USED_COLUMNS):
+        return None
+    # Extract rows with validated data, with consistent concentration
+    # value (bugs during the recording process may generate negative
+    # values) and with pollutants of interest.
+    data = data[
+        (data["validité"]==1) &
+        (data["valeur brute"]>0) &
+        ~data["Polluant"].isin(IGNORED_POLLUTANTS)]
+    # Add new columns "dateTime" and "hour".
+    dateTime = to_datetime(data["Date de début"], format="%Y/%m/%d %H:%M:%S")
+    return data.drop(columns="Date de début").assign(
+        dateTime=dateTime,
+        hour=dateTime.dt.hour)
+
+def iter_batches(data, batch_size=INSERT_BATCH_SIZE):
+    '''
+    Yield lists of at most "batch_size" documents ready to be inserted
+    into MongoDB, built directly from the columns of "data" (see function
+    "parse_day").
+    '''
+    for i in range(0, len(data), batch_size):
+        chunk = data.iloc[i:i+batch_size]
+        yield [
+            {"code site": station,
+             "Polluant": pollutant,
+             "valeur brute": value,
+             "validité": validity,
+             "dateTime": dateTime,
+             "hour": hour}
+            for station, pollutant, value, validity, dateTime, hour in zip(
+                chunk["code site"].tolist(),
+                chunk["Polluant"].tolist(),
+                chunk["valeur brute"].tolist(),
+                chunk["validité"].tolist(),
+                chunk["dateTime"].dt.to_pydatetime(),
+                chunk["hour"].tolist())]
+
+def iter_readings(data, batch_size=INSERT_BATCH_SIZE):
+    '''
+    Same as function "iter_batches", yielding the documents of the
+    time-series collection "readings" (see function "create_readings").
+    '''
+    for i in range(0, len(data), batch_size):
+        chunk = data.iloc[i:i+batch_size]
+        yield [
+            {"meta": {"station": station, "pollutant": pollutant},
+             "dateTime": dateTime,
+             "value": value}
+            for station, pollutant, value, dateTime in zip(
+                chunk["code site"].tolist(),
+                chunk["Polluant"].tolist(),
+                chunk["valeur brute"].tolist(),
+                chunk["dateTime"].dt.to_pydatetime())]
+
+def create_readings():
+    '''
+    Create the time-series collection "readings" (replacing the previous
+    one) storing the validated hourly values, grouped by MongoDB into
+    compressed buckets of the same station and pollutant. Readings older
+    than "READINGS_RETENTION" days are removed by MongoDB itself.
+    '''
+    database.drop_collection(READINGS)
+    database.create_collection(
+        READINGS,
+        timeseries={"timeField": "dateTime",
+                    "metaField": "meta",
+                    "granularity": "hours"},
+        expireAfterSeconds=READINGS_RETENTION*24*3600)
 
 def store_pollution_data(n_days, name):
     '''
@@ -86,37 +390,385 @@ def store_pollution_data(n_days, name):
     name -- name of the collection storing the collected data.
     '''
 
-    DATE = date.today() - timedelta(days=n_days)
-    # Iterate over each day until the current day.
-    while DATE < date.today():
-        url = "https://files.data.gouv.fr/lcsqa/concentrations-de"+\
-        "-polluants-atmospheriques-reglementes/temps-reel/"+\
-        str(DATE.year)+"/FR_E2_"+DATE.isoformat()+".csv"
-        data = read_csv(url, sep=";")
-        # Test whether "csv" file provide some pollution data
-        # (Server errors may occur, making data unavailable).
-        if "validité" in data.columns:
-            # Extract rows with validated data.
-            data = data[data["validité"]==1]
-            # Extract rows with consistent concentration value
-            # (bugs during the recording process may generate 
-            # negative values.)
-            data = data[data["valeur brute"]>0]
-            # Extract rows with pollutants of interest.
-            data["pollutant_to_ignore"] = data["Polluant"].apply(
-                lambda x: x in ["NO","NOX as NO2","C6H6"])
-            data = data[data["pollutant_to_ignore"]==False]
-            # Turn pandas dataframe into records.
-            records = data.to_dict("records")
-            # Iterate over each row to add new fields "dateTime" and "hour".
-            for r in records:
-                r["dateTime"] = stringToDatetime(r["Date de début"])
-                r["hour"] = r["dateTime"].hour
-                r.pop("Date de début")
-            # Move data into the"LCSQA_data" collection.
-            database[name].insert_many(records)
-        # Move on to the following day.
-        DATE += timedelta(days=1)
+    dates = [date.today()-timedelta(days=n) for n in range(n_days,0,-1)]
+    # Iterate over each day until the current day (files are downloaded
+    # concurrently, see function "fetch_days"), skipping the days already
+    # stored by a previous attempt. The documents are inserted by the
+    # threads of "writer" while the next days are parsed.
+    writer = bulkWriter()
+    try:
+        for DATE, content in fetch_days(pending_days(dates, name)):
+            store_day(DATE, content, name, writer)
+        writer.join()
+    finally:
+        writer.close()
+
+class bulkWriter():
+    '''
+    Pool of threads inserting the batches of documents put into a bounded
+    queue with unordered "insert_many" calls, so that writing the data of a
+    day overlaps with downloading and parsing the next ones. Putting a batch
+    blocks while the queue is full, which slows the parsing down to the
+    pace of the writes.
+
+    Arguments (read from WRITER_WORKERS, WRITER_QUEUE_SIZE and
+    INSERT_BATCH_SIZE when not given):
+    workers -- number of threads inserting the documents.
+    queue_size -- maximum number of batches waiting to be inserted.
+    batch_size -- maximum number of documents of a batch.
+    '''
+    def __init__(self, workers=None, queue_size=None, batch_size=None):
+        workers = workers or WRITER_WORKERS
+        self.batch_size = batch_size or INSERT_BATCH_SIZE
+        self.queue = queue.Queue(maxsize=queue_size or WRITER_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True)
+            for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, name, batches, callback=None):
+        '''
+        Queue the given batches of documents to be inserted into the
+        collection "name", and call "callback" (from one of the threads)
+        once all of them have been inserted.
+        '''
+        # Number of batches still to be inserted, plus one until they are
+        # all queued.
+        task = {"remaining": 1, "callback": callback, "failed": False}
+        for batch in batches:
+            with self.lock:
+                task["remaining"] += 1
+            self.queue.put((name, batch, task))
+        self.finish(task)
+
+    def finish(self, task):
+        '''
+        Count one more batch of "task" as inserted and call its callback if
+        it was the last one (an error raised by the callback being kept for
+        "join").
+        '''
+        with self.lock:
+            task["remaining"] -= 1
+            done = not(task["remaining"] or task["failed"])
+        if done and task["callback"] is not None:
+            try:
+                task["callback"]()
+            except Exception as error:
+                self.errors.append(error)
+
+    def run(self):
+        '''
+        Insert the batches of the queue until "close" is called.
+        '''
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                name, batch, task = item
+                try:
+                    with metrics.timed(metrics.INGESTION_SECONDS, "write"):
+                        database[name].insert_many(batch, ordered=False)
+                except Exception as error:
+                    # The callback of the task is never called.
+                    with self.lock:
+                        task["failed"] = True
+                    self.errors.append(error)
+                    continue
+                # Never let an error stop the thread, otherwise "submit"
+                # would wait forever once all the threads are stopped.
+                self.finish(task)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        '''
+        Wait until all the queued batches are inserted, and raise the first
+        error raised by an insertion, if any.
+        '''
+        self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        '''
+        Stop the threads once the queued batches are inserted.
+        '''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def manifest_entries(name):
+    '''
+    Return the dictionary mapping each day recorded in the manifest of the
+    collection "name" to its entry.
+    '''
+    return {
+        entry["_id"]["day"].date(): entry
+        for entry in database[MANIFEST].find({"_id.collection": name})}
+
+def pending_days(dates, name):
+    '''
+    Return the list of the days among "dates" which must be stored into the
+    collection "name": those which have not been completely stored yet, and
+    those whose file may still change (see function "is_final"). The other
+    days are skipped from their entry of the manifest alone, which is
+    shared by all the workers (unlike the cache of each container).
+    '''
+    entries = manifest_entries(name)
+    # The recent days are stored again only if their file has changed (see
+    # function "store_day").
+    return [
+        DATE for DATE in dates
+        if DATE not in entries or entries[DATE]["status"] != "complete" or \
+        not is_final(DATE)]
+
+def clear_manifest(name, before=None):
+    '''
+    Remove the entries of the manifest of the collection "name" (only those
+    of the days before "before" if it is given).
+    '''
+    query = {"_id.collection": name}
+    if before is not None:
+        query["_id.day"] = {"$lt": datetime(before.year, before.month, before.day)}
+    database[MANIFEST].delete_many(query)
+
+def resume_staging(name, first_day):
+    '''
+    Prepare the staging collection "name" to receive the days from
+    "first_day" on. Return True if it holds days stored by a previous
+    attempt (listed in the manifest) which are kept, the older days being
+    removed; otherwise the collection is to be emptied by the caller.
+    '''
+    if not(manifest_entries(name)):
+        return False
+    database[name].delete_many(
+        {"dateTime": {"$lt": datetime(first_day.year, first_day.month, first_day.day)}})
+    clear_manifest(name, before=first_day)
+    return True
+
+def store_day(DATE, content, name, writer=None, write_cube=True):
+    '''
+    Store the pollution data of the day "DATE" into the collection "name".
+    The data of this day already stored there are removed first, so that
+    storing a day again (when a task of "celery.py" is retried) does not
+    duplicate them, and nothing is done if the manifest shows that the same
+    file has already been completely stored. Return the number of documents
+    of the day.
+
+    Arguments:
+    DATE -- pollution day whose data are stored.
+    content -- content of the "csv" file of the day (see function "fetch_day").
+    name -- name of the collection storing the collected data.
+    writer -- "bulkWriter" inserting the documents in the background (the
+    day being marked as stored once they are all inserted), or None to
+    insert them before returning.
+    write_cube -- whether to write the day into the memory-mapped copy too
+    (the days stored in parallel by the tasks of "celery.py" are written
+    afterwards by function "fill_cube", in chronological order).
+    '''
+    DATETIME = datetime(DATE.year, DATE.month, DATE.day)
+    key = {"_id": {"collection": name, "day": DATETIME}}
+    checksum = hashlib.sha256(content).hexdigest()
+    entry = database[MANIFEST].find_one(key)
+    if entry is not None and entry["status"] == "complete" \
+    and entry["checksum"] == checksum:
+        return entry["rows"]
+    # Record that the day is being stored, so that a process stopped in the
+    # middle leaves it incomplete.
+    database[MANIFEST].update_one(
+        key,
+        {"$set": {"checksum": checksum,
+                  "rows": 0,
+                  "status": "started",
+                  "time": datetime.utcnow()}},
+        upsert=True)
+    with metrics.timed(metrics.INGESTION_SECONDS, "parse"):
+        data = parse_day(content)
+    # Documents of the day left in the collection by a previous attempt.
+    previous_data = {
+        "dateTime": {"$gte": DATETIME, "$lt": DATETIME+timedelta(days=1)}}
+    if data is None:
+        database[name].delete_many(previous_data)
+        database[MANIFEST].update_one(key, {"$set": {"status": "complete"}})
+        return 0
+    metrics.INGESTION_ROWS.labels("parse").inc(len(data))
+    # Write the day into the memory-mapped copy if there is one.
+    if cube is not None and write_cube:
+        with metrics.timed(metrics.INGESTION_SECONDS, "cube"):
+            cube.write_day(DATE, data)
+    def complete():
+        # The insertion ends once the last batch has been written.
+        metrics.INGESTION_SECONDS.labels("insert").observe(time.perf_counter()-start)
+        metrics.INGESTION_ROWS.labels("insert").inc(len(data))
+        database[MANIFEST].update_one(
+            key, {"$set": {"rows": len(data), "status": "complete"}})
+    # Move data into the collection (the order of the documents does not
+    # matter, so that MongoDB may insert them in parallel). Handing them to
+    # "writer" waits while its queue is full.
+    batch_size = writer.batch_size if writer is not None else INSERT_BATCH_SIZE
+    batches = (iter_readings if name == READINGS else iter_batches)(data, batch_size)
+    start = time.perf_counter()
+    database[name].delete_many(previous_data)
+    if writer is not None:
+        writer.submit(name, batches, complete)
+    else:
+        for batch in batches:
+            database[name].insert_many(batch, ordered=False)
+        complete()
+    return len(data)
+
+def fill_cube(days):
+    '''
+    Write the given pollution days (in chronological order) into the
+    memory-mapped copy of the hourly data, if there is one, reading their
+    files again (from the cache for all but the last day).
+    '''
+    if cube is None:
+        return
+    for DATE, content in fetch_days(days):
+        data = parse_day(content)
+        if data is not None:
+            with metrics.timed(metrics.INGESTION_SECONDS, "cube"):
+                cube.write_day(DATE, data)
+
+def cube_covers(end):
+    '''
+    Test whether the memory-mapped copy of the hourly data, if there is
+    one, holds all the days published before "end" (a datetime), so that it
+    can be read instead of the database.
+    '''
+    return cube is not None and cube.covers(end.date())
+
+def backfill_cube():
+    '''
+    Write all the published days into the memory-mapped copy of the hourly
+    data, if there is one, unless it already holds them (the copy being
+    otherwise only filled with the days stored after it has been set up).
+    The values are read from the database, one station and one pollutant
+    at a time.
+    '''
+    if cube is None or "last_update" not in database.list_collection_names():
+        return
+    from .cube import N_DAYS
+    end = get_last_update()+timedelta(days=1)
+    if cube_covers(end):
+        return
+    owner = uuid.uuid4().hex
+    if not(acquire_lock("cube", owner)):
+        return
+    try:
+        matrices = {}
+        for document in database["distribution_pollutants"].find():
+            for pollutant in document["monitored_pollutants"]:
+                name, query, projection = statistics_query(
+                    document["_id"], pollutant, N_DAYS, end)
+                matrices[(document["_id"], pollutant)] = statistics_matrix(
+                    database[name].find(query, projection), N_DAYS, end)
+        with metrics.timed(metrics.INGESTION_SECONDS, "cube"):
+            cube.write_days(end.date(), matrices)
+    finally:
+        release_lock("cube", owner)
+
+def acquire_lock(name, owner, lease=REFRESH_LEASE):
+    '''
+    Try to take the lock "name" (stored in the "locks" collection) for
+    "lease" seconds on behalf of "owner" and return True if it has been
+    taken, False if another owner holds it.
+    '''
+    now = datetime.utcnow()
+    try:
+        # The document of the lock only matches if the lock has expired (or
+        # does not exist, in which case it is inserted); otherwise the
+        # insertion fails since the "_id" is already used.
+        database["locks"].update_one(
+            {"_id": name, "expires": {"$lt": now}},
+            {"$set": {"owner": owner,
+                      "expires": now+timedelta(seconds=lease)}},
+            upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+def release_lock(name, owner):
+    '''
+    Release the lock "name" if it is still held by "owner".
+    '''
+    database["locks"].delete_one({"_id": name, "owner": owner})
+
+def create_indexes():
+    '''
+    Create the indexes given by "INDEXES" (nothing is done for those which
+    already exist).
+    '''
+    for name, indexes in INDEXES.items():
+        for keys in indexes:
+            database[name].create_index(keys)
+
+def missing_indexes():
+    '''
+    Return the list of the (collection, keys) pairs of "INDEXES" whose
+    index does not exist in the database.
+    '''
+    missing = []
+    for name, indexes in INDEXES.items():
+        existing = [
+            [(field, direction) for field, direction in index["key"]]
+            for index in database[name].index_information().values()]
+        missing += [(name, keys) for keys in indexes if keys not in existing]
+    return missing
+
+def initialize_database():
+    '''
+    Create the "air_quality" database unless it has already been created
+    (or is being created by another process).
+    '''
+    if "last_update" in database.list_collection_names():
+        # Add the indexes and fix the locations of a database built by a
+        # previous version of the application.
+        create_indexes()
+        if locations_are_outdated():
+            owner = uuid.uuid4().hex
+            if acquire_lock("refresh", owner):
+                try:
+                    create_locations()
+                finally:
+                    release_lock("refresh", owner)
+        backfill_cube()
+        return
+    owner = uuid.uuid4().hex
+    if not(acquire_lock("refresh", owner)):
+        return
+    try:
+        if "last_update" not in database.list_collection_names():
+            create_database()
+    finally:
+        release_lock("refresh", owner)
+    backfill_cube()
+
+def refresh_database():
+    '''
+    Update the database (see function "update_database") unless it is up to
+    date or is being filled by another process. Return the report of the
+    update, or None if it has not been performed.
+    '''
+    if "last_update" not in database.list_collection_names() \
+    or history_is_updated():
+        return None
+    owner = uuid.uuid4().hex
+    if not(acquire_lock("refresh", owner)):
+        return None
+    try:
+        # Another process may have performed the update in the meantime.
+        if history_is_updated():
+            return None
+        return update_database()
+    finally:
+        release_lock("refresh", owner)
 
 def create_database():
     '''
@@ -127,8 +779,46 @@ def create_database():
         - "regions", grouping French departments by French region.
         - "LCSQA_data", containing air pollution data collected over the last 180 days.
     '''
+    days = prepare_creation()
+    store_pollution_data(len(days), staging_collection(True))
+    finish_creation(days)
+
+def staging_collection(creation):
+    '''
+    Return the name of the collection receiving the downloaded days (see
+    function "store_day") when creating the database (if "creation" is
+    True) or when updating it.
+    '''
+    if TIMESERIES:
+        return READINGS
+    return "LCSQA_data" if creation else "new_data"
 
+def prepare_creation():
+    '''
+    Create the "cities", "departments" and "regions" collections and return
+    the list of the pollution days whose data must then be stored into the
+    "LCSQA_data" collection (see functions "store_day" and "finish_creation").
+    '''
+    create_locations()
+    days = [date.today()-timedelta(days=n) for n in range(180,0,-1)]
+    # Keep the days stored by a previous attempt to create the database,
+    # or remove the data it left.
+    if resume_staging(staging_collection(True), days[0]):
+        pass
+    elif TIMESERIES:
+        create_readings()
+    else:
+        database.drop_collection("LCSQA_data")
+        database["LCSQA_data"].create_index(STAGING_INDEX)
+    return days
+
+def create_locations():
+    '''
+    Create the "cities", "departments" and "regions" collections from the
+    list of the LCSQA stations (see function "load_stations").
+    '''
     # Create the "LCSQA_stations" collection.
+    database.drop_collection("LCSQA_stations")
     store_locations()
     # Create the "cities" collection using "LCSQA_stations".
     database["LCSQA_stations"].aggregate([
@@ -154,42 +844,107 @@ def create_database():
         {"$out": "regions"}])
     # Remove the "LCSQA_stations" intermediate collection.
     database.drop_collection("LCSQA_stations")
-    
-    # Create the "LCSQA_data" collection.
-    store_pollution_data(180,"LCSQA_data")
-    # Create the "distribution_pollutants" collection using "LCSQA_data".
-    database["LCSQA_data"].aggregate([
-        {"$group":
-            {"_id": "$code site",
-             "monitored_pollutants":
-                {"$push": "$Polluant"}}},
-        {"$out": "distribution_pollutants"}])
-    # Group data in "LCSQA_data" to allow computation of wanted
-    # averages (see function "get_values") and fast updates of
-    # the database (see function "update_database").
-    database["LCSQA_data"].aggregate([
-        {"$group":
-            {"_id": {"station": "$code site",
-                     "pollutant": "$Polluant",
-                     "hour": "$hour"},
-             "values": {"$push": "$valeur brute"},
-             "dates": {"$push": "$dateTime"}}},
-        {"$project":
-            {"history": {"values": "$values",
-                         "dates": "$dates"}}},
-        {"$out": "LCSQA_data"}])
+
+def locations_are_outdated():
+    '''
+    Test whether the departments of the "departments" collection differ
+    from those of the LCSQA stations (the collection having been built by a
+    previous version of the application).
+    '''
+    departments = {station["Département"] for station in load_stations()}
+    return set(database["departments"].distinct("_id")) != departments
+
+def finish_creation(days):
+    '''
+    Turn the data of the given pollution days stored into the "LCSQA_data"
+    collection into the histories read by the API (the "readings" collection
+    being read as it is) and mark the database as created.
+    '''
+    # Create the "distribution_pollutants" collection.
+    with metrics.timed(metrics.AGGREGATION_SECONDS, "distribution"):
+        database[staging_collection(True)].aggregate([
+            distribution_stage(),
+            {"$out": "distribution_pollutants"}])
+    if not(TIMESERIES):
+        # The rows are about to be replaced by the histories: a new attempt
+        # must not take them as stored days.
+        clear_manifest("LCSQA_data")
+        store_histories()
+    # Index the collections (the "$out" stages drop the previous indexes).
+    with metrics.timed(metrics.AGGREGATION_SECONDS, "indexes"):
+        create_indexes()
+    missing = missing_indexes()
+    if missing:
+        raise RuntimeError("Indexes not created: "+repr(missing))
     # Since the present application will be deployed using Docker containers, we     
     # can't update the history of data in a continuous way. We have to keep track of
     # the date when the last update occured, in order to know how many days we will
     # have to add to the history when performing the next update.
-    # So I store this information (given by the "DATE" variable) in a new collection.
+    # So I store this information (given by the last day) in a new collection.
+    DATE = days[-1]
     database["last_update"].insert_one(
-        {"date": datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=1)})
+        {"date": datetime(DATE.year, DATE.month, DATE.day)})
+
+def distribution_stage():
+    '''
+    Return the aggregation stage grouping the pollutants of the documents
+    of the staging collection (see function "staging_collection") by
+    station, as stored in "distribution_pollutants".
+    '''
+    if TIMESERIES:
+        return {"$group":
+            {"_id": "$meta.station",
+             "monitored_pollutants": {"$addToSet": "$meta.pollutant"}}}
+    return {"$group":
+        {"_id": "$code site",
+         "monitored_pollutants": {"$addToSet": "$Polluant"}}}
+
+def store_histories():
+    '''
+    Group the rows stored into "LCSQA_data" into one document per station,
+    pollutant and hour, whose history is stored in a ring buffer (see
+    function "encode_histories").
+    '''
+    # Group data in "LCSQA_data" to allow computation of wanted
+    # averages (see function "get_values") and fast updates of
+    # the database (see function "update_database").
+    with metrics.timed(metrics.AGGREGATION_SECONDS, "histories"):
+        database["LCSQA_data"].aggregate([
+            {"$group":
+                {"_id": {"station": "$code site",
+                         "pollutant": "$Polluant",
+                         "hour": "$hour"},
+                 "values": {"$push": "$valeur brute"},
+                 "dates": {"$push": "$dateTime"}}},
+            {"$project":
+                {"history": {"values": "$values",
+                             "dates": "$dates"}}},
+            {"$out": "LCSQA_data"}])
+    # Store the histories into ring buffers.
+    with metrics.timed(metrics.AGGREGATION_SECONDS, "encoding"):
+        encode_histories()
 
 def update_database():
     '''
     Complete the database with the latest pollution data recorded since
     the last update and remove those being more than 180 days old.
+    Return a dictionary giving the number of documents of "LCSQA_data"
+    which have been modified, the number of bytes sent to modify them and
+    the duration of the update in seconds.
+    '''
+    start = time.perf_counter()
+    days = prepare_update()
+    # Fill the "new_data" collection with the missing data.
+    store_pollution_data(len(days), staging_collection(False))
+    report = finish_update(days)
+    report["seconds"] = time.perf_counter()-start
+    return report
+
+def prepare_update():
+    '''
+    Return the list of the pollution days recorded since the last update,
+    whose data must be stored into the "new_data" collection (or directly
+    into "readings") before calling function "finish_update".
     '''
     # Retrieve the date when the last update occured.
     last_update = database["last_update"].find_one()["date"]
@@ -200,68 +955,555 @@ def update_database():
     DATE = following_date if oldest_date < following_date \
     else oldest_date
     n_days = (date.today()-DATE).days
-    # Fill the "new_data" collection with the missing data.
-    store_pollution_data(n_days, "new_data")
-    # Rearrange the data the same way as in the "LCSQA_data" collection.
-    database["new_data"].aggregate([
-        {"$match": {"validité": 1}},
-        {"$project": {"_id": {"station": "$code site",
-                              "pollutant": "$Polluant",
-                              "hour": "$hour"},
-                      "history": {"date": "$dateTime",
-                                  "value": "$valeur brute"}}}])
-    # Join the "LCSQA_data" collection with the "new_data" collection (line 217),
-    # then update the history of pollution data (line 222) and then update the
-    # boolean flags identifying the last values of the new history (line 230).
-    database["LCSQA_data"].aggregate([
-        {"$lookup": 
-            {"from": "new_data",
-             "localField": "_id",
-             "foreignField": "_id",
-             "as": "new_data"}},
-        {"$set":
-            {"history":
-                {"$function": 
-                    {"body": updateList,
-                     "args": ["$history",
-                              "$data_180_days_ago",
-                              "$new_data"],
-                     "lang": "js"}}}},
-        {"$set":
-            {"data_180_days_ago":
-                {"$eq": ["history.dates.$",
-                        date.today()-timedelta(days=180)]}}},
-        {"$out": "LCSQA_data"}])
-    # Remove the "new_data" collection from the database.
-    database.drop_collection("new_data")
-    # Change the date of the last update.
+    # Keep the days stored by a previous attempt to update the database, or
+    # remove the data it left.
+    if not(TIMESERIES or resume_staging("new_data", DATE)):
+        database.drop_collection("new_data")
+        database["new_data"].create_index(STAGING_INDEX)
+    return [DATE+timedelta(days=n) for n in range(n_days)]
+
+def finish_update(days):
+    '''
+    Add the data of the given pollution days stored into the "new_data"
+    collection to the database and publish them. Return a dictionary giving
+    the number of documents of "LCSQA_data" (or "readings") which have been
+    modified (or inserted) and the number of bytes sent to modify them.
+    '''
+    last_update = database["last_update"].find_one()["date"]
+    if not(days):
+        return {"documents": 0, "bytes": 0}
+    if TIMESERIES:
+        # The readings are already in place, the oldest ones being removed
+        # by MongoDB: only consider those of the new days.
+        new_data = [
+            {"$match":
+                {"dateTime":
+                    {"$gte": datetime(days[0].year, days[0].month, days[0].day)}}}]
+        with metrics.timed(metrics.AGGREGATION_SECONDS, "report"):
+            report = next(database[READINGS].aggregate(new_data+[
+                {"$group":
+                    {"_id": None,
+                     "documents": {"$sum": 1},
+                     "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}},
+                {"$project": {"_id": 0}}]), {"documents": 0, "bytes": 0})
+    else:
+        new_data = []
+        # Add the new data to the histories of the "LCSQA_data" collection.
+        with metrics.timed(metrics.AGGREGATION_SECONDS, "rollover"):
+            report = rollover("new_data")
+    # Add the pollutants monitored by new stations (or newly monitored by
+    # known stations) to the "distribution_pollutants" collection.
+    with metrics.timed(metrics.AGGREGATION_SECONDS, "distribution"):
+        database[staging_collection(False)].aggregate(new_data+[
+            distribution_stage(),
+            {"$merge":
+                {"into": "distribution_pollutants",
+                 "whenMatched": [
+                    {"$set":
+                        {"monitored_pollutants":
+                            {"$setUnion": ["$monitored_pollutants",
+                                           "$$new.monitored_pollutants"]}}}],
+                 "whenNotMatched": "insert"}}])
+    # Remove the "new_data" collection from the database (the manifest
+    # first, so that its days are never taken as stored).
+    if TIMESERIES:
+        clear_manifest(READINGS, before=date.today()-timedelta(days=READINGS_RETENTION))
+    else:
+        clear_manifest("new_data")
+        database.drop_collection("new_data")
+    # Change the date of the last update. Until then, the new data are
+    # ignored by the functions reading the database, so that they are all
+    # published at once by this single write.
+    DATE = days[-1]
     database["last_update"].replace_one(
         {"date": last_update},
-        {"date": datetime(
-            DATE.year,
-            DATE.month,
-            DATE.day)-timedelta(days=1)})
+        {"date": datetime(DATE.year, DATE.month, DATE.day)})
+    # Make the new date visible to "get_last_update" at once.
+    known_update["date"] = None
+    return report
+
+def rollover(name):
+    '''
+    Add the data of the collection "name" (filled by "store_pollution_data")
+    to the histories of "LCSQA_data". Only the documents of the (station,
+    pollutant, hour) triples with new data are modified, the slots of the
+    new days of their ring buffers (see function "encode_history") being
+    written with unordered bulk writes.
+    Return a dictionary giving the number of documents modified and the
+    number of bytes sent to modify them.
+    '''
+    report = {"documents": 0, "bytes": 0}
+    # Group the new data the same way as in the "LCSQA_data" collection.
+    groups = database[name].aggregate([
+        {"$sort": {"dateTime": 1}},
+        {"$group":
+            {"_id": {"station": "$code site",
+                     "pollutant": "$Polluant",
+                     "hour": "$hour"},
+             "values": {"$push": "$valeur brute"},
+             "dates": {"$push": "$dateTime"}}}],
+        allowDiskUse=True)
+    batch = []
+    for group in groups:
+        batch.append(group)
+        if len(batch) == INSERT_BATCH_SIZE:
+            write_rollover(batch, report)
+            batch = []
+    if batch:
+        write_rollover(batch, report)
+    return report
+
+def write_rollover(groups, report):
+    '''
+    Write the values of the given groups (see function "rollover") into
+    the slots of the corresponding documents of "LCSQA_data" and update
+    "report".
+    '''
+    import numpy
+    DATE = date.today()
+    end = datetime(DATE.year, DATE.month, DATE.day)
+    # Retrieve the histories of the documents to modify (binary data can
+    # not be modified in place by MongoDB).
+    histories = {
+        tuple(document["_id"].values()): document["history"]
+        for document in database["LCSQA_data"].find(
+            {"_id": {"$in": [group["_id"] for group in groups]}},
+            {"history": 1})}
+    requests = []
+    for group in groups:
+        days = numpy.array([x.toordinal() for x in group["dates"]])
+        values = numpy.array(group["values"], dtype="<f4")
+        history = histories.get(tuple(group["_id"].values()))
+        if history is not None:
+            # Keep the stored values of the days which are not given again
+            # (the history is encoded again, as it may have been written
+            # with another number of slots).
+            stored_values, stored_days = decode_history(history)
+            kept = ~numpy.isin(stored_days, days)
+            values = numpy.concatenate([stored_values[kept], values])
+            days = numpy.concatenate([stored_days[kept], days])
+        update = {"$set": {"history": encode_history(values, days, end)}}
+        report["bytes"] += len(encode(update))
+        requests.append(UpdateOne({"_id": group["_id"]}, update, upsert=True))
+    result = database["LCSQA_data"].bulk_write(requests, ordered=False)
+    report["documents"] += result.modified_count+result.upserted_count
+
+def encode_history(values, days, end):
+    '''
+    Return the ring buffer storing a history in "LCSQA_data": the value of
+    each of the 181 days before "end" (the day following the last stored
+    day) is kept in the slot (ordinal of the day % 181) of a binary array
+    of 181 little-endian float32, NaN marking missing values, so that the
+    documents never change size. The cumulative sums and numbers of the
+    values of these days are stored next to the ring buffer (see function
+    "history_sum").
+
+    Arguments:
+    values -- list or array of recorded values.
+    days -- list or array of the ordinals of the corresponding days.
+    end -- datetime of the day following the last day to store.
+    '''
+    import numpy
+    values = numpy.asarray(values, dtype="<f4")
+    days = numpy.asarray(days, dtype=numpy.int64)
+    slots = numpy.full(HISTORY_DAYS, numpy.nan, dtype="<f4")
+    kept = (days >= end.toordinal()-HISTORY_DAYS) & (days < end.toordinal())
+    slots[days[kept] % HISTORY_DAYS] = values[kept]
+    # The i-th cumulative sum (resp. number) is the sum (resp. the number)
+    # of the values of the i first days of the ring buffer, in
+    # chronological order.
+    window = slots[
+        numpy.arange(end.toordinal()-HISTORY_DAYS, end.toordinal()) % HISTORY_DAYS]
+    recorded = ~numpy.isnan(window)
+    sums = numpy.zeros(HISTORY_DAYS+1, dtype="<f8")
+    counts = numpy.zeros(HISTORY_DAYS+1, dtype="<u2")
+    numpy.cumsum(numpy.where(recorded, window, 0), dtype="<f8", out=sums[1:])
+    numpy.cumsum(recorded, out=counts[1:])
+    return {"end": end,
+            "values": Binary(slots.tobytes()),
+            "sums": Binary(sums.tobytes()),
+            "counts": Binary(counts.tobytes())}
+
+def history_sum(history, n_days, end):
+    '''
+    Return the sum and the number of the values stored by the ring buffer
+    "history" (see function "encode_history") for the "n_days" days before
+    "end", computed with two subtractions of its cumulative sums whatever
+    the number of days.
+    '''
+    import numpy
+    sums = numpy.frombuffer(history["sums"], dtype="<f8")
+    counts = numpy.frombuffer(history["counts"], dtype="<u2")
+    # Index of the cumulative sums of the first and last days of the period
+    # (the days outside of the ring buffer having no value).
+    first_day = history["end"].toordinal()-(len(sums)-1)
+    low = min(max(end.toordinal()-n_days-first_day, 0), len(sums)-1)
+    high = min(max(end.toordinal()-first_day, low), len(sums)-1)
+    return float(sums[high]-sums[low]), int(counts[high])-int(counts[low])
+
+def history_window(history, n_days, end):
+    '''
+    Return the array of the values stored by the ring buffer "history" (see
+    function "encode_history") for each of the "n_days" days before "end",
+    NaN marking missing values, found by index arithmetic only (the values
+    being read in place from the binary data).
+    '''
+    import numpy
+    slots = numpy.frombuffer(history["values"], dtype="<f4")
+    days = numpy.arange(end.toordinal()-n_days, end.toordinal())
+    # Slots only hold the days before the end of the history (their number
+    # being read from the data, as histories written before the number of
+    # slots was changed may still be stored).
+    last = history["end"].toordinal()
+    return numpy.where(
+        (days >= last-len(slots)) & (days < last),
+        slots[days % len(slots)],
+        numpy.nan)
+
+def decode_history(history):
+    '''
+    Return the arrays of the values stored by the ring buffer "history"
+    and of the ordinals of their recording days, in chronological order.
+    '''
+    import numpy
+    end = history["end"]
+    n_days = len(history["values"])//4
+    values = history_window(history, n_days, end)
+    days = numpy.arange(end.toordinal()-n_days, end.toordinal())
+    recorded = ~numpy.isnan(values)
+    return values[recorded], days[recorded]
+
+def encode_histories(end=None):
+    '''
+    Replace the history of each document of the "LCSQA_data" collection
+    (lists of values and dates built by "store_histories") by a ring buffer
+    of the last 181 days before "end" (the current date by default, see
+    function "encode_history").
+    '''
+    import numpy
+    if end is None:
+        DATE = date.today()
+        end = datetime(DATE.year, DATE.month, DATE.day)
+    requests = []
+    for document in database["LCSQA_data"].find({}, {"history": 1}):
+        days = numpy.array([x.toordinal() for x in document["history"]["dates"]])
+        requests.append(UpdateOne(
+            {"_id": document["_id"]},
+            {"$set":
+                {"history": encode_history(
+                    document["history"]["values"], days, end)}}))
+        if len(requests) == INSERT_BATCH_SIZE:
+            database["LCSQA_data"].bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        database["LCSQA_data"].bulk_write(requests, ordered=False)
+
+def get_last_update():
+    '''
+    Return the date of the last update of the database, read again
+    from the "last_update" collection at most every LAST_UPDATE_TTL
+    seconds (the update may be performed by another process). Raise
+    "databaseNotReady" while the database is being created.
+    '''
+    if not(update_is_known()):
+        remember_update(database["last_update"].find_one())
+    return known_update["date"]
+
+def update_is_known():
+    '''
+    Test whether the date of the last update has been read from the
+    "last_update" collection less than LAST_UPDATE_TTL seconds ago.
+    '''
+    return known_update["date"] is not None and \
+    time.monotonic()-known_update["time"] <= LAST_UPDATE_TTL
+
+def remember_update(document):
+    '''
+    Keep the date of the last update given by "document", the document of
+    the "last_update" collection (None if there is none).
+    '''
+    # Nothing can be read before the creation of the database is done.
+    if document is None:
+        raise databaseNotReady()
+    known_update["date"] = document["date"]
+    known_update["time"] = time.monotonic()
+
+def is_recent(last_update):
+    '''
+    Test whether "last_update" is the date of the previous day, meaning
+    that no pollution day is missing from the database.
+    '''
+    DATE = date.today()
+    return last_update == \
+    datetime(DATE.year, DATE.month, DATE.day) - timedelta(days=1)
 
 def history_is_updated():
     '''
     Test whether the pollution data recorded over the last
     180 days are stored in the "air_quality" database.
     '''
-    DATE = date.today()
     # Check the date of the last update to know whether some 
     # pollution days are missing.
-    return database["last_update"].find_one()["date"] == \
-    datetime(DATE.year, DATE.month, DATE.day) - timedelta(days=1)
+    return is_recent(database["last_update"].find_one()["date"])
+
+def load_catalogue():
+    '''
+    Read the "distribution_pollutants" collection into the "catalogue"
+    dictionary mapping each station code to the set of its monitored
+    pollutants.
+    '''
+    version = get_last_update()
+    set_catalogue(version, database["distribution_pollutants"].find())
+
+def set_catalogue(version, documents):
+    '''
+    Fill the "catalogue" dictionary with the documents of the
+    "distribution_pollutants" collection as of the update "version".
+    '''
+    global catalogue
+    pollutants = {
+        document["_id"]: frozenset(document["monitored_pollutants"])
+        for document in documents}
+    # Replace the whole dictionary at once, so that concurrent requests
+    # never see a partially loaded catalogue.
+    catalogue = {"version": version, "pollutants": pollutants}
 
 def is_monitored_by(pollutant, station_code):
     '''
     Test whether air concentration of "pollutant" is recorded by the
     air quality monitoring station identified by "station_code".
     '''
-    return pollutant in \
-    list(set(database["distribution_pollutants"].find_one(
-        {"_id": station})
-    ["monitored_pollutants"]))
+    # Load the catalogue again once the database has been updated.
+    if catalogue["version"] != get_last_update():
+        load_catalogue()
+    return pollutant in catalogue["pollutants"].get(station_code, ())
+
+def as_24_values(hours, averages):
+    '''
+    Return the aggregation expression building the list of the averages
+    associated to each of the 24 hours of the day (0 for missing hours)
+    from the lists "hours" and "averages".
+    '''
+    return {"$map":
+        {"input": {"$range": [0, 24]},
+         "as": "hour",
+         "in":
+            {"$let":
+                {"vars": {"i": {"$indexOfArray": [hours, "$$hour"]}},
+                 "in":
+                    {"$cond": [{"$eq": ["$$i", -1]},
+                               0,
+                               {"$ifNull":
+                                   [{"$arrayElemAt": [averages, "$$i"]},
+                                    0]}]}}}}}
+
+def profiles_pipeline(stations, pollutants, n_days, end):
+    '''
+    Return the aggregation pipeline computing, from the "readings"
+    collection, the average values of air concentration (over the "n_days"
+    days before "end") associated to each of the 24 hours of the day, for
+    all the given stations and pollutants.
+    '''
+    return [
+        {"$match": {"meta.station": {"$in": list(stations)},
+                    "meta.pollutant": {"$in": list(pollutants)},
+                    "dateTime": {"$gte": end-timedelta(days=n_days),
+                                 "$lt": end}}},
+        {"$group":
+            {"_id": {"station": "$meta.station",
+                     "pollutant": "$meta.pollutant",
+                     "hour": {"$hour": "$dateTime"}},
+             "average": {"$avg": "$value"}}},
+        {"$group":
+            {"_id": {"station": "$_id.station",
+                     "pollutant": "$_id.pollutant"},
+             "hours": {"$push": "$_id.hour"},
+             "averages": {"$push": "$average"}}},
+        {"$project":
+            {"values": as_24_values("$hours", "$averages")}}]
+
+def as_profiles(documents):
+    '''
+    Turn the documents returned by the pipeline of "profiles_pipeline" into
+    a dictionary mapping each (station, pollutant) pair with data to the
+    list of its 24 averages.
+    '''
+    return {
+        (document["_id"]["station"], document["_id"]["pollutant"]):
+        [float(x) for x in document["values"]]
+        for document in documents}
+
+def profiles_query(stations, pollutants, n_days, end):
+    '''
+    Return the (collection, pipeline) pair of the aggregation retrieving
+    with a single query the data needed to compute the average values of
+    air concentration (over the "n_days" days before "end") associated to
+    each of the 24 hours of the day, for all the given stations and
+    pollutants (see function "profiles_from"). The averages are computed by
+    MongoDB from the readings in the "timeseries" layout (see function
+    "profiles_pipeline"), and from the ring buffers of "LCSQA_data" by the
+    API otherwise (see function "history_profiles").
+    '''
+    if TIMESERIES:
+        return READINGS, profiles_pipeline(stations, pollutants, n_days, end)
+    return (
+        "LCSQA_data",
+        [{"$match": {"_id.station": {"$in": list(stations)},
+                     "_id.pollutant": {"$in": list(pollutants)}}},
+         {"$project": {"history": 1}}])
+
+def profiles_from(documents, n_days, end):
+    '''
+    Return the dictionary mapping each (station, pollutant) pair with data
+    to the list of its 24 averages, computed from the documents returned by
+    the aggregation of "profiles_query".
+    '''
+    if TIMESERIES:
+        return as_profiles(documents)
+    return history_profiles(documents, n_days, end)
+
+def complete_profiles(pairs, profiles):
+    '''
+    Return the dictionary mapping each of the (station, pollutant) pairs
+    "pairs" to its 24 averages given by "profiles" (0 for the pairs
+    without data).
+    '''
+    return {pair: profiles.get(pair, [float(0)]*24) for pair in pairs}
+
+def cube_profiles(pairs, n_days, end):
+    '''
+    Return the dictionary mapping each of the (station, pollutant) pairs
+    "pairs" to its 24 averages over the "n_days" days before "end", read
+    from the memory-mapped copy of the hourly data, or None if it does not
+    hold the days published before "end" (see function "cube_covers").
+    '''
+    if not(cube_covers(end)):
+        return None
+    return {
+        (station, pollutant):
+        cube.get_values(station, pollutant, n_days, end.date())
+        for station, pollutant in pairs}
+
+def cube_matrix(station, pollutant, n_days, end):
+    '''
+    Same as function "cube_profiles" for the (day x hour) array of the
+    values of "pollutant" recorded by "station" (see function
+    "statistics_matrix").
+    '''
+    if not(cube_covers(end)):
+        return None
+    return cube.matrix(station, pollutant, n_days, end.date())
+
+def profiles_of(pairs, n_days):
+    '''
+    Return the dictionary mapping each of the (station, pollutant) pairs
+    "pairs" to the 24 averages computed over the "n_days" last days, read
+    from the memory-mapped copy of the hourly data if it holds the published
+    days, and from the database otherwise.
+    '''
+    # Consider only the data published by the last update.
+    end = get_last_update()+timedelta(days=1)
+    profiles = cube_profiles(pairs, n_days, end)
+    if profiles is not None:
+        return profiles
+    # Check whether "n_days" is not null (the zero value is used when
+    # we just send the web request to allow an update of the database).
+    if not(n_days):
+        return complete_profiles(pairs, {})
+    name, pipeline = profiles_query(
+        {station for station, _ in pairs},
+        {pollutant for _, pollutant in pairs},
+        n_days,
+        end)
+    return complete_profiles(
+        pairs, profiles_from(database[name].aggregate(pipeline), n_days, end))
+
+def get_stations(region=None, department=None):
+    '''
+    Return the sorted list of the codes of the stations located in the
+    given French region or department, using the "regions", "departments"
+    and "cities" collections.
+    '''
+    if region is not None:
+        document = database["regions"].find_one({"_id": region})
+        departments = list(set(document["departments"])) if document else []
+    else:
+        departments = [department]
+    cities = set()
+    for document in database["departments"].find({"_id": {"$in": departments}}):
+        cities.update(document["cities"])
+    return sorted({
+        station["code"]
+        for document in database["cities"].find(
+            {"_id": {"$in": list(cities)}},
+            {"stations.code": 1})
+        for station in document["stations"]})
+
+def get_profiles(stations, pollutants, n_days):
+    '''
+    Return the dictionary mapping each (station, pollutant) pair among the
+    given stations and pollutants, with the pollutant monitored by the
+    station, to the 24 averages computed over the "n_days" last days.
+    '''
+    pairs = [
+        (station, pollutant)
+        for station in stations for pollutant in pollutants
+        if is_monitored_by(pollutant, station)]
+    if not(pairs):
+        return {}
+    return profiles_of(pairs, n_days)
+
+def history_matrix(documents, n_days, end):
+    '''
+    Return the (day x hour) float32 array of the values stored over the
+    "n_days" days before "end" by the ring buffers of the given documents of
+    "LCSQA_data" (all of the same station and pollutant), NaN marking
+    missing values.
+    '''
+    import numpy
+    matrix = numpy.full((n_days, 24), numpy.nan, dtype=numpy.float32)
+    for document in documents:
+        matrix[:, document["_id"]["hour"]] = \
+        history_window(document["history"], n_days, end)
+    return matrix
+
+def history_averages(documents, n_days, end):
+    '''
+    Return the list of the average values of air concentration over the
+    "n_days" days before "end" associated to each of the 24 hours of the
+    day (0 for hours without data), using the cumulative sums of the ring
+    buffers of the given documents of "LCSQA_data".
+    '''
+    import numpy
+    averages = [float(0)]*24
+    for document in documents:
+        history = document["history"]
+        if "sums" in history:
+            total, count = history_sum(history, n_days, end)
+        else:
+            # Histories written before the cumulative sums were stored.
+            window = history_window(history, n_days, end)
+            recorded = ~numpy.isnan(window)
+            total = float(window[recorded].sum(dtype=numpy.float64))
+            count = int(recorded.sum())
+        if count:
+            averages[document["_id"]["hour"]] = total/count
+    return averages
+
+def history_profiles(documents, n_days, end):
+    '''
+    Same as function "history_averages" for documents of several stations
+    and pollutants, returning the dictionary mapping each (station,
+    pollutant) pair with documents to the list of its 24 averages.
+    '''
+    groups = {}
+    for document in documents:
+        groups.setdefault(
+            (document["_id"]["station"], document["_id"]["pollutant"]), []
+        ).append(document)
+    return {
+        pair: history_averages(group, n_days, end)
+        for pair, group in groups.items()}
 
 def get_values(station, pollutant, n_days):
     '''
@@ -270,41 +1512,102 @@ def get_values(station, pollutant, n_days):
     data coming from "station") of "pollutant" associated to each 
     of the 24 hours of the day.
     '''
-    DATE = date.today()
-    DATETIME = datetime(DATE.year, DATE.month, DATE.day)
-    # Initialize the "averages" dictionary storing the average values
-    # of air concentration associated to the 24 hours of the day.
-    averages = {str(x): float(0) for x in range(24)}
-    # Check whether "n_days" is not null (the zero value is used when
-    # we just send the web request to allow an update of the database).
-    if n_days:
-        # Retrieve all the documents with the wanted informations.
-        data = database["LCSQA_data"].find(
-            {"_id.station": station,
-             "_id.pollutant": pollutant})
-    # Check whether some documents have been found.
-    if data:
-        # Iterate over all the documents.
-        for document in data:
-            # Retrieve the hour when the data given by the current document 
-            # have been recorded.
-            hour = document["_id"]["hour"]
-            # Build the "history" list composed of the 
-            #(recorded_concentration-recording date) pair of values, ordered
-            # from the most recent date to the oldest.
-            history = list(zip(
-                document["history"]["values"],
-                document["history"]["dates"]))[::-1]
-            # Extract only elements of "history" with a date less than "n_days"
-            # days before the current date (the last element to consider is given
-            # by the "i" variable at the end of the "while" loop).
-            i = 0
-            duration = DATETIME - history[i][1]
-            while duration.days <= n_days:
-                i += 1
-                duration = DATETIME - history[i][1]
-            # Compute the mean of the retrieved values and update the "averages"
-            # dictionary accordingly.
-            averages[str(hour)] = float(mean([e[0] for e in history[:i]]))
-    # Return only the list of the 24 computed average values, as expected.
-    return list(averages.values())
+    return profiles_of([(station, pollutant)], n_days)[(station, pollutant)]
+
+def statistics_query(station, pollutant, n_days, end):
+    '''
+    Return the (collection, filter, projection) triple of the query
+    retrieving the values recorded by "station" for "pollutant" which are
+    needed to compute the statistics of the "n_days" days before "end"
+    (see function "statistics_matrix").
+    '''
+    if TIMESERIES:
+        return (
+            READINGS,
+            {"meta.station": station,
+             "meta.pollutant": pollutant,
+             "dateTime": {"$gte": end-timedelta(days=n_days), "$lt": end}},
+            {"_id": 0, "dateTime": 1, "value": 1})
+    return (
+        "LCSQA_data",
+        {"_id.station": station, "_id.pollutant": pollutant},
+        {"history": 1})
+
+def statistics_matrix(documents, n_days, end):
+    '''
+    Return the (day x hour) float32 array of the values recorded over the
+    "n_days" days before "end" given by the documents returned by the query
+    of "statistics_query", NaN marking missing readings.
+    '''
+    import numpy
+    if not(TIMESERIES):
+        return history_matrix(documents, n_days, end)
+    matrix = numpy.full((n_days, 24), numpy.nan, dtype=numpy.float32)
+    first_day = end.toordinal()-n_days
+    documents = list(documents)
+    rows = numpy.array(
+        [x["dateTime"].toordinal()-first_day for x in documents], dtype=int)
+    hours = numpy.array([x["dateTime"].hour for x in documents], dtype=int)
+    matrix[rows, hours] = [x["value"] for x in documents]
+    return matrix
+
+def hourly_statistics(matrix, statistics):
+    '''
+    Compute in one vectorized pass over the (day x hour) array "matrix"
+    (NaN marking missing readings) the given statistics of the values of
+    each of the 24 hours of the day. Return the dictionary mapping each
+    statistic to its 24 values (None for hours without any value).
+
+    Arguments:
+    matrix -- array of shape (number of days, 24).
+    statistics -- names of the statistics among "mean", "median", "max",
+    "count" (number of values) and "pNN" (NN-th percentile).
+    '''
+    import warnings
+    import numpy
+    counts = numpy.count_nonzero(~numpy.isnan(matrix), axis=0)
+    # Compute all the percentiles (the median being the 50th one) with a
+    # single sort of the values of each hour.
+    percentiles = [x for x in statistics if x == "median" or x.startswith("p")]
+    results = {}
+    # Hours without any value give NaN (and a warning).
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        if len(matrix) and percentiles:
+            rows = dict(zip(percentiles, numpy.nanpercentile(
+                matrix,
+                [50 if x == "median" else int(x[1:]) for x in percentiles],
+                axis=0)))
+        else:
+            rows = {x: numpy.full(24, numpy.nan) for x in percentiles}
+        for name in statistics:
+            if name == "count":
+                results[name] = counts.tolist()
+                continue
+            if not(len(matrix)):
+                row = numpy.full(24, numpy.nan)
+            elif name == "mean":
+                row = numpy.nanmean(matrix, axis=0, dtype=numpy.float64)
+            elif name == "max":
+                row = numpy.nanmax(matrix, axis=0)
+            else:
+                row = rows[name]
+            results[name] = [
+                None if numpy.isnan(x) else x for x in row.astype(float).tolist()]
+    return results
+
+def get_statistics(station, pollutant, n_days, statistics):
+    '''
+    Return the given statistics (see function "hourly_statistics") of the
+    values of air concentration of "pollutant" recorded by "station" over
+    the "n_days" last days, for each of the 24 hours of the day, computed
+    from the values retrieved by a single query.
+    '''
+    # Consider only the data published by the last update.
+    end = get_last_update()+timedelta(days=1)
+    matrix = cube_matrix(station, pollutant, n_days, end)
+    if matrix is None:
+        name, query, projection = statistics_query(station, pollutant, n_days, end)
+        matrix = statistics_matrix(
+            database[name].find(query, projection), n_days, end)
+    return hourly_statistics(matrix, statistics)
@@ -0,0 +1,267 @@
+'''
+Optional storage of the hourly pollution data in memory-mapped NumPy
+files, next to the "LCSQA_data" collection.
+'''
+import fcntl
+import json
+import os
+import warnings
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import numpy
+
+# Number of pollution days kept: one more than the 180 days read, so that
+# the oldest day read by the previous version of the data is kept while
+# the new day is being written.
+N_DAYS = 181
+
+class hourlyCube():
+    '''
+    Dense (station x pollutant x day x hour) float32 array of the values
+    recorded over the last 181 days, NaN marking missing readings.
+
+    The array is stored in a ".npy" file of "directory" opened as a memory
+    map, so that several processes reading it share the same pages. The
+    day of a pollution date is stored at position (date.toordinal() % 181)
+    of the "day" axis, so that adding a day only overwrites one plane. The
+    file "index.json" gives the station codes and pollutant symbols
+    associated to the positions along the first two axes, the first stored
+    day ("start"), the day following the last stored day ("end") and the
+    name of the current ".npy" file.
+    Writers hold the lock of the file "lock" (see method "locked"), so that
+    only one process modifies the files at a time.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.index_time = None
+        self.values = None
+        self.stations = {}
+        self.pollutants = {}
+        self.start = None
+        self.end = None
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Map again the array if "index.json" has been modified by another
+        process since the last call.
+        '''
+        try:
+            index_time = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if index_time == self.index_time:
+            return
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.stations = {x: i for i, x in enumerate(index["stations"])}
+        self.pollutants = {x: i for i, x in enumerate(index["pollutants"])}
+        self.end = date.fromisoformat(index["end"]) if index["end"] else None
+        # The first day is missing from the files written by a previous
+        # version, which are therefore never read (see method "covers").
+        self.start = \
+        date.fromisoformat(index["start"]) if index.get("start") else None
+        self.file = index["file"]
+        self.values = numpy.load(
+            os.path.join(self.directory, self.file), mmap_mode="r+")
+        self.index_time = index_time
+        # Ignore an array written with another number of days (its file is
+        # replaced by the next call to "grow").
+        if self.values.shape[2] != N_DAYS:
+            self.values = None
+            self.stations = {}
+            self.pollutants = {}
+            self.start = None
+            self.end = None
+
+    @contextmanager
+    def locked(self):
+        '''
+        Hold the exclusive lock of the directory during the "with" block,
+        waiting for the other processes writing the array to release it.
+        '''
+        with open(os.path.join(self.directory, "lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save_index(self):
+        '''
+        Write "index.json" under a temporary name and then rename it, so that
+        readers never see an incomplete file.
+        '''
+        index = {
+            "stations": list(self.stations),
+            "pollutants": list(self.pollutants),
+            "start": self.start.isoformat() if self.start else None,
+            "end": self.end.isoformat() if self.end else None,
+            "file": self.file}
+        temporary_path = self.index_path+".tmp"+str(os.getpid())
+        with open(temporary_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temporary_path, self.index_path)
+        self.index_time = os.stat(self.index_path).st_mtime_ns
+
+    def grow(self, stations, pollutants):
+        '''
+        Add new station codes and pollutant symbols to the array, copying
+        the stored values into a new, larger file.
+        '''
+        new_stations = [x for x in stations if x not in self.stations]
+        new_pollutants = [x for x in pollutants if x not in self.pollutants]
+        if not(new_stations or new_pollutants) and self.values is not None:
+            return
+        for x in new_stations:
+            self.stations[x] = len(self.stations)
+        for x in new_pollutants:
+            self.pollutants[x] = len(self.pollutants)
+        # Processes still mapping the previous file keep reading it until
+        # they see the new "index.json".
+        version = int(self.file[7:-4])+1 if self.file else 0
+        file = "values-"+str(version)+".npy"
+        values = numpy.lib.format.open_memmap(
+            os.path.join(self.directory, file),
+            mode="w+",
+            dtype=numpy.float32,
+            shape=(len(self.stations), len(self.pollutants), N_DAYS, 24))
+        values[:] = numpy.nan
+        if self.values is not None:
+            values[:self.values.shape[0], :self.values.shape[1]] = self.values
+        previous_file = os.path.join(self.directory, self.file) if self.file else None
+        values.flush()
+        self.values, self.file = values, file
+        self.save_index()
+        if previous_file:
+            os.remove(previous_file)
+
+    def write_day(self, DATE, data):
+        '''
+        Store the values of the pollution day "DATE" given by the dataframe
+        "data" (see function "parse_day" of "crud.py"). The days must be
+        written in chronological order.
+        '''
+        with self.locked():
+            self.write_locked_day(DATE, data)
+
+    def write_locked_day(self, DATE, data):
+        '''
+        Same as method "write_day", the lock being held.
+        '''
+        self.refresh()
+        stations = data["code site"].astype(str)
+        pollutants = data["Polluant"].astype(str)
+        self.grow(stations.unique(), pollutants.unique())
+        if self.end is not None:
+            # Ignore days older than those stored, whose position is used
+            # by a more recent day.
+            if DATE < self.end-timedelta(days=N_DAYS):
+                return
+            # Empty the planes of the days skipped since the last stored day.
+            for n in range(min((DATE-self.end).days, N_DAYS)):
+                self.values[:, :, (self.end+timedelta(days=n)).toordinal() % N_DAYS] = \
+                numpy.nan
+        # Several values may be given for the same hour: keep their mean.
+        averages = data.assign(
+            station=stations.map(self.stations).values,
+            pollutant=pollutants.map(self.pollutants).values
+        ).groupby(["station","pollutant","hour"])["valeur brute"].mean()
+        plane = self.values[:, :, DATE.toordinal() % N_DAYS]
+        plane[:] = numpy.nan
+        plane[
+            averages.index.get_level_values("station"),
+            averages.index.get_level_values("pollutant"),
+            averages.index.get_level_values("hour")] = averages.values
+        self.values.flush()
+        if self.end is None or DATE >= self.end:
+            self.end = DATE+timedelta(days=1)
+        if self.start is None or DATE < self.start:
+            self.start = DATE
+        self.save_index()
+
+    def write_days(self, end, matrices):
+        '''
+        Store the values of the "N_DAYS" days before "end" given by
+        "matrices", a dictionary mapping (station code, pollutant symbol)
+        pairs to (day x hour) arrays of shape (N_DAYS, 24), NaN marking
+        missing readings. The days stored after "end" are kept.
+        '''
+        with self.locked():
+            self.refresh()
+            self.grow(
+                list(dict.fromkeys(station for station, _ in matrices)),
+                list(dict.fromkeys(pollutant for _, pollutant in matrices)))
+            positions = [
+                (end-timedelta(days=N_DAYS-n)).toordinal() % N_DAYS
+                for n in range(N_DAYS)]
+            self.values[:, :, positions] = numpy.nan
+            for (station, pollutant), matrix in matrices.items():
+                self.values[
+                    self.stations[station],
+                    self.pollutants[pollutant],
+                    positions] = matrix
+            self.values.flush()
+            self.start = end-timedelta(days=N_DAYS)
+            if self.end is None or self.end < end:
+                self.end = end
+            self.save_index()
+
+    def covers(self, end):
+        '''
+        Test whether all the days among the "N_DAYS"-1 days before "end" are
+        stored, in which case the array can be read instead of the database.
+        '''
+        self.refresh()
+        if self.start is None or self.end is None:
+            return False
+        return self.start <= end-timedelta(days=N_DAYS-1) and \
+        end <= self.end <= end+timedelta(days=1)
+
+    def days(self, n_days, end):
+        '''
+        Return the positions along the "day" axis of the stored days among
+        the "n_days" days before "end".
+        '''
+        first = max(
+            end-timedelta(days=n_days),
+            self.end-timedelta(days=N_DAYS))
+        last = min(self.end, end)
+        return [
+            (first+timedelta(days=n)).toordinal() % N_DAYS
+            for n in range((last-first).days)]
+
+    def matrix(self, station, pollutant, n_days, end=None):
+        '''
+        Return the (day x hour) array of the values of air concentration of
+        "pollutant" recorded by "station" over the stored days among the
+        "n_days" days before "end" (the current date by default).
+        '''
+        self.refresh()
+        if not(n_days) or self.end is None or station not in self.stations \
+        or pollutant not in self.pollutants:
+            return numpy.empty((0, 24), dtype=numpy.float32)
+        return self.values[
+            self.stations[station],
+            self.pollutants[pollutant],
+            self.days(n_days, end or date.today())]
+
+    def get_values(self, station, pollutant, n_days, end=None):
+        '''
+        Return the average values of air concentration of "pollutant"
+        recorded by "station" over the "n_days" days before "end" (the
+        current date by default), for each of the 24 hours of the day (0
+        when there is no data).
+        '''
+        matrix = self.matrix(station, pollutant, n_days, end)
+        if not(len(matrix)):
+            return [float(0)]*24
+        # Hours without any value give a NaN average (and a warning).
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            averages = numpy.nanmean(matrix, axis=0)
+        return numpy.nan_to_num(averages, nan=0).astype(float).tolist()
@@ -1,12 +1,15 @@
+import json
+import os
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 
 import requests
-from matplotlib import pyplot
 from pymongo import MongoClient
 
-overseas_departments = [
+# Overseas regions, grouped under the "OUTRE-MER" choice of the regions.
+overseas_regions = [
     "GUADELOUPE",
     "GUYANE",
     "MARTINIQUE",
@@ -15,70 +18,142 @@ overseas_departments = [
     "SAINT-MARTIN"
 ]
 
-symbol_to_name = {
-    "O3": "ozone",
-    "NO2": "nitrogen dioxide",
-    "SO2": "sulphur dioxide",
-    "PM2.5": "fine particles",
-    "PM10": "particles",
-    "CO": "carbone monoxide"
-}
-
-WHO_recommendation = {
-    pollutant: value for (pollutant, value) in zip(
-        symbol_to_name.keys(),
-        [100,25,40,15,45,4]        
-    )
-}
-
 mongoClient = MongoClient("mongodb://localhost:8001")
 database = mongoClient["air_quality"]
 
+API_URL = "http://127.0.0.1:8000"
+# Connections to the API, kept open from one request to another.
+session = requests.Session()
+session.verify = False
+# Number of pollution days considered unless the user asks for a shorter
+# period.
+DEFAULT_PERIOD = 180
+# Thread downloading the graph of the default period while the user is
+# choosing the period (see function "prefetch_plot").
+prefetcher = ThreadPoolExecutor(max_workers=1)
+
+def get_plot(parameters):
+    '''
+    Return the PNG image of the graph rendered by the API for the query
+    string parameters "parameters" ("s", "p" and "n").
+    '''
+    response = session.get(
+        API_URL+"/plot",
+        params={**parameters, "f": "png"})
+    response.raise_for_status()
+    return response.content
+
+def prefetch_plot(station, pollutant):
+    '''
+    Start downloading the graph of "pollutant" recorded by "station" over
+    the default period and return the query string parameters of the graph
+    along with the future giving its image.
+    '''
+    parameters = {"s": station, "p": pollutant, "n": str(DEFAULT_PERIOD)}
+    return parameters, prefetcher.submit(get_plot, parameters)
+
+# File keeping the navigation tree of the database between two runs (see
+# function "load_catalogue").
+CATALOGUE_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "daily_pollution", "catalogue.json")
+# Navigation tree used by the current run.
+catalogue = None
+
+def load_catalogue():
+    '''
+    Return the navigation tree of the "air_quality" database, that is a
+    dictionary giving the departments of each region ("regions"), the
+    cities of each department ("departments"), the [name, code] pairs of
+    the stations of each city ("cities") and the pollutants monitored by
+    each station ("pollutants"). The tree is read from "CATALOGUE_FILE"
+    unless the database has been updated since it was written, in which
+    case it is downloaded again (with one query per collection).
+    '''
+    # The date of the last update identifies the version of the tree.
+    version = database["last_update"].find_one()["date"].isoformat()
+    try:
+        with open(CATALOGUE_FILE) as f:
+            tree = json.load(f)
+        if tree["version"] == version:
+            return tree
+    except (OSError, ValueError, KeyError):
+        pass
+    tree = {
+        "version": version,
+        "regions": {
+            x["_id"]: x["departments"]
+            for x in database["regions"].find()},
+        "departments": {
+            x["_id"]: x["cities"]
+            for x in database["departments"].find()},
+        "cities": {
+            x["_id"]: [[e["name"], e["code"]] for e in x["stations"]]
+            for x in database["cities"].find()},
+        "pollutants": {
+            x["_id"]: x["monitored_pollutants"]
+            for x in database["distribution_pollutants"].find()}}
+    # Write the file under a temporary name and then rename it, so that
+    # another run never reads an incomplete file.
+    os.makedirs(os.path.dirname(CATALOGUE_FILE), exist_ok=True)
+    temporary_file = CATALOGUE_FILE+".tmp"+str(os.getpid())
+    with open(temporary_file, "w") as f:
+        json.dump(tree, f, separators=(",", ":"))
+    os.replace(temporary_file, CATALOGUE_FILE)
+    return tree
+
+def get_catalogue():
+    '''
+    Return the navigation tree of the database (see function
+    "load_catalogue"), loading it at the first call only.
+    '''
+    global catalogue
+    if catalogue is None:
+        catalogue = load_catalogue()
+    return catalogue
+
 def get_items(about, query_filter):
     '''
-    Query the "air_quality" database to retrieve the items
-    representing the available choices proposed to the user.
+    Look up the navigation tree of the "air_quality" database (see
+    function "load_catalogue") to retrieve the items representing the
+    available choices proposed to the user.
 
     Arguments:
     about -- string determining the name of the collection
-             to query within the database.
-    query_filter -- dictionary used as filter for the query.
+             whose documents are looked up.
+    query_filter -- dictionary giving the "_id" of the wanted document.
     '''
-    # Query the appropriate collection and store the retrieved
+    tree = get_catalogue()
+    # Look up the appropriate part of the tree and store the retrieved
     # elements in a list "items".
     match about:
         case "regions":
-            items = database["regions"].find().distinct("_id")
-            for e in overseas_departments:
-                items.remove(e)
+            items = [
+                e for e in tree["regions"] if e not in overseas_regions]
         case "departments":
             if query_filter["_id"] == "OUTRE-MER":
-                items = overseas_departments
+                # List the departments of all the overseas regions.
+                items = list(set(
+                    e for region in overseas_regions
+                    for e in tree["regions"].get(region, [])))
             else:
-                items = list(set(database["regions"].find_one(
-                    query_filter)["departments"]))
+                items = list(set(tree["regions"][query_filter["_id"]]))
         case "cities":
-            items = list(set(database["departments"].find_one(
-                query_filter)["cities"]))
+            items = list(set(tree["departments"][query_filter["_id"]]))
         case "stations":
-            list_of_stations = database["cities"].find_one(
-                query_filter)["stations"]
+            list_of_stations = tree["cities"][query_filter["_id"]]
             items = list(set([
-                e["name"]+"#"+e["code"]
-                for e in list_of_stations]))
+                name+"#"+code
+                for name, code in list_of_stations]))
         case "pollutants":
-            items = list(set(database["distribution_pollutants"].find_one(
-                query_filter)["monitored_pollutants"]))
+            items = list(set(tree["pollutants"][query_filter["_id"]]))
     # Build the "listed_items" list giving the ordered set of the retrieved
     # items along with their corresponding position.
     listed_items = list(zip(sorted(items), range(1,len(items)+1)))
     if about == "regions":
-        listed_items.append((len(listed_items)+1,"OUTRE-MER"))
+        listed_items.append(("OUTRE-MER",len(listed_items)+1))
     return listed_items
 
 
-all_the_stations = database["distribution_pollutants"].distinct("_id")
-
 def is_number(string):
     '''
     Return True if "string" represents a positive integer,
@@ -96,7 +171,8 @@ def get_input(about, items, shorter_period=False, first_choice=False):
 
     Arguments:
     about -- string determining the message displayed to the user.
-    items -- list containing the choices proposed to the user.
+    items -- list of the (name, position) pairs of the choices proposed to
+             the user (see function "get_items").
     shorter_period -- boolean set to True when treating the specific case of
                       allowing the user to reduce the number of pollution days
                       taken into account.
@@ -117,10 +193,10 @@ def get_input(about, items, shorter_period=False, first_choice=False):
         message_to_user = "Enter a number of days.\n"
         choices = []
     # Add the "Return" option allowing to return to the previous
-    # choices.
-    if about != "regions":
+    # choices (the number of days being the last choice).
+    if about not in ["regions","n_days"]:
         choices += [
-            "\n"+str(len(lines)+1)+ " : Return"]
+            "\n"+str(len(items)+1)+ " : Return"]
     # Ask the user for his choice and save the "answer".
     text = message_to_user+"\n".join(choices)+"\n\n"
     space = "\n" if (about == "regions" and first_choice) else "\n"*4
@@ -128,15 +204,15 @@ def get_input(about, items, shorter_period=False, first_choice=False):
     # If a number is expected as input...
     if not(about=="n_days" and not(shorter_period)):
         # Assign to "n" the highest possible value for the input.
-        n = 180 if about == "n_days" and shorter_period else len(choices)+1
+        n = 180 if about == "n_days" and shorter_period else len(choices)
         # Ask the same question to the user until a valid answer is provided.
         while not(is_number(answer) and int(answer) in range(1,n+1)):
             answer = input("\n"*4+text)
         number = int(answer)
         # Check avaibility of pollution data recorded by the chosen station.
-        if number < n and about == "stations":
-            item = choices[number-1][1]
-            station_found = item[item.index("#")+1:] in all_the_stations
+        if number <= len(items) and about == "stations":
+            item = items[number-1][0]
+            station_found = item[item.index("#")+1:] in get_catalogue()["pollutants"]
             if not(station_found):
                 print("Sorry, no data available for this station.\n")
                 return None
@@ -146,9 +222,9 @@ def get_input(about, items, shorter_period=False, first_choice=False):
         while answer not in ["Y","y","n"]:
             answer = input("\n"*4+text)
         if answer in ["Y","y"]:
-            return "180"
-        else:
             return get_input(about, items, shorter_period=True)
+        else:
+            return DEFAULT_PERIOD
 
 steps = ["regions","departments","cities","stations","pollutants","n_days"]
 
@@ -165,10 +241,11 @@ class userChoices():
             "n": None}
         self.i = 0 # saves the current step.
         self.current_filter = None
-        self.previous_filter = None
+        self.previous_filters = [] # filters of the previous steps.
         self.return_back = False
         self.station_not_found = False
         self.done = False
+        self.prefetched = None # graph of the default period (see "prefetch_plot").
 
     def get_chosen_item(self):
         '''
@@ -179,9 +256,7 @@ class userChoices():
         if not(self.i):
             items = get_items(current_step, {})
         elif current_step != "n_days":
-            items = get_items(
-                current_step,
-                search_filter=self.current_filter)
+            items = get_items(current_step, self.current_filter)
         # No items listed at the last step.
         else:
             items = []
@@ -191,14 +266,13 @@ class userChoices():
         # chosen by the user does not provide any pollution data.
         if type(x) is int:
             if self.i != 5:
-                choicen_item = None if x == len(listed_items)+1 else \
-                listed_items[x-1][1]
+                chosen_item = None if x == len(items)+1 else items[x-1][0]
             else:
                 chosen_item = x
             if chosen_item is None:
                 self.return_back = True
             else:
-                self.previous_filter = self.current_filter
+                self.previous_filters.append(self.current_filter)
                 if current_step in ["regions","departments","cities"]:
                     self.current_filter = {"_id": chosen_item}
                 elif current_step == "stations":
@@ -208,6 +282,10 @@ class userChoices():
                     self.current_filter = {"_id": code}
                 elif current_step == "pollutants":
                     self.query_parameters["p"] = chosen_item
+                    # Download the graph of the default period while the
+                    # user is choosing the period.
+                    self.prefetched = prefetch_plot(
+                        self.query_parameters["s"], chosen_item)
                 else:
                     self.query_parameters["n"] = chosen_item
                     # Indicate that the saving of the query parameters is done.
@@ -221,79 +299,15 @@ class userChoices():
         '''
         if self.return_back:
             self.i -= 1
-            self.current_filter = self.previous_filter
+            self.current_filter = self.previous_filters.pop()
             self.return_back = False
+        elif self.station_not_found:
+            # Ask again for a station of the same city.
+            self.station_not_found = False
         else:
-            if self.station_not_found:
-                self.done = True
             self.i += 1
     
 
-def plot_variation(station, pollutant, values):
-    '''
-    Generate the graph showing average daily variation (obtained using
-    average concentrations recorded at each of the 24 hours of the day, 
-    stored in "values") of air concentration of "pollutant" recorded by 
-    "station".
-    '''
-    fig, ax = pyplot.subplots()
-    fig.set_size_inches(17,14)
-    ax.scatter([str(x)+"h00" for x in range(24)], values)
-    # Compute four threshold values based on the corresponding WHO
-    # recommendation (will be used later to split the graph into
-    # colored zones, improving readibility and understanding of the
-    # displayed pollution data).
-    thresholds = [
-        (x/3)*WHO_recommendation[pollutant]
-        for x in range(1,5)]
-    ax.plot(
-        range(24),
-        [thresholds[2]]*24,
-        color="blueviolet",
-        ls="--",
-        lw=1.7,
-        label="Average daily air\nconcentration\nrecommended by WHO")
-    # Determine the maximum value to consider for the Y-axis in order
-    # to avoid scaling issues which could affect readibility of the
-    # displayed data.
-    highest_value = max(values)
-    max_level = 2
-    while (max_level < 5 and thresholds[max_level] < highest_value):
-        max_level += 1
-    if max_level == 5:
-        max_level -= 1
-    space = (0.40)*thresholds[0]
-    lim = thresholds[max_level] if max_level == 2 else highest_value
-    ax.set_ylim(0,lim+(space if max_level == 2 else 0))
-    # Split the graph into four colored zones.
-    colors = ["limegreen","yellow","orange","red"]
-    y_min = 0
-    for j in list(range(max_level+1)):
-        ax.fill_between(
-            list(range(24)),
-            thresholds[j],
-            y2=y_min,
-            color=colors[j],
-            alpha=0.1)
-        y_min = thresholds[j]
-    # Add a fifth zone if one or several values are above the highest
-    # set threshold.
-    if highest_value > thresholds[max_level]:
-        ax.fill_between(
-            list(range(24)),
-            ax.get_ylim()[1],
-            y2=thresholds[max_level],
-            color="magenta",
-            alpha=0.1)
-    ax.set_yticks([0])
-    ax.set_yticklabels([" "])
-    ax.legend(loc="upper right")
-    ax.set_title(
-        "Average daily"+symbol_to_name[pollutant]+" pollution\n\
-        recorded at :\n"+station,
-        ha="center")
-    pyplot.savefig("image")
-
 def main():
     
     # Display a message to the user if the initialization process
@@ -320,27 +334,30 @@ def main():
             "s": dictionary["_id"],
             "p": dictionary["monitored_pollutants"][0],
             "n": "0"}
-        _ = requests.get(
-            "http://127.0.0.1:8000",
-            params=parameters,
-            verify=False)
+        _ = session.get(API_URL, params=parameters)
     # Start the process of interacting with the user to get the query parameters
     # corresponding to his choices.
     process = userChoices()
     while not(process.done):
         process.get_chosen_item()
         process.next_step()
-    # Send the given query parameters to the endpoint and retrieve the values
-    # provided by the response.
-    values = requests.get(
-        "http://127.0.0.1:8000",
-        params=process.query_parameters,
-        verify=False).json()["values"]
-    # Generate the expected graph and display it to the user.
-    plot_variation(
-        process.parameters["station_name"],
-        process.parameters["p"],
-        values)
+    # Send the given query parameters to the endpoint rendering the expected
+    # graph (see "plots.py") and display it to the user, reusing the graph
+    # downloaded in the background if the user kept the default period.
+    parameters = {
+        "s": process.query_parameters["s"],
+        "p": process.query_parameters["p"],
+        "n": str(process.query_parameters["n"])}
+    image = None
+    if process.prefetched is not None and process.prefetched[0] == parameters:
+        try:
+            image = process.prefetched[1].result()
+        except requests.RequestException:
+            pass
+    if image is None:
+        image = get_plot(parameters)
+    with open("image.png", "wb") as f:
+        f.write(image)
     subprocess.run(["xdg-open","image.png"])
 
 if __name__=="__main__":
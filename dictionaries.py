@@ -9,6 +9,7 @@ names = [
     "Ardennes",
     "Ariège",
     "Aube",
+    "Aude",
     "Aveyron",
     "Bouches-du-Rhône",
     "Calvados",
@@ -54,8 +55,8 @@ names = [
    "Mayenne",
    "Meurthe-et-Moselle",
    "Meuse",
-   "Morbilhan",
-   "Moselle,
+   "Morbihan",
+   "Moselle",
    "Nièvre",
    "Nord",
    "Oise",
@@ -68,7 +69,7 @@ names = [
    "Bas-Rhin",
    "Haut-Rhin",
    "Rhône",
-   "Saône",
+   "Haute-Saône",
    "Saône-et-Loire",
    "Sarthe",
    "Savoie",
@@ -100,7 +101,13 @@ names = [
    "La Réunion",
    "Mayotte"]
 
-french_departments = {
-    code: name for code, name in zip(
-        list(range(1,11)+list(range(12,98)),
-        names))}
+# Codes of the departments (the first two characters of the code of their
+# cities, or three for the overseas ones), in the order of "names".
+codes = (
+    ["0"+str(x) for x in range(1,10)]+
+    [str(x) for x in range(10,20)]+
+    ["2A","2B"]+
+    [str(x) for x in range(21,96)]+
+    ["971","972","973","974","976"])
+
+french_departments = dict(zip(codes, names))
@@ -1,15 +1,125 @@
-from typing import Annotated
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
+from typing import Annotated, Optional, Union
 
-from fastapi import FastAPI, HTTPException, Query
-from pandas import read_excel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel, Field
 
+from . import metrics
+from .async_crud import \
+get_last_update, get_profiles, get_statistics, get_values, is_monitored_by, \
+run_blocking
 from .crud import \
-get_values, history_is_updated, is_monitored_by, create_database, update_database
+databaseNotReady, initialize_database, is_recent, load_stations, get_stations, \
+refresh_database
+from .plots import MEDIA_TYPES, WHO_recommendation, plot_variation
+
+# Maximum number of responses kept in memory.
+CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 4096))
+# Maximum number of rendered graphs kept in memory (about 100 kB each).
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 256))
+# Statistics which may be requested with the "stats" parameter ("pNN" being
+# the NN-th percentile).
+STATISTIC = "(mean|median|max|count|p[1-9][0-9]?)"
+# Number of seconds during which clients and proxies may reuse a response
+# without revalidating it.
+CACHE_MAX_AGE = 3600
+# Number of seconds between two checks of the date of the last update.
+REFRESH_PERIOD = 600
+# Number of seconds after which clients may try again while the database
+# is being created.
+RETRY_AFTER = 60
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# Endpoints whose requests are measured, with the label of their metrics.
+MEASURED_PATHS = {"/": "values", "/batch": "batch", "/plot": "plot"}
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    '''
+    Observe the duration of the requests of the endpoints of
+    "MEASURED_PATHS", labelled by the outcome set by the endpoint (or by
+    the status of the response), and their number of MongoDB commands.
+    '''
+    endpoint = MEASURED_PATHS.get(request.url.path)
+    if endpoint is None:
+        return await call_next(request)
+    start = time.perf_counter()
+    counter = [0]
+    metrics.round_trips.set(counter)
+    response = await call_next(request)
+    outcome = getattr(request.state, "outcome", None) or \
+    ("rejected" if response.status_code < 500 else "error")
+    metrics.REQUEST_SECONDS.labels(endpoint, outcome).observe(
+        time.perf_counter()-start)
+    metrics.REQUEST_ROUND_TRIPS.labels(endpoint).observe(counter[0])
+    return response
+
+@app.exception_handler(databaseNotReady)
+async def database_not_ready(request: Request, error: databaseNotReady):
+    '''
+    Answer the requests received while the database is being created (see
+    "start_initialization") with a 503 status code telling the clients when
+    to try again.
+    '''
+    request.state.outcome = "not_ready"
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "The database is being created, try again later."},
+        headers={"Retry-After": str(RETRY_AFTER)})
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    '''
+    Return the metrics of the process in the Prometheus text format.
+    '''
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-create_database()
+async def refresh_periodically():
+    '''
+    Update the database in the background whenever it is outdated, checking
+    it every "REFRESH_PERIOD" seconds or as soon as a request has been
+    answered with outdated data. Requests never wait for the update: they
+    are answered with the previous data until it has been published.
+    '''
+    while True:
+        try:
+            if not(is_recent(await get_last_update())):
+                # Only one process among those of the API (or the Celery
+                # worker) performs the update (see "refresh_database").
+                await run_blocking(refresh_database)
+        except databaseNotReady:
+            # Nothing to update until the creation of the database is done.
+            pass
+        except Exception:
+            logger.exception("Failed to update the database")
+        refresh_requested.clear()
+        try:
+            await asyncio.wait_for(refresh_requested.wait(), REFRESH_PERIOD)
+        except asyncio.TimeoutError:
+            pass
+
+@app.on_event("startup")
+def start_initialization():
+    '''
+    Create the database in the background if needed, so that the server
+    is ready at once (the client waits for the initialization to be done),
+    and start the task keeping it up to date.
+    '''
+    global refresh_requested
+    threading.Thread(target=initialize_database, daemon=True).start()
+    refresh_requested = asyncio.Event()
+    app.state.refresh_task = asyncio.get_running_loop().create_task(
+        refresh_periodically())
 
 # Define the "averageConcentrations" response Pydantic model
 # (the interest here is on providing a description of what is
@@ -21,20 +131,122 @@ class averageConcentrations(BaseModel):
         calculated for each of the 24 hours of the day (set to 0 when not enough data)\
         with data recorded by the given station over the given period."
     )
+    stats: Optional[dict[str, list[Optional[Union[int, float]]]]] = Field(
+        default=None,
+        description="The requested statistics (see parameter 'stats') of the values \
+        recorded at each of the 24 hours of the day, null for hours without data."
+    )
+
+# Define the "profileMatrix" response Pydantic model of the batch endpoint.
+class profileMatrix(BaseModel):
+    stations: list[str] = Field(
+        description="Codes of the stations, in the order of the rows of 'values'."
+    )
+    pollutants: list[str] = Field(
+        description="Pollutants, in the order of the columns of 'values'."
+    )
+    values: list[list[Optional[list[float]]]] = Field(
+        description="The 24 average values of air concentration of each pollutant\
+        (column) recorded by each station (row) over the given period, or null\
+        when the pollutant is not monitored by the station."
+    )
+
+class responseCache():
+    '''
+    Keep the values of the most recently requested responses, all of them
+    computed with the data of the same update of the database (whose date
+    is given by "version"). The lookups are counted under the label "name".
+    '''
+    def __init__(self, name, size):
+        self.size = size
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = metrics.CACHE_REQUESTS.labels(name, "hit")
+        self.misses = metrics.CACHE_REQUESTS.labels(name, "miss")
+
+    def get(self, key, version):
+        '''
+        Return the values stored for "key", or None if there are none.
+        '''
+        # Drop all the responses once the database has been updated.
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        if key not in self.entries:
+            self.misses.inc()
+            return None
+        self.hits.inc()
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, version, values):
+        '''
+        Store "values" for "key", removing the least recently used
+        response if the cache is full.
+        '''
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        self.entries[key] = values
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+responses = responseCache("responses", CACHE_SIZE)
+renders = responseCache("renders", RENDER_CACHE_SIZE)
 
-# Retrieve all the "LCSQA" station codes (will be used at line 60
-# to verify the existence of the given station).
-url = "https://www.lcsqa.org/system/files/media/documents/"+\
-"Liste points de mesures 2021 pour site LCSQA_27072022.xlsx"
-LCSQA_stations = read_excel(
-    url.replace(" ", "%20"),
-    sheet_name=1
-).iloc[:,0][2:].tolist()
+def cache_headers(key, version):
+    '''
+    Return the headers ("ETag", "Cache-Control", "X-Last-Update" and, if
+    the data are outdated, "Warning") of the response to the query "key"
+    computed with the data of the update "version".
+    '''
+    etag = sha1(repr((key, version)).encode()).hexdigest()
+    headers = {
+        "ETag": '"'+etag+'"',
+        "Cache-Control": "public, max-age="+str(CACHE_MAX_AGE),
+        "X-Last-Update": version.date().isoformat()}
+    if not(is_recent(version)):
+        headers["Warning"] = '110 - "Response is Stale"'
+        # Wake up the task updating the database.
+        refresh_requested.set()
+    return headers
+
+# Retrieve the names of all the "LCSQA" stations (the codes will be used in
+# "check_query" to verify the existence of the given station).
+station_names = {x["Code station"]: x["Nom station"] for x in load_stations()}
+LCSQA_stations = frozenset(station_names)
+
+async def check_query(station, pollutant, n_days):
+    '''
+    Raise the HTTP error explaining why the 24 average values of air
+    concentration of "pollutant" recorded by "station" over the "n_days"
+    last days can not be computed, if so.
+    '''
+    # Notify an error when the given station does not exist.
+    if station not in LCSQA_stations:
+        raise HTTPException(
+            status_code=400,
+            detail="This station does not exist!")
+    # Notify an error when air concentration of the given 
+    # pollutant is not monitored by the given station.
+    if not(await is_monitored_by(pollutant, station)):
+        raise HTTPException(
+            status_code=400,
+            detail="Pollutant not available!")
+    # Notify an error when the given number of days is greater than 180.
+    if int(n_days) not in list(range(181)):
+        raise HTTPException(status_code=400, detail="Number of days too high!")
 
 # Define the only endpoint of the API, that is a "GET" method
 # returning the expected 24 average values of air concentration.
-@app.get("/", response_model=averageConcentrations)
+@app.get(
+    "/",
+    response_model=averageConcentrations,
+    response_model_exclude_none=True)
 async def get_response(
+    request: Request,
+    response: Response,
     station: Annotated[
         str,
         Query(
@@ -56,23 +268,187 @@ async def get_response(
             alias="n",
             description=(
                 "Parameter telling the API that we are interested in\
-                 pollution data recorded over the 'n_days' last days.")
-            pattern="\d+")]):
-    # Notify an error when the given station does not exist.
-    if station not in LCSQA_stations:
-        raise HTTPException(
-            status_code=400,
-            detail="This station does not exist!")
-    # Notify an error when air concentration of the given 
-    # pollutant is not monitored by the given station.
-    if not(is_monitored_by(pollutant, station)):
+                 pollution data recorded over the 'n_days' last days."),
+            pattern=r"^\d+$")],
+    stats: Annotated[
+        Optional[str],
+        Query(
+            description=(
+                "Comma-separated statistics of the values of each hour to\
+                 return besides the averages, among 'mean', 'median', 'max',\
+                 'count' and 'pNN' (NN-th percentile)."),
+            pattern="^"+STATISTIC+"(,"+STATISTIC+")*$")] = None):
+    # Ignore the statistics requested twice.
+    statistics = tuple(dict.fromkeys(stats.split(","))) if stats else ()
+    key = (station, pollutant, int(n_days))+((statistics,) if statistics else ())
+    version = await get_last_update()
+    headers = cache_headers(key, version)
+    # Let the client reuse its own copy of the response if it is still valid.
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        request.state.outcome = "not_modified"
+        return Response(status_code=304, headers=headers)
+    # Return the stored values if the same query has already been answered.
+    content = responses.get(key, version)
+    if content is not None:
+        request.state.outcome = "cached"
+        response.headers.update(headers)
+        return content if statistics else {"values": content}
+    await check_query(station, pollutant, n_days)
+    if statistics:
+        # Compute the averages along with the requested statistics, from
+        # the same values.
+        results = await get_statistics(
+            station, pollutant, int(n_days), ("mean",)+statistics)
+        content = {
+            "values": [x or float(0) for x in results["mean"]],
+            "stats": {x: results[x] for x in statistics}}
+    else:
+        content = await get_values(station, pollutant, int(n_days))
+    request.state.outcome = "computed"
+    responses.put(key, version, content)
+    response.headers.update(headers)
+    return content if statistics else {"values": content}
+
+# Define the batch endpoint, returning the 24 average values of air
+# concentration of several pollutants for several stations at once.
+@app.get("/batch", response_model=profileMatrix)
+async def get_batch_response(
+    request: Request,
+    response: Response,
+    pollutants: Annotated[
+        list[str],
+        Query(
+            alias="p",
+            description="Pollutants whose average daily variation of air\
+             concentration we want to display (may be repeated).")],
+    n_days: Annotated[
+        str,
+        Query(
+            alias="n",
+            description=(
+                "Parameter telling the API that we are interested in\
+                 pollution data recorded over the 'n_days' last days."),
+            pattern=r"^\d+$")],
+    stations: Annotated[
+        Optional[list[str]],
+        Query(
+            alias="s",
+            description="Codes identifying the air quality monitoring\
+             stations whose data we are interested in (may be repeated).")] = None,
+    department: Annotated[
+        Optional[str],
+        Query(
+            alias="d",
+            description="French department whose stations are wanted.")] = None,
+    region: Annotated[
+        Optional[str],
+        Query(
+            alias="r",
+            description="French region whose stations are wanted.")] = None):
+    # Notify an error when no station is given.
+    if not(stations or department or region):
         raise HTTPException(
             status_code=400,
-            detail="Pollutant not available!")
+            detail="No station given!")
     # Notify an error when the given number of days is greater than 180.
     if int(n_days) not in list(range(181)):
         raise HTTPException(status_code=400, detail="Number of days too high!")
-    # Update the database if necessary.
-    if not(history_is_updated):
-        update_database()
-    return {"values": get_values(station, pollutant, int(n_days))}
+    key = (
+        "batch",
+        tuple(stations or ()),
+        department,
+        region,
+        tuple(pollutants),
+        int(n_days))
+    version = await get_last_update()
+    headers = cache_headers(key, version)
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        request.state.outcome = "not_modified"
+        return Response(status_code=304, headers=headers)
+    matrix = responses.get(key, version)
+    request.state.outcome = "cached"
+    if matrix is None:
+        request.state.outcome = "computed"
+        # Gather the stations of the department or region with the
+        # given ones.
+        codes = list(dict.fromkeys(
+            [x for x in stations or [] if x in LCSQA_stations]+
+            (await run_blocking(get_stations, region, department)
+             if department or region else [])))
+        profiles = await get_profiles(codes, pollutants, int(n_days))
+        matrix = {
+            "stations": codes,
+            "pollutants": pollutants,
+            "values": [
+                [profiles.get((station, pollutant)) for pollutant in pollutants]
+                for station in codes]}
+        responses.put(key, version, matrix)
+    response.headers.update(headers)
+    return matrix
+
+# Define the endpoint returning the graph of the 24 average values of air
+# concentration (the same graph being rendered once for all the clients).
+@app.get(
+    "/plot",
+    response_class=Response,
+    responses={200: {"content": {x: {} for x in MEDIA_TYPES.values()}}})
+async def get_plot(
+    request: Request,
+    station: Annotated[
+        str,
+        Query(
+            alias="s",
+            description=(
+                "Code identifying the air quality monitoring station\
+                 whose data we are interested in."),
+            pattern="^FR([0-9]{5}$)")],
+    pollutant: Annotated[
+        str,
+        Query(
+            alias="p",
+            description=(
+                "Pollutant whose average daily variation of air\
+                 concentration we want to display."))],
+    n_days: Annotated[
+        str,
+        Query(
+            alias="n",
+            description=(
+                "Parameter telling the API that we are interested in\
+                 pollution data recorded over the 'n_days' last days."),
+            pattern=r"^\d+$")],
+    format: Annotated[
+        str,
+        Query(
+            alias="f",
+            description="Format of the image ('png' or 'svg').",
+            pattern="^(png|svg)$")] = "png"):
+    key = ("plot", station, pollutant, int(n_days), format)
+    version = await get_last_update()
+    headers = cache_headers(key, version)
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        request.state.outcome = "not_modified"
+        return Response(status_code=304, headers=headers)
+    image = renders.get(key, version)
+    request.state.outcome = "cached"
+    if image is None:
+        request.state.outcome = "computed"
+        await check_query(station, pollutant, n_days)
+        # Notify an error when there is no WHO recommendation to draw.
+        if pollutant not in WHO_recommendation:
+            raise HTTPException(
+                status_code=400,
+                detail="No graph available for this pollutant!")
+        # Reuse the values of the same query if they have been computed.
+        values = responses.get((station, pollutant, int(n_days)), version)
+        if values is None:
+            values = await get_values(station, pollutant, int(n_days))
+            responses.put((station, pollutant, int(n_days)), version, values)
+        image = await run_blocking(
+            plot_variation,
+            station_names.get(station, station),
+            pollutant,
+            values,
+            format)
+        renders.put(key, version, image)
+    return Response(image, media_type=MEDIA_TYPES[format], headers=headers)
@@ -0,0 +1,105 @@
+'''
+Prometheus metrics of the ingestion pipeline ("crud.py" and "celery.py")
+and of the API ("main.py"), exposed by the "/metrics" route of the API and
+pushed by the Celery workers to a Pushgateway (see function "push").
+'''
+import contextvars
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, push_to_gateway
+from prometheus_client import REGISTRY
+from pymongo import monitoring
+
+# Address of the Prometheus Pushgateway receiving the metrics of the
+# Celery workers (nothing is pushed when it is not set).
+PUSHGATEWAY_URL = os.environ.get("PUSHGATEWAY_URL")
+
+# Stages of the ingestion of a pollution day: "cache" (lookup of its file in
+# the local cache), "download", "parse", "cube" (writing into the
+# memory-mapped copy), "insert" (from the removal of the documents left by a
+# previous attempt until all the documents of the day are inserted, possibly
+# by the threads of "bulkWriter") and "write" (insertion of one batch by one
+# of these threads).
+INGESTION_SECONDS = Histogram(
+    "ingestion_stage_seconds",
+    "Duration of each stage of the ingestion of a pollution day.",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+INGESTION_ROWS = Counter(
+    "ingestion_rows",
+    "Number of rows of the daily files parsed and inserted into MongoDB.",
+    ["stage"])
+AGGREGATION_SECONDS = Histogram(
+    "aggregation_seconds",
+    "Duration of the aggregations building or updating the database.",
+    ["step"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+REQUEST_SECONDS = Histogram(
+    "request_seconds",
+    "Time needed to answer a request of the API.",
+    ["endpoint", "outcome"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+REQUEST_ROUND_TRIPS = Histogram(
+    "request_mongo_round_trips",
+    "Number of commands sent to MongoDB to answer a request of the API.",
+    ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+MONGO_COMMANDS = Counter(
+    "mongo_commands",
+    "Number of commands sent to MongoDB.",
+    ["command"])
+CACHE_REQUESTS = Counter(
+    "response_cache_requests",
+    "Number of lookups in the caches of the API (responses or rendered graphs).",
+    ["cache", "result"])
+
+# Number of commands sent to MongoDB by the request being answered (a
+# one-element list, shared by the tasks and threads working for it).
+round_trips = contextvars.ContextVar("round_trips", default=None)
+
+class commandCounter(monitoring.CommandListener):
+    '''
+    Count the commands sent to MongoDB by all the clients, and those sent
+    for the request being answered.
+    '''
+    def started(self, event):
+        MONGO_COMMANDS.labels(event.command_name).inc()
+        counter = round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Listen to the clients created from now on (this module is imported by
+# "crud.py" before it creates its client).
+monitoring.register(commandCounter())
+
+@contextmanager
+def timed(histogram, *labels):
+    '''
+    Observe the duration of the "with" block in "histogram" with the
+    given label values.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter()-start)
+
+def push():
+    '''
+    Send all the metrics of the process to the Pushgateway, if there is one.
+    '''
+    if PUSHGATEWAY_URL:
+        push_to_gateway(
+            PUSHGATEWAY_URL,
+            job="celery",
+            registry=REGISTRY,
+            grouping_key={"instance": socket.gethostname()+":"+str(os.getpid())})
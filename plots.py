@@ -0,0 +1,94 @@
+'''
+Rendering of the graphs of the average daily variation of air
+concentration returned by the "/plot" endpoint of the API.
+'''
+from io import BytesIO
+
+symbol_to_name = {
+    "O3": "ozone",
+    "NO2": "nitrogen dioxide",
+    "SO2": "sulphur dioxide",
+    "PM2.5": "fine particles",
+    "PM10": "particles",
+    "CO": "carbone monoxide"
+}
+
+WHO_recommendation = {
+    pollutant: value for (pollutant, value) in zip(
+        symbol_to_name.keys(),
+        [100,25,40,15,45,4]
+    )
+}
+
+# Media types of the formats of the images.
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+def plot_variation(station, pollutant, values, format="png"):
+    '''
+    Return the image (in the format "format", "png" or "svg") of the graph
+    showing average daily variation (obtained using average concentrations
+    recorded at each of the 24 hours of the day, stored in "values") of air
+    concentration of "pollutant" recorded by "station".
+    '''
+    # Import matplotlib only when the first graph is requested (it takes
+    # about a second), drawing without any display.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(17,14))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.scatter([str(x)+"h00" for x in range(24)], values)
+    # Compute four threshold values based on the corresponding WHO
+    # recommendation (will be used later to split the graph into
+    # colored zones, improving readibility and understanding of the
+    # displayed pollution data).
+    thresholds = [
+        (x/3)*WHO_recommendation[pollutant]
+        for x in range(1,5)]
+    ax.plot(
+        range(24),
+        [thresholds[2]]*24,
+        color="blueviolet",
+        ls="--",
+        lw=1.7,
+        label="Average daily air\nconcentration\nrecommended by WHO")
+    # Determine the maximum value to consider for the Y-axis in order
+    # to avoid scaling issues which could affect readibility of the
+    # displayed data.
+    highest_value = max(values)
+    max_level = 2
+    while (max_level < 3 and thresholds[max_level] < highest_value):
+        max_level += 1
+    space = (0.40)*thresholds[0]
+    lim = thresholds[max_level] if max_level == 2 else highest_value
+    ax.set_ylim(0,lim+(space if max_level == 2 else 0))
+    # Split the graph into four colored zones.
+    colors = ["limegreen","yellow","orange","red"]
+    y_min = 0
+    for j in list(range(max_level+1)):
+        ax.fill_between(
+            list(range(24)),
+            thresholds[j],
+            y2=y_min,
+            color=colors[j],
+            alpha=0.1)
+        y_min = thresholds[j]
+    # Add a fifth zone if one or several values are above the highest
+    # set threshold.
+    if highest_value > thresholds[max_level]:
+        ax.fill_between(
+            list(range(24)),
+            ax.get_ylim()[1],
+            y2=thresholds[max_level],
+            color="magenta",
+            alpha=0.1)
+    ax.set_yticks([0])
+    ax.set_yticklabels([" "])
+    ax.legend(loc="upper right")
+    ax.set_title(
+        "Average daily "+symbol_to_name[pollutant]+" pollution\n\
+        recorded at :\n"+station,
+        ha="center")
+    image = BytesIO()
+    fig.savefig(image, format=format)
+    return image.getvalue()
@@ -0,0 +1,25 @@
+'''
+Make the modules of the repository importable as the "webApplication"
+package (the name of its folder in the Docker image), so that the tests
+can be run from a checkout with any folder name. The packages needed by
+the tests are listed in "requirements-test.txt".
+'''
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules of the package must not be imported as top-level modules
+# when the tests are run from its folder ("celery.py" would hide the
+# "celery" package).
+sys.path[:] = [x for x in sys.path if os.path.abspath(x or os.curdir) != ROOT]
+
+if "webApplication" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "webApplication",
+        os.path.join(ROOT, "__init__.py"),
+        submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["webApplication"] = package
+    spec.loader.exec_module(package)
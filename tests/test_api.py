@@ -0,0 +1,148 @@
+'''
+Tests of the endpoints of the API, run against the in-process stand-ins of
+the "mongomock" and "mongomock_motor" packages.
+'''
+from datetime import timedelta
+
+import pytest
+
+from webApplication import async_crud, benchmark, crud
+
+mongomock = pytest.importorskip("mongomock")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+testclient = pytest.importorskip("fastapi.testclient")
+
+from webApplication import main
+
+STATIONS = ["FR10000", "FR10001"]
+
+@pytest.fixture
+def client(monkeypatch):
+    '''
+    Return a client of the API reading synthetic histories of the stations
+    "STATIONS", located in the department "Moselle" of the region "GRAND
+    EST", both clients of MongoDB sharing the same data.
+    '''
+    mongoClient = mongomock.MongoClient()
+    monkeypatch.setattr(crud, "database", mongoClient["air_quality"])
+    monkeypatch.setattr(
+        async_crud,
+        "database",
+        mongomock_motor.AsyncMongoMockClient(
+            mock_mongo_client=mongoClient)["air_quality"])
+    monkeypatch.setattr(crud, "catalogue", {"version": None, "pollutants": {}})
+    benchmark.store_synthetic_history(len(STATIONS), n_days=10)
+    benchmark.publish_synthetic_history()
+    crud.database["distribution_pollutants"].insert_many([
+        {"_id": STATIONS[0], "monitored_pollutants": ["O3", "NO2"]},
+        {"_id": STATIONS[1], "monitored_pollutants": ["O3"]}])
+    crud.database["regions"].insert_one(
+        {"_id": "GRAND EST", "departments": ["Moselle"]})
+    crud.database["departments"].insert_one(
+        {"_id": "Moselle", "cities": ["METZ", "THIONVILLE"]})
+    crud.database["cities"].insert_many([
+        {"_id": "METZ", "stations": [{"code": STATIONS[0]}]},
+        {"_id": "THIONVILLE", "stations": [{"code": STATIONS[1]}]}])
+    # Neither create nor update the database when the server starts.
+    monkeypatch.setattr(main, "initialize_database", lambda: None)
+    monkeypatch.setattr(main, "refresh_database", lambda: None)
+    monkeypatch.setattr(main, "LCSQA_stations", frozenset(STATIONS))
+    monkeypatch.setattr(main, "responses", main.responseCache("responses", 16))
+    monkeypatch.setattr(main, "renders", main.responseCache("renders", 16))
+    with testclient.TestClient(main.app) as client:
+        yield client
+
+def test_get_stations(client):
+    assert crud.get_stations(department="Moselle") == STATIONS
+    assert crud.get_stations(region="GRAND EST") == STATIONS
+    assert crud.get_stations(region="BRETAGNE") == []
+
+def test_batch_of_a_region(client):
+    response = client.get(
+        "/batch", params={"r": "GRAND EST", "p": ["O3", "NO2"], "n": "7"})
+    assert response.status_code == 200
+    matrix = response.json()
+    assert matrix["stations"] == STATIONS
+    assert matrix["pollutants"] == ["O3", "NO2"]
+    # The second station does not monitor NO2.
+    assert matrix["values"][1][1] is None
+    for station, row in zip(STATIONS, matrix["values"]):
+        assert row[0] == pytest.approx(crud.get_values(station, "O3", 7))
+
+def test_batch_merges_the_stations(client):
+    response = client.get(
+        "/batch",
+        params={"s": [STATIONS[1], "FR99999"], "d": "Moselle", "p": "O3", "n": "3"})
+    # The unknown stations are ignored, and each station is given once.
+    assert response.json()["stations"] == [STATIONS[1], STATIONS[0]]
+
+def test_batch_without_stations(client):
+    response = client.get("/batch", params={"p": "O3", "n": "7"})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("path", ["/", "/batch", "/plot"])
+@pytest.mark.parametrize("n_days", ["abc7", "7abc", "-1", ""])
+def test_invalid_number_of_days(client, path, n_days):
+    response = client.get(
+        path, params={"s": STATIONS[0], "p": "O3", "n": n_days})
+    assert response.status_code == 422
+
+@pytest.mark.parametrize("path", ["/", "/batch"])
+def test_number_of_days_too_high(client, path):
+    response = client.get(path, params={"s": STATIONS[0], "p": "O3", "n": "181"})
+    assert response.status_code == 400
+
+def test_response_cache():
+    cache = main.responseCache("responses", 2)
+    cache.put("a", 1, [1.0])
+    cache.put("b", 1, [2.0])
+    assert cache.get("a", 1) == [1.0]
+    # The least recently used response is removed.
+    cache.put("c", 1, [3.0])
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == [1.0]
+    # All the responses are removed once the database has been updated.
+    assert cache.get("c", 2) is None
+    assert cache.get("a", 2) is None
+
+def test_same_query_is_answered_from_the_cache(client, monkeypatch):
+    params = {"s": STATIONS[0], "p": "O3", "n": "7"}
+    values = client.get("/", params=params).json()
+    calls = []
+    monkeypatch.setattr(main, "get_values", lambda *x: calls.append(x))
+    assert client.get("/", params=params).json() == values
+    assert calls == []
+
+def test_not_modified(client):
+    params = {"s": STATIONS[0], "p": "O3", "n": "7"}
+    response = client.get("/", params=params)
+    etag = response.headers["ETag"]
+    assert response.headers["X-Last-Update"] == \
+    crud.get_last_update().date().isoformat()
+    assert "max-age" in response.headers["Cache-Control"]
+    response = client.get("/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+    # Another query has another tag.
+    response = client.get(
+        "/", params={**params, "n": "8"}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_tags_change_with_the_update(client, monkeypatch):
+    params = {"s": STATIONS[0], "p": "O3", "n": "7"}
+    etag = client.get("/", params=params).headers["ETag"]
+    last_update = crud.get_last_update()
+    monkeypatch.setitem(crud.known_update, "date", last_update-timedelta(days=1))
+    response = client.get("/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    # The data of the day before yesterday are outdated.
+    assert "Warning" in response.headers
+
+@pytest.mark.parametrize("path", ["/batch", "/plot"])
+def test_not_modified_batch_and_plot(client, path):
+    params = {"s": STATIONS[0], "p": "O3", "n": "7"}
+    etag = client.get(path, params=params).headers["ETag"]
+    response = client.get(path, params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
@@ -0,0 +1,98 @@
+'''
+Tests of the asynchronous functions of "async_crud.py", which must give the
+same results as those of "crud.py" in every layout of the database, run
+against the in-process stand-ins of the "mongomock" and "mongomock_motor"
+packages.
+'''
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from webApplication import async_crud, benchmark, crud
+from webApplication.cube import hourlyCube
+
+mongomock = pytest.importorskip("mongomock")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+STATIONS = ["FR10000", "FR10001"]
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    '''
+    Fill both clients of MongoDB with the same synthetic histories of the
+    stations "STATIONS".
+    '''
+    mongoClient = mongomock.MongoClient()
+    monkeypatch.setattr(crud, "database", mongoClient["air_quality"])
+    monkeypatch.setattr(
+        async_crud,
+        "database",
+        mongomock_motor.AsyncMongoMockClient(
+            mock_mongo_client=mongoClient)["air_quality"])
+    monkeypatch.setattr(crud, "catalogue", {"version": None, "pollutants": {}})
+    monkeypatch.setattr(crud, "cube", None)
+    benchmark.store_synthetic_history(len(STATIONS), n_days=10)
+    benchmark.publish_synthetic_history()
+    crud.database["distribution_pollutants"].insert_many([
+        {"_id": STATIONS[0], "monitored_pollutants": ["O3", "NO2"]},
+        {"_id": STATIONS[1], "monitored_pollutants": ["O3"]}])
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+@pytest.fixture(params=["arrays", "timeseries", "cube"])
+def layout(request, monkeypatch, tmp_path):
+    '''
+    Read the data from the ring buffers, from the readings of the
+    "timeseries" layout or from the memory-mapped copy.
+    '''
+    if request.param == "timeseries":
+        # The readings are stored in a plain collection ("mongomock" does
+        # not create time-series collections).
+        monkeypatch.setattr(crud, "create_readings", lambda: None)
+        benchmark.store_synthetic_readings()
+        monkeypatch.setattr(crud, "TIMESERIES", True)
+    elif request.param == "cube":
+        monkeypatch.setattr(crud, "cube", hourlyCube(str(tmp_path)))
+        crud.backfill_cube()
+        assert crud.cube_covers(crud.get_last_update()+timedelta(days=1))
+    return request.param
+
+# The averages of the "timeseries" layout are computed by operators of
+# MongoDB which are not implemented by "mongomock" (see function
+# "profiles_pipeline" of "crud.py").
+averages = pytest.mark.parametrize("layout", ["arrays", "cube"], indirect=True)
+
+@averages
+@pytest.mark.parametrize("n_days", [0, 1, 7, 30])
+def test_get_values(layout, n_days):
+    values = crud.get_values(STATIONS[0], "O3", n_days)
+    assert len(values) == 24
+    assert run(async_crud.get_values(STATIONS[0], "O3", n_days)) == values
+
+@averages
+@pytest.mark.parametrize("n_days", [0, 7])
+def test_get_profiles(layout, n_days):
+    profiles = crud.get_profiles(STATIONS+["FR99999"], ["O3", "NO2"], n_days)
+    # Only the monitored pollutants are given.
+    assert set(profiles) == {
+        (STATIONS[0], "O3"), (STATIONS[0], "NO2"), (STATIONS[1], "O3")}
+    assert profiles[(STATIONS[1], "O3")] == \
+    crud.get_values(STATIONS[1], "O3", n_days)
+    assert run(async_crud.get_profiles(
+        STATIONS+["FR99999"], ["O3", "NO2"], n_days)) == profiles
+
+def test_get_statistics(layout):
+    statistics = crud.get_statistics(STATIONS[0], "O3", 7, ["mean", "count"])
+    assert sum(statistics["count"]) > 0
+    assert run(async_crud.get_statistics(
+        STATIONS[0], "O3", 7, ["mean", "count"])) == statistics
+
+def test_get_last_update_without_database(monkeypatch):
+    crud.database["last_update"].drop()
+    monkeypatch.setitem(crud.known_update, "date", None)
+    with pytest.raises(crud.databaseNotReady):
+        crud.get_last_update()
+    with pytest.raises(crud.databaseNotReady):
+        run(async_crud.get_last_update())
@@ -0,0 +1,74 @@
+'''
+Tests of the catalogue of the pollutants monitored by each station.
+'''
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from webApplication import async_crud, benchmark, crud
+
+mongomock = pytest.importorskip("mongomock")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    mongoClient = mongomock.MongoClient()
+    monkeypatch.setattr(crud, "database", mongoClient["air_quality"])
+    monkeypatch.setattr(
+        async_crud,
+        "database",
+        mongomock_motor.AsyncMongoMockClient(
+            mock_mongo_client=mongoClient)["air_quality"])
+    monkeypatch.setattr(crud, "catalogue", {"version": None, "pollutants": {}})
+    benchmark.publish_synthetic_history()
+    crud.database["distribution_pollutants"].insert_many([
+        {"_id": "FR10000", "monitored_pollutants": ["O3", "NO2", "O3"]},
+        {"_id": "FR10001", "monitored_pollutants": []}])
+
+@pytest.fixture
+def loads(monkeypatch):
+    '''
+    Return the list of the versions of the catalogue loaded from the
+    database.
+    '''
+    loads = []
+    set_catalogue = crud.set_catalogue
+    def counted(version, documents):
+        loads.append(version)
+        set_catalogue(version, documents)
+    monkeypatch.setattr(crud, "set_catalogue", counted)
+    return loads
+
+def test_is_monitored_by(loads):
+    assert crud.is_monitored_by("O3", "FR10000")
+    assert crud.is_monitored_by("NO2", "FR10000")
+    assert not(crud.is_monitored_by("SO2", "FR10000"))
+    assert not(crud.is_monitored_by("O3", "FR10001"))
+    assert not(crud.is_monitored_by("O3", "FR99999"))
+    # The catalogue is read once.
+    assert loads == [crud.get_last_update()]
+    assert crud.catalogue["pollutants"]["FR10000"] == frozenset(["O3", "NO2"])
+
+def test_catalogue_is_loaded_again_after_an_update(loads, monkeypatch):
+    assert not(crud.is_monitored_by("SO2", "FR10000"))
+    crud.database["distribution_pollutants"].update_one(
+        {"_id": "FR10000"}, {"$push": {"monitored_pollutants": "SO2"}})
+    # The previous catalogue is used until the database is updated.
+    assert not(crud.is_monitored_by("SO2", "FR10000"))
+    last_update = crud.get_last_update()+timedelta(days=1)
+    monkeypatch.setitem(crud.known_update, "date", last_update)
+    assert crud.is_monitored_by("SO2", "FR10000")
+    assert loads == [last_update-timedelta(days=1), last_update]
+
+def test_asynchronous_is_monitored_by(loads):
+    async def lookups():
+        return [
+            await async_crud.is_monitored_by(pollutant, station)
+            for station, pollutant in [
+                ("FR10000", "O3"), ("FR10000", "SO2"), ("FR10001", "O3")]]
+    assert asyncio.run(lookups()) == [True, False, False]
+    assert len(loads) == 1
+    # Both versions share the same catalogue.
+    assert crud.is_monitored_by("NO2", "FR10000")
+    assert len(loads) == 1
@@ -0,0 +1,88 @@
+'''
+Tests of the tasks of "celery.py", run in the calling process (see
+"CELERY_ALWAYS_EAGER") against a local HTTP server serving synthetic files
+and the in-process stand-in of the "mongomock" package.
+'''
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+
+# The tasks must run in the calling process, without any server.
+os.environ.setdefault("CELERY_ALWAYS_EAGER", "1")
+os.environ.setdefault("CELERY_BROKER_URL", "memory://")
+os.environ.setdefault("CELERY_RESULT_BACKEND", "cache+memory://")
+
+from webApplication import benchmark, crud
+from webApplication.cube import hourlyCube
+
+mongomock = pytest.importorskip("mongomock")
+tasks = pytest.importorskip("webApplication.celery")
+
+DATES = [date.today()-timedelta(days=n) for n in range(3,0,-1)]
+
+@pytest.fixture
+def updates(tmp_path, monkeypatch):
+    '''
+    Serve the files of the days "DATES" missing from the database and
+    return the list of the lists of days given to "finish_update" ("mongomock"
+    not implementing the aggregations it runs).
+    '''
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+    DATE = DATES[0]-timedelta(days=1)
+    crud.database["last_update"].insert_one(
+        {"date": datetime(DATE.year, DATE.month, DATE.day)})
+    benchmark.write_fixtures(str(tmp_path/"files"), DATES, n_stations=2)
+    server, url = benchmark.serve(str(tmp_path/"files"))
+    monkeypatch.setattr(crud, "LCSQA_URL", url)
+    monkeypatch.setattr(crud, "CACHE_DIRECTORY", str(tmp_path/"cache"))
+    monkeypatch.setattr(crud, "cube", None)
+    updates = []
+    monkeypatch.setattr(
+        crud,
+        "finish_update",
+        lambda days: updates.append(days) or {"documents": 0, "bytes": 0})
+    yield updates
+    server.shutdown()
+
+def stored_days():
+    return sorted({
+        document["dateTime"].date()
+        for document in crud.database["new_data"].find({}, {"dateTime": 1})})
+
+def test_refresh_database(updates):
+    assert tasks.refresh_database.delay().get() is not None
+    # The final task runs once all the days are stored.
+    assert updates == [DATES]
+    assert stored_days() == DATES
+    assert all(
+        entry["status"] == "complete"
+        for entry in crud.manifest_entries("new_data").values())
+    # The lock has been released by the final task.
+    assert crud.acquire_lock("refresh", "another process")
+
+def test_refresh_database_stores_the_days_once(updates):
+    tasks.refresh_database.delay().get()
+    count = crud.database["new_data"].count_documents({})
+    # Only the last days are read again, and stored again if their file
+    # has changed.
+    tasks.refresh_database.delay().get()
+    assert updates == [DATES, DATES]
+    assert crud.database["new_data"].count_documents({}) == count
+
+def test_refresh_database_while_another_process_updates(updates):
+    assert crud.acquire_lock("refresh", "another process")
+    assert tasks.refresh_database.delay().get() is None
+    assert updates == []
+
+def test_final_task_writes_the_days_in_order(updates, tmp_path, monkeypatch):
+    monkeypatch.setattr(crud, "cube", hourlyCube(str(tmp_path/"cube")))
+    written = []
+    write_day = crud.cube.write_day
+    monkeypatch.setattr(
+        crud.cube,
+        "write_day",
+        lambda DATE, data: written.append(DATE) or write_day(DATE, data))
+    tasks.refresh_database.delay().get()
+    assert written == DATES
+    assert crud.cube.end == DATES[-1]+timedelta(days=1)
@@ -0,0 +1,49 @@
+'''
+Tests of the menus of the command-line client ("daily_pollution.py"),
+built from the navigation tree of the real list of stations.
+'''
+import pytest
+
+from webApplication import crud
+
+mongomock = pytest.importorskip("mongomock")
+daily_pollution = pytest.importorskip("webApplication.daily_pollution")
+
+@pytest.fixture(autouse=True)
+def tree(monkeypatch):
+    database = mongomock.MongoClient()["air_quality"]
+    monkeypatch.setattr(crud, "database", database)
+    crud.create_locations()
+    tree = {
+        "regions": {x["_id"]: x["departments"] for x in database["regions"].find()},
+        "departments": {x["_id"]: x["cities"] for x in database["departments"].find()},
+        "cities": {
+            x["_id"]: [[e["name"], e["code"]] for e in x["stations"]]
+            for x in database["cities"].find()},
+        "pollutants": {}}
+    monkeypatch.setattr(daily_pollution, "catalogue", tree)
+    return tree
+
+def names(items):
+    return [name for name, _ in items]
+
+def test_regions_group_the_overseas_regions():
+    items = daily_pollution.get_items("regions", {})
+    assert items[-1] == ("OUTRE-MER", len(items))
+    assert "GUADELOUPE" not in names(items)
+    assert [position for _, position in items] == list(range(1, len(items)+1))
+
+def test_overseas_stations_can_be_reached():
+    departments = names(daily_pollution.get_items("departments", {"_id": "OUTRE-MER"}))
+    assert "Guadeloupe" in departments and "La Réunion" in departments
+    for department in departments:
+        cities = names(daily_pollution.get_items("cities", {"_id": department}))
+        assert cities
+        stations = names(daily_pollution.get_items("stations", {"_id": cities[0]}))
+        assert all("#FR" in station for station in stations)
+
+def test_departments_of_a_region():
+    departments = names(daily_pollution.get_items("departments", {"_id": "GRAND EST"}))
+    assert "Moselle" in departments
+    cities = names(daily_pollution.get_items("cities", {"_id": "Moselle"}))
+    assert "METZ" in cities
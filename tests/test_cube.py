@@ -0,0 +1,104 @@
+'''
+Tests of the memory-mapped copy of the hourly data (see "cube.py").
+'''
+from datetime import date, timedelta
+
+import numpy
+import pandas
+import pytest
+
+from webApplication import benchmark, crud
+from webApplication.cube import N_DAYS, hourlyCube
+
+END = date(2024, 3, 1)
+
+def day(rows):
+    '''
+    Return the dataframe of the given (station, pollutant, hour, value)
+    rows, in the format of function "parse_day" of "crud.py".
+    '''
+    return pandas.DataFrame(
+        rows, columns=["code site", "Polluant", "hour", "valeur brute"])
+
+@pytest.fixture
+def cube(tmp_path):
+    return hourlyCube(str(tmp_path))
+
+def test_write_day(cube):
+    cube.write_day(END-timedelta(days=1), day([
+        ("FR10000", "O3", 3, 2.0),
+        ("FR10000", "O3", 3, 4.0),
+        ("FR10001", "NO2", 5, 7.0)]))
+    values = cube.get_values("FR10000", "O3", 1, END)
+    # Several values of the same hour are averaged.
+    assert values[3] == 3.0
+    assert values[:3] == [float(0)]*3
+    assert cube.get_values("FR10001", "NO2", 7, END)[5] == 7.0
+    assert cube.get_values("FR10001", "O3", 7, END) == [float(0)]*24
+    assert cube.get_values("FR99999", "O3", 7, END) == [float(0)]*24
+
+def test_write_day_keeps_the_previous_days(cube):
+    cube.write_day(END-timedelta(days=2), day([("FR10000", "O3", 0, 2.0)]))
+    # New stations and pollutants are added to the array.
+    cube.write_day(END-timedelta(days=1), day([
+        ("FR10000", "O3", 0, 4.0), ("FR10001", "SO2", 0, 1.0)]))
+    assert cube.matrix("FR10000", "O3", 2, END)[:, 0].tolist() == [2.0, 4.0]
+    assert cube.get_values("FR10000", "O3", 1, END)[0] == 4.0
+
+def test_write_day_empties_the_skipped_days(cube):
+    cube.write_day(END-timedelta(days=N_DAYS+2), day([("FR10000", "O3", 0, 2.0)]))
+    cube.write_day(END-timedelta(days=2), day([("FR10000", "O3", 0, 4.0)]))
+    # The day N_DAYS days before shares the position of the new day, and
+    # the days in between are empty.
+    assert cube.get_values("FR10000", "O3", N_DAYS, END)[0] == 4.0
+    cube.write_day(END-timedelta(days=1), day([("FR10000", "O3", 1, 1.0)]))
+    matrix = cube.matrix("FR10000", "O3", N_DAYS, END)
+    assert numpy.count_nonzero(~numpy.isnan(matrix)) == 2
+
+def test_another_process_sees_the_new_days(cube, tmp_path):
+    reader = hourlyCube(str(tmp_path))
+    assert reader.get_values("FR10000", "O3", 7, END) == [float(0)]*24
+    cube.write_day(END-timedelta(days=1), day([("FR10000", "O3", 0, 2.0)]))
+    assert reader.get_values("FR10000", "O3", 7, END)[0] == 2.0
+
+def test_covers(cube):
+    cube.write_day(END-timedelta(days=1), day([("FR10000", "O3", 0, 2.0)]))
+    # A single day is not enough to answer the requests.
+    assert not(cube.covers(END))
+    matrix = numpy.full((N_DAYS, 24), numpy.nan, dtype=numpy.float32)
+    matrix[:, 0] = numpy.arange(N_DAYS)
+    cube.write_days(END, {("FR10000", "O3"): matrix})
+    assert cube.covers(END)
+    assert not(cube.covers(END+timedelta(days=1)))
+    assert not(cube.covers(END-timedelta(days=2)))
+    # The next day keeps the array usable until the next update.
+    cube.write_day(END, day([("FR10000", "O3", 0, 2.0)]))
+    assert cube.covers(END) and cube.covers(END+timedelta(days=1))
+
+def test_write_days(cube):
+    matrix = numpy.full((N_DAYS, 24), numpy.nan, dtype=numpy.float32)
+    matrix[:, 4] = numpy.arange(N_DAYS)
+    cube.write_days(END, {("FR10000", "O3"): matrix})
+    assert cube.matrix("FR10000", "O3", 3, END)[:, 4].tolist() == \
+    [N_DAYS-3, N_DAYS-2, N_DAYS-1]
+    assert cube.get_values("FR10000", "O3", 2, END)[4] == N_DAYS-1.5
+
+def test_backfill_cube(cube, monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+    monkeypatch.setattr(crud, "catalogue", {"version": None, "pollutants": {}})
+    benchmark.store_synthetic_history(2, pollutants=["O3", "NO2"])
+    benchmark.publish_synthetic_history()
+    for i in range(2):
+        crud.database["distribution_pollutants"].insert_one(
+            {"_id": "FR"+str(10000+i), "monitored_pollutants": ["O3", "NO2"]})
+    expected = {
+        n_days: crud.get_statistics("FR10001", "NO2", n_days, ["mean", "count"])
+        for n_days in [1, 7, 180]}
+    monkeypatch.setattr(crud, "cube", cube)
+    crud.backfill_cube()
+    assert crud.cube_covers(crud.get_last_update()+timedelta(days=1))
+    for n_days, statistics in expected.items():
+        results = crud.get_statistics("FR10001", "NO2", n_days, ["mean", "count"])
+        assert results["count"] == statistics["count"]
+        assert results["mean"] == pytest.approx(statistics["mean"])
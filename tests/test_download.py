@@ -0,0 +1,74 @@
+'''
+Tests of the download of the daily files and of their local cache, against
+a local HTTP server serving synthetic files (see "benchmark.py").
+'''
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from webApplication import benchmark, crud
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    '''
+    Serve the synthetic files of the last 5 days and point the downloads
+    and the cache of "crud.py" to them. Return the list of the days.
+    '''
+    dates = [date.today()-timedelta(days=n) for n in range(5,0,-1)]
+    benchmark.write_fixtures(str(tmp_path/"files"), dates, n_stations=2)
+    server, url = benchmark.serve(str(tmp_path/"files"))
+    monkeypatch.setattr(crud, "LCSQA_URL", url)
+    monkeypatch.setattr(crud, "CACHE_DIRECTORY", str(tmp_path/"cache"))
+    yield dates
+    server.shutdown()
+
+def test_fetch_days_keeps_the_order_of_the_days(server):
+    fetched = list(crud.fetch_days(server, workers=3))
+    assert [DATE for DATE, _ in fetched] == server
+    for DATE, content in fetched:
+        assert content == benchmark.synthetic_day(DATE, n_stations=2)
+
+def test_fetch_days_caches_the_complete_days_only(server):
+    list(crud.fetch_days(server))
+    # The file of yesterday may still be completed by the LCSQA.
+    assert crud.read_cache(server[-1]) is None
+    for DATE in server[:-1]:
+        assert crud.read_cache(DATE) == benchmark.synthetic_day(DATE, n_stations=2)
+        assert crud.cached_digest(DATE) is not None
+
+def test_fetch_days_reads_the_cache(server, monkeypatch):
+    list(crud.fetch_days(server))
+    # Make the downloads fail: the files of the cached days are still read.
+    monkeypatch.setattr(crud, "LCSQA_URL", "http://127.0.0.1:1/")
+    fetched = list(crud.fetch_days(server[:-1]))
+    assert [DATE for DATE, _ in fetched] == server[:-1]
+
+def test_read_cache_ignores_missing_and_damaged_files(server):
+    assert crud.read_cache(server[0]) is None
+    list(crud.fetch_days(server))
+    digest = crud.cached_digest(server[0])
+    with open(os.path.join(crud.CACHE_DIRECTORY, "objects", digest), "ab") as f:
+        f.write(b"damaged")
+    assert crud.read_cache(server[0]) is None
+    assert crud.read_cache(server[1]) is not None
+
+def test_fetch_days_with_identical_files(server, tmp_path):
+    # Files without any data have the same content, and so the same object
+    # in the cache, written by several threads at once.
+    for DATE in server:
+        with open(tmp_path/"files"/str(DATE.year)/("FR_E2_"+DATE.isoformat()+".csv"), "wb") as f:
+            f.write(b"header only\n")
+    for _ in range(5):
+        fetched = list(crud.fetch_days(server, workers=len(server)))
+        assert [content for _, content in fetched] == [b"header only\n"]*len(server)
+    objects = os.listdir(os.path.join(crud.CACHE_DIRECTORY, "objects"))
+    assert len(objects) == 1
+
+def test_write_cache_keeps_existing_objects(server):
+    crud.write_cache(server[0], b"content")
+    path = os.path.join(crud.CACHE_DIRECTORY, "objects", crud.cached_digest(server[0]))
+    inode = os.stat(path).st_ino
+    crud.write_cache(server[1], b"content")
+    assert os.stat(path).st_ino == inode
+    assert crud.read_cache(server[1]) == b"content"
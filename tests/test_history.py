@@ -0,0 +1,91 @@
+'''
+Tests of the ring buffers storing the histories of "LCSQA_data".
+'''
+from datetime import datetime, timedelta
+
+import numpy
+import pytest
+from bson import Binary
+
+from webApplication import crud
+
+END = datetime(2024, 3, 1)
+
+def history_of(days, end=END):
+    '''
+    Return the ring buffer whose value for each of the given days before
+    "end" is the number of days between the day and "end".
+    '''
+    days = numpy.arange(end.toordinal()-days, end.toordinal())
+    return crud.encode_history(end.toordinal()-days, days, end)
+
+def test_encode_history_has_a_fixed_size():
+    assert len(history_of(3)["values"]) == 4*crud.HISTORY_DAYS
+    assert len(history_of(400)["values"]) == 4*crud.HISTORY_DAYS
+
+def test_history_window_returns_the_days_in_order():
+    window = crud.history_window(history_of(10), 5, END)
+    assert window.tolist() == [5, 4, 3, 2, 1]
+
+def test_history_window_marks_the_missing_days():
+    window = crud.history_window(history_of(2), 4, END)
+    assert numpy.isnan(window[:2]).all()
+    assert window[2:].tolist() == [2, 1]
+
+def test_history_window_ignores_the_overwritten_days():
+    # The day "HISTORY_DAYS" days before the end shares its slot with the
+    # last stored day.
+    window = crud.history_window(history_of(crud.HISTORY_DAYS), 200, END)
+    assert numpy.isnan(window[:200-crud.HISTORY_DAYS]).all()
+    assert not(numpy.isnan(window[200-crud.HISTORY_DAYS:]).any())
+
+def test_previous_window_survives_a_rollover():
+    # Add the following day to a full history: the 180 days read by the
+    # previous version of the database must still be there.
+    values, days = crud.decode_history(history_of(crud.HISTORY_DAYS))
+    following_day = END.toordinal()
+    history = crud.encode_history(
+        numpy.append(values, -1), numpy.append(days, following_day),
+        END+timedelta(days=1))
+    previous = crud.history_window(history, 180, END)
+    assert previous.tolist() == list(range(180,0,-1))
+    assert crud.history_window(history, 1, END+timedelta(days=1)).tolist() == [-1]
+
+def test_history_window_reads_histories_of_another_size():
+    days = numpy.arange(END.toordinal()-180, END.toordinal())
+    slots = numpy.full(180, numpy.nan, dtype="<f4")
+    slots[days % 180] = END.toordinal()-days
+    history = {"end": END, "values": Binary(slots.tobytes())}
+    assert crud.history_window(history, 180, END).tolist() == list(range(180,0,-1))
+    values, decoded_days = crud.decode_history(history)
+    assert decoded_days.tolist() == days.tolist()
+
+def test_decode_history_skips_the_missing_days():
+    history = crud.encode_history([1.5, 2.5], [END.toordinal()-9, END.toordinal()-2], END)
+    values, days = crud.decode_history(history)
+    assert values.tolist() == [1.5, 2.5]
+    assert days.tolist() == [END.toordinal()-9, END.toordinal()-2]
+
+@pytest.mark.parametrize("n_days", [0, 1, 7, 180, 181, 400])
+@pytest.mark.parametrize("shift", [-200, -3, 0, 2, 200])
+def test_history_sum_matches_the_window(n_days, shift):
+    generator = numpy.random.default_rng(n_days)
+    days = numpy.arange(END.toordinal()-crud.HISTORY_DAYS, END.toordinal())
+    kept = generator.random(len(days)) < 0.8
+    history = crud.encode_history(
+        generator.uniform(0, 60, kept.sum()), days[kept], END)
+    total, count = crud.history_sum(history, n_days, END+timedelta(days=shift))
+    window = crud.history_window(history, n_days, END+timedelta(days=shift))
+    assert count == numpy.count_nonzero(~numpy.isnan(window))
+    assert total == pytest.approx(numpy.nansum(window, dtype=numpy.float64))
+
+def test_history_averages_without_cumulative_sums():
+    documents = []
+    for hour in range(3):
+        history = history_of(10)
+        documents.append({"_id": {"hour": hour}, "history": history})
+    # Histories written before the cumulative sums were stored.
+    del documents[0]["history"]["sums"], documents[0]["history"]["counts"]
+    averages = crud.history_averages(documents, 4, END)
+    assert averages[:3] == [2.5, 2.5, 2.5]
+    assert averages[3:] == [float(0)]*21
@@ -0,0 +1,75 @@
+'''
+Tests of the locks making a single process update the database, run
+against the in-process stand-in of the "mongomock" package.
+'''
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from webApplication import crud
+
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+
+def test_acquire_lock():
+    assert crud.acquire_lock("refresh", "a")
+    assert not(crud.acquire_lock("refresh", "b"))
+    # The owner can not take its own lock again either.
+    assert not(crud.acquire_lock("refresh", "a"))
+    # Other locks are independent.
+    assert crud.acquire_lock("cube", "b")
+
+def test_release_lock():
+    assert crud.acquire_lock("refresh", "a")
+    # Only the owner releases the lock.
+    crud.release_lock("refresh", "b")
+    assert not(crud.acquire_lock("refresh", "b"))
+    crud.release_lock("refresh", "a")
+    assert crud.acquire_lock("refresh", "b")
+
+def test_expired_lock_is_taken():
+    assert crud.acquire_lock("refresh", "a", lease=-1)
+    assert crud.acquire_lock("refresh", "b")
+    # The previous owner does not release the lock of the new one.
+    crud.release_lock("refresh", "a")
+    assert not(crud.acquire_lock("refresh", "a"))
+
+@pytest.fixture
+def updates(monkeypatch):
+    '''
+    Store an outdated date of the last update and return the list of the
+    updates performed.
+    '''
+    DATE = date.today()-timedelta(days=3)
+    crud.database["last_update"].insert_one(
+        {"date": datetime(DATE.year, DATE.month, DATE.day)})
+    updates = []
+    monkeypatch.setattr(
+        crud, "update_database", lambda: updates.append(1) or {"documents": 0})
+    return updates
+
+def test_refresh_database(updates):
+    assert crud.refresh_database() == {"documents": 0}
+    assert updates == [1]
+    # The lock is released once the update is done.
+    assert crud.acquire_lock("refresh", "a")
+
+def test_refresh_database_while_another_process_updates(updates):
+    assert crud.acquire_lock("refresh", "another process")
+    assert crud.refresh_database() is None
+    assert updates == []
+
+def test_refresh_database_when_up_to_date(updates):
+    DATE = date.today()-timedelta(days=1)
+    crud.database["last_update"].replace_one(
+        {}, {"date": datetime(DATE.year, DATE.month, DATE.day)})
+    assert crud.refresh_database() is None
+    assert updates == []
+
+def test_refresh_database_before_the_creation(updates):
+    crud.database.drop_collection("last_update")
+    assert crud.refresh_database() is None
+    assert updates == []
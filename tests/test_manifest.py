@@ -0,0 +1,61 @@
+'''
+Tests of the manifest recording the days stored into a collection, run
+against the in-process stand-in of the "mongomock" package.
+'''
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from webApplication import crud
+
+mongomock = pytest.importorskip("mongomock")
+
+DATES = [date(2024, 3, 1)+timedelta(days=n) for n in range(4)]
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch, tmp_path):
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+    monkeypatch.setattr(crud, "CACHE_DIRECTORY", str(tmp_path))
+
+def record(DATE, status, content=b"content"):
+    '''
+    Record the day "DATE" in the manifest of "new_data" and in the cache.
+    '''
+    crud.write_cache(DATE, content)
+    crud.database[crud.MANIFEST].insert_one(
+        {"_id": {"collection": "new_data",
+                 "day": datetime(DATE.year, DATE.month, DATE.day)},
+         "checksum": crud.cached_digest(DATE),
+         "rows": 1,
+         "status": status})
+
+def test_pending_days_without_manifest():
+    assert crud.pending_days(DATES, "new_data") == DATES
+
+def test_pending_days_skips_the_complete_days():
+    record(DATES[0], "complete")
+    record(DATES[1], "started")
+    assert crud.pending_days(DATES, "new_data") == DATES[1:]
+
+def test_pending_days_without_cache(tmp_path, monkeypatch):
+    # The cache of another worker is not needed to skip the complete days.
+    record(DATES[0], "complete")
+    monkeypatch.setattr(crud, "CACHE_DIRECTORY", str(tmp_path/"empty"))
+    assert crud.pending_days(DATES, "new_data") == DATES[1:]
+
+def test_pending_days_keeps_the_recent_days():
+    recent = [date.today()-timedelta(days=n) for n in range(3,-1,-1)]
+    for DATE in recent:
+        record(DATE, "complete")
+    # The files of yesterday and today may still be completed.
+    assert crud.pending_days(recent, "new_data") == recent[2:]
+
+def test_pending_days_reads_the_manifest_of_the_collection():
+    record(DATES[0], "complete")
+    assert crud.pending_days(DATES, "LCSQA_data") == DATES
+
+def test_clear_manifest_before_a_day():
+    for DATE in DATES:
+        record(DATE, "complete")
+    crud.clear_manifest("new_data", before=DATES[2])
+    assert crud.pending_days(DATES, "new_data") == DATES[:2]
@@ -0,0 +1,66 @@
+'''
+Tests of the parsing of the daily files of the LCSQA.
+'''
+from datetime import date, datetime
+
+from webApplication import benchmark, crud
+
+DATE = date(2024, 3, 1)
+
+def day_file(rows):
+    '''
+    Return the content of a daily file with the given (station, pollutant,
+    hour, value, validity) rows (see function "synthetic_day" of
+    "benchmark.py").
+    '''
+    lines = [";".join(benchmark.FR_E2_COLUMNS)]
+    for station, pollutant, hour, value, validity in rows:
+        start = datetime(DATE.year, DATE.month, DATE.day, hour)
+        line = [""]*len(benchmark.FR_E2_COLUMNS)
+        line[0] = start.strftime(benchmark.TIME_FORMAT)
+        line[benchmark.FR_E2_COLUMNS.index("code site")] = station
+        line[benchmark.FR_E2_COLUMNS.index("Polluant")] = pollutant
+        line[benchmark.FR_E2_COLUMNS.index("valeur brute")] = str(value)
+        line[benchmark.FR_E2_COLUMNS.index("validité")] = str(validity)
+        lines.append(";".join(line))
+    return ("\n".join(lines)+"\n").encode()
+
+def test_parse_day_keeps_the_validated_data():
+    data = crud.parse_day(day_file([
+        ("FR10000", "O3", 0, 12.5, 1),
+        ("FR10000", "O3", 1, 13.5, -1),
+        ("FR10000", "NO2", 2, -2.0, 1),
+        ("FR10001", "NO", 3, 4.0, 1),
+        ("FR10001", "PM10", 23, 8.0, 1)]))
+    assert data["code site"].tolist() == ["FR10000", "FR10001"]
+    assert data["Polluant"].tolist() == ["O3", "PM10"]
+    assert data["valeur brute"].tolist() == [12.5, 8.0]
+    assert data["hour"].tolist() == [0, 23]
+    assert data["dateTime"].tolist() == [
+        datetime(2024, 3, 1, 0), datetime(2024, 3, 1, 23)]
+    assert "Date de début" not in data.columns
+
+def test_parse_day_reads_the_used_columns_only():
+    data = crud.parse_day(benchmark.synthetic_day(DATE, n_stations=2))
+    assert set(data.columns) == \
+    set(crud.USED_COLUMNS)-{"Date de début"}|{"dateTime", "hour"}
+    assert str(data["code site"].dtype) == "category"
+    assert str(data["Polluant"].dtype) == "category"
+    assert not(data["Polluant"].isin(crud.IGNORED_POLLUTANTS).any())
+
+def test_parse_day_without_data():
+    assert crud.parse_day(b"Service unavailable\n") is None
+
+def test_iter_batches():
+    data = crud.parse_day(benchmark.synthetic_day(DATE, n_stations=2))
+    batches = list(crud.iter_batches(data, batch_size=100))
+    assert [len(x) for x in batches[:-1]] == [100]*(len(batches)-1)
+    assert sum(len(x) for x in batches) == len(data)
+    document = batches[0][0]
+    assert set(document) == {
+        "code site", "Polluant", "valeur brute", "validité", "dateTime", "hour"}
+    # The documents only hold types which can be encoded by "pymongo".
+    assert type(document["code site"]) is str
+    assert type(document["valeur brute"]) is float
+    assert type(document["hour"]) is int
+    assert type(document["dateTime"]) is datetime
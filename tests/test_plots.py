@@ -0,0 +1,18 @@
+'''
+Tests of the rendering of the graphs returned by the "/plot" endpoint.
+'''
+import pytest
+
+from webApplication.plots import WHO_recommendation, plot_variation
+
+@pytest.mark.parametrize("level", [0, 1, 1.2, 4/3, 2, 10])
+def test_plot_variation_of_each_band(level):
+    # Values below, inside and above the colored zones of the thresholds
+    # (the highest one being 4/3 of the WHO recommendation).
+    values = [level*WHO_recommendation["PM2.5"]]*24
+    image = plot_variation("FR10000", "PM2.5", values)
+    assert image.startswith(b"\x89PNG")
+
+def test_plot_variation_in_svg():
+    image = plot_variation("FR10000", "O3", [200]*24, format="svg")
+    assert b"<svg" in image
@@ -0,0 +1,92 @@
+'''
+Tests of the daily rollover adding the new data to the ring buffers of
+"LCSQA_data", run against the in-process stand-in of the "mongomock"
+package.
+'''
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from webApplication import benchmark, crud
+
+mongomock = pytest.importorskip("mongomock")
+
+TODAY = date.today()
+END = datetime(TODAY.year, TODAY.month, TODAY.day)
+YESTERDAY = END-timedelta(days=1)
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    '''
+    Store the histories of two stations until the day before yesterday.
+    '''
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+    benchmark.store_synthetic_history(2, pollutants=["O3", "NO2"], days_ago=1)
+
+def history(station, pollutant, hour):
+    return crud.database["LCSQA_data"].find_one(
+        {"_id": {"station": station, "pollutant": pollutant, "hour": hour}}
+    )["history"]
+
+def store_new_data(rows):
+    '''
+    Fill the "new_data" collection with the given (station, pollutant,
+    hour, value, day) rows.
+    '''
+    crud.database["new_data"].insert_many([
+        {"code site": station,
+         "Polluant": pollutant,
+         "hour": hour,
+         "valeur brute": value,
+         "dateTime": DAY+timedelta(hours=hour)}
+        for station, pollutant, hour, value, DAY in rows])
+
+def test_rollover_adds_the_new_day():
+    previous = crud.history_window(history("FR10000", "O3", 5), 180, YESTERDAY)
+    store_new_data([("FR10000", "O3", 5, 42.0, YESTERDAY)])
+    report = crud.rollover("new_data")
+    assert report["documents"] == 1
+    assert report["bytes"] > 0
+    window = crud.history_window(history("FR10000", "O3", 5), 181, END)
+    assert window[-1] == 42.0
+    # The previous days are kept, the oldest one being still there while
+    # the update is published.
+    assert window[:-1].tolist() == pytest.approx(previous.tolist(), nan_ok=True)
+    assert history("FR10000", "O3", 5)["end"] == END
+
+def test_rollover_touches_only_the_documents_with_new_data():
+    documents = {
+        document["_id"]["hour"]: document["history"]
+        for document in crud.database["LCSQA_data"].find(
+            {"_id.station": "FR10001", "_id.pollutant": "NO2"})}
+    store_new_data([
+        ("FR10000", "O3", 5, 42.0, YESTERDAY),
+        ("FR10000", "O3", 6, 43.0, YESTERDAY)])
+    assert crud.rollover("new_data")["documents"] == 2
+    for document in crud.database["LCSQA_data"].find(
+        {"_id.station": "FR10001", "_id.pollutant": "NO2"}):
+        assert document["history"] == documents[document["_id"]["hour"]]
+
+def test_rollover_adds_new_stations():
+    store_new_data([("FR10009", "SO2", 0, 7.0, YESTERDAY)])
+    assert crud.rollover("new_data")["documents"] == 1
+    assert crud.history_window(history("FR10009", "SO2", 0), 2, END).tolist() \
+    == pytest.approx([float("nan"), 7.0], nan_ok=True)
+
+def test_rollover_replaces_the_values_given_again():
+    # Days given again (when an update is retried) replace the stored ones.
+    DAY = YESTERDAY-timedelta(days=3)
+    store_new_data([
+        ("FR10000", "O3", 5, 1.0, DAY),
+        ("FR10000", "O3", 5, 2.0, YESTERDAY)])
+    crud.rollover("new_data")
+    window = crud.history_window(history("FR10000", "O3", 5), 4, END)
+    assert window[0] == 1.0
+    assert window[-1] == 2.0
+    averages = crud.history_averages(
+        crud.database["LCSQA_data"].find({"_id.station": "FR10000",
+                                          "_id.pollutant": "O3",
+                                          "_id.hour": 5}),
+        1,
+        END)
+    assert averages[5] == 2.0
@@ -0,0 +1,50 @@
+'''
+Tests of the locations of the LCSQA stations (departments and regions).
+'''
+import pytest
+
+from webApplication import crud
+
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.mark.parametrize("city_code, department", [
+    ("01004", "Ain"),
+    ("11069", "Aude"),
+    ("2A004", "Corse-du-Sud"),
+    ("2B033", "Haute-Corse"),
+    ("21231", "Côte-d'Or"),
+    ("57463", "Moselle"),
+    ("58194", "Nièvre"),
+    ("95127", "Val-d'Oise"),
+    ("97101", "Guadeloupe"),
+    ("97411", "La Réunion")])
+def test_get_department(city_code, department):
+    assert crud.get_department(city_code) == department
+
+def test_get_department_of_an_unknown_code():
+    with pytest.raises(KeyError):
+        crud.get_department("99135")
+
+@pytest.fixture
+def database(monkeypatch):
+    database = mongomock.MongoClient()["air_quality"]
+    monkeypatch.setattr(crud, "database", database)
+    return database
+
+def test_every_station_has_a_department():
+    assert all(station["Département"] for station in crud.load_stations())
+
+def test_create_locations(database):
+    crud.create_locations()
+    assert not(crud.locations_are_outdated())
+    metz = database["cities"].find_one({"_id": "METZ"})
+    assert "FR01011" in crud.get_stations(department="Moselle")
+    assert {x["code"] for x in metz["stations"]} <= \
+    set(crud.get_stations(region="GRAND EST"))
+    assert database["regions"].find_one({"_id": "GUADELOUPE"})["departments"][0] \
+    == "Guadeloupe"
+
+def test_outdated_locations_are_detected(database):
+    crud.create_locations()
+    database["departments"].insert_one({"_id": "Morbilhan", "cities": ["METZ"]})
+    assert crud.locations_are_outdated()
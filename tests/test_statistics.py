@@ -0,0 +1,55 @@
+'''
+Tests of the hourly statistics returned with the "stats" parameter.
+'''
+from datetime import date, datetime, timedelta
+
+import numpy
+import pytest
+
+from webApplication import crud
+
+def test_hourly_statistics():
+    matrix = numpy.full((4, 24), numpy.nan, dtype=numpy.float32)
+    matrix[:, 0] = [1, 2, 3, 4]
+    matrix[1:3, 1] = [5, 7]
+    statistics = crud.hourly_statistics(
+        matrix, ["mean", "median", "max", "count", "p50"])
+    assert statistics["mean"][:3] == [2.5, 6, None]
+    assert statistics["median"][:3] == [2.5, 6, None]
+    assert statistics["p50"][:3] == [2.5, 6, None]
+    assert statistics["max"][:3] == [4, 7, None]
+    assert statistics["count"][:3] == [4, 2, 0]
+
+def test_hourly_statistics_without_days():
+    statistics = crud.hourly_statistics(
+        numpy.empty((0, 24), dtype=numpy.float32), ["mean", "p90", "count"])
+    assert statistics == {
+        "mean": [None]*24, "p90": [None]*24, "count": [0]*24}
+
+@pytest.mark.parametrize("percentile", [1, 25, 90, 99])
+def test_hourly_statistics_percentiles(percentile):
+    generator = numpy.random.default_rng(0)
+    matrix = generator.uniform(0, 60, (180, 24)).astype(numpy.float32)
+    row = crud.hourly_statistics(matrix, ["p"+str(percentile)])["p"+str(percentile)]
+    assert row == pytest.approx(
+        numpy.percentile(matrix, percentile, axis=0).tolist(), rel=1e-6)
+
+def test_get_statistics_from_the_ring_buffers(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+    monkeypatch.setattr(crud, "cube", None)
+    DATE = date.today()-timedelta(days=1)
+    last_update = datetime(DATE.year, DATE.month, DATE.day)
+    monkeypatch.setattr(crud, "known_update", {"date": None, "time": float(0)})
+    crud.database["last_update"].insert_one({"date": last_update})
+    # Values 1, 2 and 3 recorded at 8h00 over the last three days.
+    end = last_update+timedelta(days=1)
+    days = [end.toordinal()-n for n in (3, 2, 1)]
+    crud.database["LCSQA_data"].insert_one(
+        {"_id": {"station": "FR10000", "pollutant": "O3", "hour": 8},
+         "history": crud.encode_history([1, 2, 3], days, end)})
+    statistics = crud.get_statistics("FR10000", "O3", 2, ["mean", "count", "max"])
+    assert statistics["mean"][8] == 2.5
+    assert statistics["count"][8] == 2
+    assert statistics["max"][8] == 3
+    assert statistics["mean"][9] is None
@@ -0,0 +1,91 @@
+'''
+Tests of the pool of threads inserting the parsed documents (see class
+"bulkWriter" of "crud.py"), run against the in-process stand-in of the
+"mongomock" package.
+'''
+import threading
+import time
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from webApplication import crud
+
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    monkeypatch.setattr(crud, "database", mongomock.MongoClient()["air_quality"])
+
+@pytest.fixture
+def writer():
+    writer = crud.bulkWriter(workers=2, queue_size=2, batch_size=2)
+    yield writer
+    writer.close()
+
+def batches(first, n_batches):
+    return [[{"_id": first+2*i}, {"_id": first+2*i+1}] for i in range(n_batches)]
+
+def test_submit_calls_back_once_all_batches_are_inserted(writer):
+    counts = []
+    callback = lambda: counts.append(crud.database["c"].count_documents({}))
+    writer.submit("c", batches(0, 5), callback)
+    writer.join()
+    assert counts == [10]
+
+def test_submit_without_batches(writer):
+    calls = []
+    writer.submit("c", [], lambda: calls.append(1))
+    writer.join()
+    assert calls == [1]
+
+def test_failed_insertion(writer):
+    calls = []
+    crud.database["c"].insert_one({"_id": 3})
+    writer.submit("c", batches(0, 3), lambda: calls.append(1))
+    with pytest.raises(BulkWriteError):
+        writer.join()
+    # The day is never marked as stored.
+    assert calls == []
+    # The threads are still running.
+    assert all(thread.is_alive() for thread in writer.threads)
+    writer.errors.clear()
+    writer.submit("d", batches(0, 3), lambda: calls.append(2))
+    writer.join()
+    assert calls == [2]
+
+def test_failed_callback(writer):
+    def callback():
+        raise RuntimeError("manifest not available")
+    for i in range(3):
+        writer.submit("c", batches(10*i, 2), callback)
+    with pytest.raises(RuntimeError):
+        writer.join()
+    assert len(writer.errors) == 3
+    assert crud.database["c"].count_documents({}) == 12
+    assert all(thread.is_alive() for thread in writer.threads)
+
+def test_full_queue_pauses_the_parsing(writer, monkeypatch):
+    # Block the insertions until "released" is set.
+    released = threading.Event()
+    insert_many = mongomock.collection.Collection.insert_many
+    def blocked(self, *args, **kwargs):
+        released.wait()
+        return insert_many(self, *args, **kwargs)
+    monkeypatch.setattr(mongomock.collection.Collection, "insert_many", blocked)
+    produced = []
+    def parse():
+        for batch in batches(0, 10):
+            produced.append(batch)
+            yield batch
+    thread = threading.Thread(target=writer.submit, args=("c", parse()))
+    thread.start()
+    time.sleep(0.2)
+    # One batch is being inserted by each thread, two are queued and the
+    # next one waits for a free place.
+    assert len(produced) == 2+2+1
+    released.set()
+    thread.join()
+    writer.join()
+    assert len(produced) == 10
+    assert crud.database["c"].count_documents({}) == 20